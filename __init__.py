@@ -11,14 +11,52 @@ bl_info = {
 
 import bpy
 import aud
-import textwrap
 import re
 import os
-import subprocess
 import platform
+import functools
+import struct
+import json
+import time
 import site
-from bpy.props import StringProperty, BoolProperty, EnumProperty, CollectionProperty, PointerProperty, IntProperty
+import uuid
+import threading
+from bpy.props import StringProperty, BoolProperty, EnumProperty, CollectionProperty, PointerProperty, IntProperty, FloatProperty
 from bpy.types import Operator, AddonPreferences, Panel, PropertyGroup
+from .engine.dependencies import Installer, install_commands, is_installed, uninstall_commands
+from .engine.downloads import DEFAULT_MODELS_DIRECTORY, ModelDownload, fetch_model_info, scan_models
+from .engine.backends import LocalBackend, OpenAIBackend
+from .engine.candidates import CandidatePool, candidate_requests, candidate_workers
+from .engine.chunking import chunk_spans, tail_text
+from .engine.fountain import FountainIndex, is_scene_heading, text_hash
+from .engine.generation import ChatSessions, GenerationJob, GenerationRequest
+from .engine.history_store import HistoryStore
+from .engine.metrics import MetricsLog, RollingAverages, estimate_tokens, format_summary
+from .engine.models import ModelManager, Prewarmer, close_model, load_gpt4all
+from .engine.prompts import (
+    SYSTEM_TEMPLATE,
+    chunk_prompt,
+    collect_history,
+    message_prompt,
+    retrieval_prompt,
+    selection_prompt,
+    selection_system_template,
+)
+from .engine.response_cache import ResponseCache, cache_key, is_deterministic
+from .engine.retrieval import Embedder, Retrieval, SceneIndex, passages
+from .engine.scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, RequestQueue
+from .engine.stopping import StopRules, pattern_error, stop_stream
+from .engine.streaming import StreamProcessor, TokenCoalescer, process_stream
+from .engine.textdiff import LineDiff, diff_preview, text_end
+from .engine.tuning import (
+    AutoTuner,
+    TuningStore,
+    available_memory,
+    estimate_memory,
+    read_gguf_metadata,
+    tuning_configurations,
+)
+from .engine.wrapping import WrapCache
 
 # Only GPU is supported, but can be changed:
 # model = GPT4All(model, device="gpu")  # , device='gpu') # device='amd', device='intel'
@@ -57,70 +95,138 @@ def python_exec():
         print("Sorry, still not implemented for ", os.name, " - ", platform.system)
 
 
-def import_module(module, install_module):
-    module = str(module)
-    python_exe = python_exec()
-    try:
-        subprocess.call([python_exe, "-m", "ensurepip"])
-        subprocess.call([python_exe, "-m", "pip", "install", "--upgrade", "pip"])
-    except ImportError:
-        pass
-    try:
-        subprocess.call([python_exe, "import ", packageName])
-    except:
-        print("\nInstalling: " + module + " module")
-        subprocess.call([python_exe, "-m", "pip", "install", install_module, "--no-warn-script-location", "--upgrade"])
+installer = Installer()
+
+GPT4ALL_REQUIREMENT = "gpt4all[cuda]"
+
+
+def redraw_preferences():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == "PREFERENCES":
+                area.tag_redraw()
+
+
+def watch_background_tasks():
+    """Redraw the preferences while pip or a model download is running"""
+    redraw_preferences()
+    if installer.running or (_model_download is not None and _model_download.running):
+        return 0.5
+    return None
+
+
+def watch_in_preferences():
+    if not bpy.app.timers.is_registered(watch_background_tasks):
+        bpy.app.timers.register(watch_background_tasks)
+
+
+def run_installer(build_commands):
+    """Run pip commands in the background, showing their output in the add-on preferences"""
+    started = installer.start(build_commands, on_done=lambda status: print("pip: " + status.lower()))
+    if started:
+        watch_in_preferences()
+    return started
 
-        try:
-            exec("import " + module)
-        except ModuleNotFoundError:
-            return False
-    return True
+
+def install_gpt4all():
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    python_exe = python_exec()
+    wheel_dir = bpy.path.abspath(addon_prefs.wheel_directory)
+    return run_installer(lambda: install_commands(python_exe, GPT4ALL_REQUIREMENT, wheel_dir))
 
 
 # Function to check and install GPT4All
 def ensure_gpt4all_installed():
-    module = "gpt4all"
+    """Return True when GPT4All can be imported, otherwise start installing it in the background"""
+    if is_installed("gpt4all"):
+        return True
+    if not installer.running:
+        print("\nInstalling: gpt4all module")
+        install_gpt4all()
+    return False
 
-    try:
-        from gpt4all import GPT4All
 
-        print("Checking: GPT4ALL is installed.")
-    except Exception as e:
-        print(f"{e}")
-        import_module(module, "gpt4all[cuda]")
-        # get_supported_models()
-        return []
+def wait_for_gpt4all():
+    """Block until GPT4All is installed, for scripts and background mode"""
+    if not ensure_gpt4all_installed():
+        installer.wait()
+    return is_installed("gpt4all", refresh=True)
 
 
-def get_module_dependencies(module_name):
-    """
-    Get the list of dependencies for a given module.
-    """
-    pybin = python_exec()
-    result = subprocess.run([pybin, "-m", "pip", "show", module_name], capture_output=True, text=True)
-    output = result.stdout.strip()
-    dependencies = []
-    for line in output.split("\n"):
-        if line.startswith("Requires:"):
-            dependencies = line.split(":")[1].strip().split(", ")
-            break
-    return dependencies
+INSTALLING_MESSAGE = "GPT4All is being installed, see the add-on preferences for progress"
 
+DOWNLOADING_MESSAGE = "The model is being downloaded, see the add-on preferences for progress"
 
-def uninstall_module_with_dependencies(module_name):
-    """
-    Uninstall a module and its dependencies.
-    """
-    pybin = python_exec()
-    dependencies = get_module_dependencies(module_name)
-    # Uninstall the module
-    subprocess.run([pybin, "-m", "pip", "uninstall", "-y", module_name])
-    # Uninstall the dependencies
-    for dependency in dependencies:
-        print("\n ")
-        if len(dependency) > 5 and str(dependency[5].lower) != "numpy":
-            subprocess.run([pybin, "-m", "pip", "uninstall", "-y", dependency])
+_model_download = None
+
+
+def models_directory(addon_prefs):
+    if addon_prefs.models_directory:
+        return bpy.path.abspath(addon_prefs.models_directory)
+    return DEFAULT_MODELS_DIRECTORY
+
+
+def model_url(model_name):
+    return GPT4AllAddonPreferences.bl_rna.properties["model_select"].enum_items[model_name].description
+
+
+def is_model_downloaded(addon_prefs):
+    return addon_prefs.model_select in scan_models(models_directory(addon_prefs))
+
+
+def download_model(addon_prefs):
+    """Start downloading the selected model in the background, unless it is present or already downloading"""
+    global _model_download
+    model_name = addon_prefs.model_select
+    path = os.path.join(models_directory(addon_prefs), model_name)
+    if _model_download is not None and _model_download.running:
+        return _model_download.path == path
+    if is_model_downloaded(addon_prefs):
+        return False
+    print("Downloading: " + model_name)
+    _model_download = ModelDownload(model_url(model_name), path, lookup=lambda: fetch_model_info(model_name))
+    _model_download.start()
+    watch_in_preferences()
+    return True
+
+
+def ensure_model_downloaded():
+    """Return True when the selected model is on disk, otherwise start downloading it"""
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    if is_model_downloaded(addon_prefs):
+        return True
+    download_model(addon_prefs)
+    return False
+
+
+def wait_for_model():
+    """Block until the selected model is downloaded, for scripts and background mode"""
+    if not ensure_model_downloaded() and _model_download is not None:
+        _model_download.wait()
+    return is_model_downloaded(bpy.context.preferences.addons[__name__].preferences)
+
+
+def local_model_free(context):
+    """False while auto-tune loads its own copies of the local model, a Send would load one more next to them"""
+    if _auto_tuner is None or not _auto_tuner.running:
+        return True
+    return context.preferences.addons[__name__].preferences.backend == "SERVER"
+
+
+def ready_to_generate(operator):
+    """Report and return False while GPT4All is being installed, the model downloaded or auto-tuned"""
+    if bpy.context.preferences.addons[__name__].preferences.backend == "SERVER":
+        return True
+    if not local_model_free(bpy.context):
+        operator.report({"WARNING"}, "Auto-tune is running, wait for it or cancel it in the add-on preferences")
+        return False
+    if not ensure_gpt4all_installed():
+        operator.report({"WARNING"}, INSTALLING_MESSAGE)
+        return False
+    if not ensure_model_downloaded():
+        operator.report({"WARNING"}, DOWNLOADING_MESSAGE)
+        return False
+    return True
 
 
 #def get_supported_models():
@@ -140,9 +246,271 @@ def uninstall_module_with_dependencies(module_name):
 #        return []
 
 
+chat_sessions = ChatSessions()
+
+model_manager = ModelManager(on_release=chat_sessions.discard)
+
+# Extra models that generate rewrite candidates next to the resident one
+candidate_pool = CandidatePool()
+
+# Queued requests already run one at a time, this keeps the blocking helpers and
+# the pre-warm from using the resident model at the same time as them
+_model_lock = threading.Lock()
+
+prewarmer = Prewarmer(model_manager, _model_lock)
+
+wrap_cache = WrapCache()
+
+HISTORY_PAGE_LINES = 40
+HISTORY_ENTRIES_PER_PAGE = 3
+# Number of recent outputs offered to the prompt assembler, which keeps the newest that fit the history budget
+# Earlier versions gave only the last output. The assembler keeps the newest of these
+# that fit in the History Tokens budget, so older outputs only add context when there is room
+HISTORY_OUTPUTS = 3
+
+
+def config_path(filename):
+    """Path of a file in the add-on's folder of the Blender user config directory"""
+    folder = bpy.utils.user_resource("CONFIG", path="gpt4blender", create=True)
+    return os.path.join(folder, filename)
+
+
+_response_cache = None
+
+
+def get_response_cache(addon_prefs):
+    """Open the response cache in the user config folder on first use"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(config_path("responses.sqlite"))
+    _response_cache.max_bytes = addon_prefs.response_cache_size * 1024 * 1024
+    return _response_cache
+
+
+def close_response_cache():
+    global _response_cache
+    if _response_cache is not None:
+        _response_cache.close()
+        _response_cache = None
+
+
+_history_store = None
+
+
+def get_history_store():
+    """The external chat history store, opened on first use"""
+    global _history_store
+    if _history_store is None:
+        _history_store = HistoryStore(config_path("history.sqlite"))
+    return _history_store
+
+
+def close_history_store():
+    global _history_store
+    if _history_store is not None:
+        _history_store.close()
+        _history_store = None
+
+
+def uses_history_store(context=None):
+    addon_prefs = (context or bpy.context).preferences.addons[__name__].preferences
+    return addon_prefs.history_backend == "EXTERNAL"
+
+
+def history_count(scene):
+    """Number of chat history entries of the scene, wherever they are stored"""
+    gpt = scene.gpt
+    if not uses_history_store():
+        return len(gpt.chat_history)
+    if not gpt.history_session:
+        return 0
+    return get_history_store().count(gpt.history_session)
+
+
+def recent_outputs(scene, count):
+    """Outputs of the last count history entries, oldest first"""
+    gpt = scene.gpt
+    if not uses_history_store():
+        return [item.output for item in gpt.chat_history[-count:]]
+    if not gpt.history_session:
+        return []
+    return [entry["output"] for entry in reversed(get_history_store().page(gpt.history_session, 0, count))]
+
+
+metrics_averages = RollingAverages()
+
+# Requests ended by a stop rule this session, and the tokens of max_tokens they did not generate
+early_stops = {"count": 0, "tokens_saved": 0}
+
+_metrics_log = None
+
+
+def record_metrics(job):
+    """Log the metrics of a finished job and add them to the rolling averages"""
+    global _metrics_log
+    data = job.request.metrics.to_dict()
+    metrics_averages.add(data)
+    if data["tokens_saved"]:
+        early_stops["count"] += 1
+        early_stops["tokens_saved"] += data["tokens_saved"]
+    print("Metrics: " + format_summary(data))
+    if bpy.context.preferences.addons[__name__].preferences.log_metrics:
+        if _metrics_log is None:
+            _metrics_log = MetricsLog(config_path("metrics.jsonl"))
+        try:
+            _metrics_log.append(data)
+        except OSError as e:
+            print(f"Writing metrics log failed: {e}")
+    return data
+
+
+def release_models(self, context):
+    model_manager.release_all()
+    candidate_pool.release_all()
+
+
+def model_changed(self, context):
+    """Unload the old model and switch to the tuned settings of the new model and device"""
+    model_manager.release_all()
+    candidate_pool.release_all()
+    tuned = TuningStore(config_path("tuning.json")).get(self.model_select, self.device_select)
+    if tuned is not None:
+        self.n_threads = tuned["n_threads"]
+        self.n_batch = tuned["n_batch"]
+
+
+@functools.lru_cache(maxsize=8)
+def cached_gguf_metadata(path, modified):
+    return read_gguf_metadata(path)
+
+
+def model_memory_estimate(addon_prefs, n_batch=None):
+    """Estimated RAM needed by the selected model in bytes, or None if it is not on disk"""
+    path = os.path.join(models_directory(addon_prefs), addon_prefs.model_select)
+    try:
+        metadata = cached_gguf_metadata(path, os.path.getmtime(path))
+    except (OSError, ValueError, struct.error):
+        return None
+    return estimate_memory(metadata, os.path.getsize(path), addon_prefs.context_length, n_batch or addon_prefs.n_batch)
+
+
+_auto_tuner = None
+
+
+def watch_auto_tuner():
+    """Store and apply the fastest configuration once the auto-tune sweep has finished"""
+    redraw_preferences()
+    if _auto_tuner.running:
+        return 0.5
+    best = _auto_tuner.best
+    if _auto_tuner.status == "DONE" and best is not None:
+        addon_prefs = bpy.context.preferences.addons[__name__].preferences
+        TuningStore(config_path("tuning.json")).put(addon_prefs.model_select, addon_prefs.device_select, best)
+        addon_prefs.n_threads = best["n_threads"]
+        addon_prefs.n_batch = best["n_batch"]
+        print(f"Auto-tune: {best['n_threads']} threads, batch size {best['n_batch']}")
+    return None
+
+
+# Each pre-warm policy also covers the triggers with a lower level
+PREWARM_LEVELS = {"OFF": 0, "PANEL": 1, "LOAD": 2, "STARTUP": 3}
+
+_panel_prewarmed = False
+
+
+def prewarm_model(trigger):
+    """Start loading and warming up the selected model in the background if the pre-warm policy covers trigger"""
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    if PREWARM_LEVELS[addon_prefs.prewarm] < PREWARM_LEVELS[trigger] or addon_prefs.backend == "SERVER":
+        return
+    if not is_installed("gpt4all") or not is_model_downloaded(addon_prefs):
+        return
+    sync_model_manager(addon_prefs)
+    settings = model_settings(addon_prefs)
+    started = prewarmer.start(
+        addon_prefs.model_select, addon_prefs.device_select, settings, SYSTEM_TEMPLATE, n_batch=addon_prefs.n_batch
+    )
+    if started and not bpy.app.timers.is_registered(watch_prewarm):
+        bpy.app.timers.register(watch_prewarm)
+
+
+def watch_prewarm():
+    redraw_text_editors()
+    return 0.5 if prewarmer.running else None
+
+
+def prewarm_on_startup():
+    prewarm_model("STARTUP")
+    return None
+
+
+@bpy.app.handlers.persistent
+def prewarm_on_load(dummy):
+    if any(len(scene.gpt.chat_history) or scene.gpt.history_session for scene in bpy.data.scenes):
+        prewarm_model("LOAD")
+
+
+def release_idle_models():
+    sync_model_manager(bpy.context.preferences.addons[__name__].preferences)
+    model_manager.release_idle()
+    candidate_pool.release_idle()
+    return 30.0
+
+
 class GPT4AllAddonPreferences(AddonPreferences):
     bl_idname = __name__
 
+    backend: EnumProperty(
+        name="Backend",
+        description="Where the text is generated",
+        items=(
+            ("LOCAL", "Local GPT4All", "Run the selected model inside Blender"),
+            ("SERVER", "Server", "Send the prompts to an OpenAI-compatible server, on this machine or the network"),
+        ),
+        default="LOCAL",
+    )
+
+    server_url: StringProperty(
+        name="Server URL",
+        description="Base URL of the OpenAI-compatible API, the chat completions endpoint is added to it",
+        default="http://localhost:4891/v1",
+    )
+
+    server_api_key: StringProperty(
+        name="API Key",
+        description="Sent as a bearer token, leave empty for servers without authentication",
+        default="",
+        subtype="PASSWORD",
+    )
+
+    server_model: StringProperty(
+        name="Server Model",
+        description="Model name sent to the server, empty uses the selected model",
+        default="",
+    )
+
+    server_extended_sampling: BoolProperty(
+        name="Send llama.cpp Sampling",
+        description="Also send top_k and repeat_penalty, for servers built on llama.cpp such as the GPT4All API server",
+        default=False,
+    )
+
+    server_connect_timeout: FloatProperty(
+        name="Connect Timeout",
+        description="Seconds to wait for a connection to the server",
+        default=5.0,
+        min=0.5,
+        max=60.0,
+    )
+
+    server_read_timeout: FloatProperty(
+        name="Read Timeout",
+        description="Seconds to wait for the next token before giving up",
+        default=120.0,
+        min=1.0,
+        max=3600.0,
+    )
+
     soundselect: EnumProperty(
         name="Sound",
         items={
@@ -273,6 +641,7 @@ class GPT4AllAddonPreferences(AddonPreferences):
 #            ),
         },
         default="Nous-Hermes-2-Mistral-7B-DPO.Q4_0.gguf",
+        update=model_changed,
     )
 
     tokens: IntProperty(
@@ -280,6 +649,65 @@ class GPT4AllAddonPreferences(AddonPreferences):
         default=2000,
     )
 
+    stop_strings: StringProperty(
+        name="Stop Strings",
+        description="Comma separated strings that end the output before a line that starts with one of them",
+        default="Note:, Notes:, Explanation:",
+    )
+
+    stop_pattern: StringProperty(
+        name="Stop Pattern",
+        description="Regular expression, a generated line that matches it is dropped and ends the output",
+        default="",
+    )
+
+    stop_scene_complete: BoolProperty(
+        name="Stop When Scene Is Complete",
+        description="End the output after a transition, or before a scene heading the request did not ask for",
+        default=False,
+    )
+
+    history_tokens: IntProperty(
+        name="History Tokens",
+        description="Maximum size of the chat history given with a message, the newest outputs are kept",
+        default=512,
+        min=0,
+        max=16384,
+    )
+
+    use_retrieval: BoolProperty(
+        name="Scene Retrieval",
+        description="Add the scenes of the active text that are most relevant to the message to the prompt",
+        default=False,
+    )
+
+    embedding_model: EnumProperty(
+        name="Embedding Model",
+        description="Local model used to find relevant scenes",
+        items=(
+            ("nomic-embed-text-v1.5.f16.gguf", "nomic-embed-text-v1.5", "Nomic Embed v1.5, 270 MB"),
+            ("nomic-embed-text-v1.f16.gguf", "nomic-embed-text-v1", "Nomic Embed v1, 270 MB"),
+            ("all-MiniLM-L6-v2.gguf2.f16.gguf", "all-MiniLM-L6-v2", "SBert MiniLM, 45 MB, fastest"),
+        ),
+        default="all-MiniLM-L6-v2.gguf2.f16.gguf",
+    )
+
+    retrieval_scenes: IntProperty(
+        name="Scenes",
+        description="Maximum number of relevant scenes added to the prompt",
+        default=3,
+        min=1,
+        max=20,
+    )
+
+    retrieval_tokens: IntProperty(
+        name="Scene Tokens",
+        description="Maximum size of the added scenes in tokens",
+        default=1024,
+        min=64,
+        max=16384,
+    )
+
     device_select: EnumProperty(
         name="Device",
         items={
@@ -291,17 +719,337 @@ class GPT4AllAddonPreferences(AddonPreferences):
             ("nvidia", "NVIDIA", "Use the best GPU provided by the Kompute backend from this vendor"),
         },
         default="cuda",
+        update=model_changed,
+    )
+
+    models_directory: StringProperty(
+        name="Models Folder",
+        description="Folder the models are downloaded to and loaded from, empty uses the GPT4All default",
+        subtype="DIR_PATH",
+        default="",
+        update=release_models,
+    )
+
+    context_length: IntProperty(
+        name="Context Length",
+        description="Maximum number of tokens the model keeps in context",
+        default=2048,
+        min=256,
+        update=release_models,
+    )
+
+    temperature: FloatProperty(
+        name="Temperature",
+        description="Randomness of the output, 0 always picks the most likely token",
+        default=0.7,
+        min=0.0,
+        max=2.0,
+    )
+
+    top_k: IntProperty(
+        name="Top K",
+        description="Sample from this many of the most likely tokens",
+        default=40,
+        min=1,
+    )
+
+    top_p: FloatProperty(
+        name="Top P",
+        description="Sample from the most likely tokens whose probabilities add up to this",
+        default=0.4,
+        min=0.0,
+        max=1.0,
+    )
+
+    repeat_penalty: FloatProperty(
+        name="Repeat Penalty",
+        description="Penalize tokens that were generated recently",
+        default=1.18,
+        min=1.0,
+        max=2.0,
+    )
+
+    use_response_cache: BoolProperty(
+        name="Response Cache",
+        description="Store answers to deterministic prompts (Temperature 0 or Top K 1) and reuse them",
+        default=True,
+    )
+
+    response_cache_size: IntProperty(
+        name="Cache Size (MB)",
+        description="Maximum size of the response cache",
+        default=50,
+        min=1,
+    )
+
+    wheel_directory: StringProperty(
+        name="Offline Wheels",
+        description="Install dependencies from the wheel files in this folder instead of the internet",
+        subtype="DIR_PATH",
+        default="",
+    )
+
+    log_metrics: BoolProperty(
+        name="Log Metrics",
+        description="Append the timings of every request to metrics.jsonl in the user config folder",
+        default=True,
+    )
+
+    prewarm: EnumProperty(
+        name="Pre-warm Model",
+        description="Load the model in the background before the first message is sent",
+        items=(
+            ("OFF", "Off", "Load the model when the first message is sent"),
+            ("PANEL", "Panel Opened", "Load the model when the GPT4ALL panel is first shown"),
+            (
+                "LOAD",
+                "File Loaded",
+                "Load the model when a file with chat history is opened, or the panel is first shown",
+            ),
+            ("STARTUP", "Startup", "Load the model when Blender starts, a file is opened or the panel is shown"),
+        ),
+        default="OFF",
+    )
+
+    persistent_session: BoolProperty(
+        name="Keep Chat Session",
+        description="Continue the open chat session for consecutive messages instead of evaluating the "
+        "system prompt and history again",
+        default=True,
+    )
+
+    flush_rate: FloatProperty(
+        name="Text Updates per Second",
+        description="Maximum rate at which streamed tokens are written to the text, 0 writes every token",
+        default=20.0,
+        min=0.0,
+        max=120.0,
+    )
+
+    candidate_count: IntProperty(
+        name="Candidates",
+        description="Number of rewrites generated side by side by Send Candidates",
+        default=3,
+        min=2,
+        max=6,
+    )
+
+    output_mode: EnumProperty(
+        name="Output",
+        description="How generated text reaches the Text",
+        items=(
+            ("STREAM", "Stream Into Text", "Write tokens into the Text as they arrive, every write is its own edit"),
+            (
+                "COMMIT",
+                "Commit When Done",
+                "Stream into a scratch Text, then change only the lines that differ in one undo step",
+            ),
+            ("PREVIEW", "Preview", "Stream into a scratch Text, then accept or reject the changed lines"),
+        ),
+        default="COMMIT",
+    )
+
+    chunk_overlap: IntProperty(
+        name="Chunk Overlap",
+        description=(
+            "Tokens of the already rewritten text given as context when a long selection is rewritten in chunks"
+        ),
+        default=64,
+        min=0,
+        max=1024,
+    )
+
+    history_preview_lines: IntProperty(
+        name="History Preview Lines",
+        description="Number of lines shown for a collapsed chat history output",
+        default=8,
+        min=1,
+        max=HISTORY_PAGE_LINES,
+    )
+
+    history_backend: EnumProperty(
+        name="Chat History",
+        description="Where the chat history is kept",
+        items=(
+            ("SCENE", "Scene", "Store the history in the scene, inside the .blend file"),
+            (
+                "EXTERNAL",
+                "External Store",
+                "Store the history in a database in the user config folder, the scene only keeps a reference",
+            ),
+        ),
+        default="SCENE",
+        update=lambda self, context: invalidate_history_cache(),
+    )
+
+    n_threads: IntProperty(
+        name="Threads",
+        description="CPU threads used by the model, 0 lets GPT4All decide",
+        default=0,
+        min=0,
+        max=256,
+        update=release_models,
+    )
+
+    n_batch: IntProperty(
+        name="Batch Size",
+        description="Number of prompt tokens evaluated at once",
+        default=8,
+        min=1,
+        max=4096,
+    )
+
+    model_cache_size: IntProperty(
+        name="Resident Models",
+        description="Number of loaded models kept in memory between requests",
+        default=1,
+        min=1,
+        max=4,
+    )
+
+    model_idle_timeout: IntProperty(
+        name="Unload After (min)",
+        description="Unload models that have not been used for this many minutes, 0 keeps them loaded",
+        default=10,
+        min=0,
     )
 
     def draw(self, context):
         layout = self.layout
+        layout.prop(self, "backend")
+        if self.backend == "SERVER":
+            box = layout.box()
+            box.prop(self, "server_url")
+            box.prop(self, "server_api_key")
+            box.prop(self, "server_model")
+            box.prop(self, "server_extended_sampling")
+            row = box.row()
+            row.prop(self, "server_connect_timeout")
+            row.prop(self, "server_read_timeout")
         layout.prop(self, "model_select")
+        box = layout.box()
+        box.prop(self, "models_directory")
+        download = _model_download
+        row = box.row()
+        if download is not None and download.running and download.path.endswith(self.model_select):
+            if download.status == "VERIFYING":
+                row.label(text="Verifying...", icon="SORTTIME")
+            else:
+                text = f"Downloading {download.progress * 100:.0f}%"
+                if download.total:
+                    text += f" of {download.total / 1e9:.1f} GB"
+                text += f", {download.bytes_per_second / 1e6:.1f} MB/s"
+                row.label(text=text, icon="SORTTIME")
+            row.operator("gpt4all.cancel_download", text="", icon="CANCEL")
+        elif is_model_downloaded(self):
+            row.label(text="Downloaded", icon="CHECKMARK")
+        else:
+            if download is not None and download.status == "FAILED":
+                row.label(text="Download failed: " + str(download.error), icon="ERROR")
+            row.operator("gpt4all.download_model", text="Download", icon="IMPORT")
         layout.prop(self, "device_select")
-        layout.prop(self, "tokens")
+        row = layout.row()
+        row.prop(self, "tokens")
+        row.prop(self, "history_tokens")
+
+        box = layout.box()
+        row = box.row()
+        row.prop(self, "stop_strings")
+        row.prop(self, "stop_pattern")
+        error = pattern_error(self.stop_pattern)
+        if error is not None:
+            box.label(text="Invalid stop pattern, it is ignored: " + error, icon="ERROR")
+        box.prop(self, "stop_scene_complete")
+
+        box = layout.box()
+        box.prop(self, "use_retrieval")
+        if self.use_retrieval:
+            box.prop(self, "embedding_model")
+            row = box.row()
+            row.prop(self, "retrieval_scenes")
+            row.prop(self, "retrieval_tokens")
+
+        box = layout.box()
+        row = box.row()
+        row.prop(self, "context_length")
+        row.prop(self, "n_threads")
+        row.prop(self, "n_batch")
+        row = box.row()
+        if _auto_tuner is not None and _auto_tuner.running:
+            progress = f"{len(_auto_tuner.results)} / {len(_auto_tuner.configurations)}"
+            row.label(text="Auto-tuning " + progress, icon="SORTTIME")
+            row.operator("gpt4all.cancel_auto_tune", text="", icon="CANCEL")
+        else:
+            row.operator("gpt4all.auto_tune", text="Auto-tune", icon="PREFERENCES")
+            if _auto_tuner is not None and _auto_tuner.status == "FAILED":
+                row.label(text="Auto-tune failed: " + str(_auto_tuner.error), icon="ERROR")
+        needed = model_memory_estimate(self)
+        available = available_memory()
+        if needed is not None:
+            text = f"Needs about {needed / 1e9:.1f} GB"
+            if available is not None:
+                text += f" of {available / 1e9:.1f} GB available"
+            box.label(text=text, icon="ERROR" if available is not None and needed > available else "MEMORY")
+        layout.prop(self, "persistent_session")
+        layout.prop(self, "log_metrics")
+
+        box = layout.box()
+        box.label(text="Sampling")
+        row = box.row()
+        row.prop(self, "temperature")
+        row.prop(self, "top_k")
+        row = box.row()
+        row.prop(self, "top_p")
+        row.prop(self, "repeat_penalty")
+        row = box.row()
+        row.prop(self, "use_response_cache")
+        sub = row.row(align=True)
+        sub.active = self.use_response_cache
+        sub.prop(self, "response_cache_size")
+        sub.operator("gpt4all.clear_response_cache", text="", icon="TRASH")
+        if self.use_response_cache and _response_cache is not None:
+            stats = _response_cache.stats()
+            box.label(
+                text=f"{stats['entries']} answers, {stats['bytes'] / (1024 * 1024):.1f} MB, "
+                f"{stats['hits']} hits, {stats['misses']} misses this session"
+            )
+        row = layout.row()
+        row.prop(self, "output_mode")
+        row.prop(self, "flush_rate")
+        row = layout.row()
+        row.prop(self, "chunk_overlap")
+        row.prop(self, "candidate_count")
+        layout.prop(self, "history_preview_lines")
+        row = layout.row()
+        row.prop(self, "history_backend")
+        if self.history_backend == "EXTERNAL":
+            row.operator("gpt.move_history_to_store", text="", icon="EXPORT")
 
         row = layout.row()
+        row.prop(self, "model_cache_size")
+        row.prop(self, "model_idle_timeout")
+        row.operator("gpt4all.release_models", text="", icon="X")
+        layout.prop(self, "prewarm")
+
+        box = layout.box()
+        row = box.row()
         row.operator("gpt4all.install_dependencies", text="Install Dependencies")
         row.operator("gpt4all.uninstall_dependencies", text="Uninstall Dependencies")
+        box.prop(self, "wheel_directory")
+        if installer.status == "RUNNING":
+            box.label(text="Running pip...", icon="SORTTIME")
+        elif installer.status == "FAILED":
+            box.label(text="pip failed", icon="ERROR")
+        else:
+            installed = is_installed("gpt4all")
+            box.label(
+                text="GPT4All is installed" if installed else "GPT4All is not installed",
+                icon="CHECKMARK" if installed else "INFO",
+            )
+        if installer.status != "IDLE":
+            column = box.column(align=True)
+            for line in list(installer.lines)[-8:]:
+                column.label(text=line)
 
         box = layout.box()
         box.prop(self, "playsound")
@@ -354,13 +1102,113 @@ class GPT_OT_sound_notification(Operator):
         return {"FINISHED"}
 
 
+class GPT_OT_release_models(Operator):
+    bl_idname = "gpt4all.release_models"
+    bl_label = "Unload Models"
+    bl_description = "Unload all resident models to free memory"
+
+    def execute(self, context):
+        model_manager.release_all()
+        candidate_pool.release_all()
+        return {"FINISHED"}
+
+
+class GPT_OT_clear_response_cache(Operator):
+    bl_idname = "gpt4all.clear_response_cache"
+    bl_label = "Clear Response Cache"
+    bl_description = "Delete all cached answers"
+
+    def execute(self, context):
+        get_response_cache(context.preferences.addons[__name__].preferences).clear()
+        return {"FINISHED"}
+
+
+class GPT_OT_download_model(Operator):
+    bl_idname = "gpt4all.download_model"
+    bl_label = "Download Model"
+    bl_description = "Download the selected model in the background, resuming an interrupted download"
+
+    def execute(self, context):
+        download_model(context.preferences.addons[__name__].preferences)
+        return {"FINISHED"}
+
+
+class GPT_OT_cancel_download(Operator):
+    bl_idname = "gpt4all.cancel_download"
+    bl_label = "Cancel Download"
+    bl_description = "Stop the download, it can be resumed later"
+
+    def execute(self, context):
+        if _model_download is not None:
+            _model_download.cancel()
+        return {"FINISHED"}
+
+
+class GPT_OT_auto_tune(Operator):
+    bl_idname = "gpt4all.auto_tune"
+    bl_label = "Auto-tune"
+    bl_description = (
+        "Measure prompt and generation speed for several thread counts and batch sizes, "
+        "and keep the fastest for this model and device"
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return not is_busy() and not (_auto_tuner is not None and _auto_tuner.running)
+
+    def execute(self, context):
+        global _auto_tuner
+        addon_prefs = context.preferences.addons[__name__].preferences
+        if not ready_to_generate(self):
+            return {"CANCELLED"}
+
+        available = available_memory()
+        configurations = tuning_configurations(os.cpu_count(), addon_prefs.context_length)
+        if available is not None:
+            configurations = [
+                (n_threads, n_batch)
+                for n_threads, n_batch in configurations
+                if (model_memory_estimate(addon_prefs, n_batch) or 0) <= available
+            ]
+        if not configurations:
+            self.report({"ERROR"}, "The model would not fit in the available memory, lower the context length")
+            return {"CANCELLED"}
+
+        model_manager.release_all()
+        candidate_pool.release_all()
+        settings = model_settings(addon_prefs)
+        model_name, device = addon_prefs.model_select, addon_prefs.device_select
+
+        def load(n_threads):
+            return load_gpt4all(model_name, device, **dict(settings, n_threads=n_threads))
+
+        _auto_tuner = AutoTuner(load, configurations, SYSTEM_TEMPLATE, close=close_model).start()
+        bpy.app.timers.register(watch_auto_tuner)
+        return {"FINISHED"}
+
+
+class GPT_OT_cancel_auto_tune(Operator):
+    bl_idname = "gpt4all.cancel_auto_tune"
+    bl_label = "Cancel Auto-tune"
+    bl_description = "Stop the calibration sweep"
+
+    def execute(self, context):
+        if _auto_tuner is not None:
+            _auto_tuner.cancel()
+        return {"FINISHED"}
+
+
 class GPT_OT_install_dependencies(Operator):
     bl_idname = "gpt4all.install_dependencies"
     bl_label = "Install Dependencies"
     bl_description = "Install necessary dependencies for GPT4All"
 
+    @classmethod
+    def poll(cls, context):
+        return not installer.running
+
     def execute(self, context):
-        ensure_gpt4all_installed()
+        install_gpt4all()
         return {"FINISHED"}
 
 
@@ -369,26 +1217,138 @@ class GPT_OT_uninstall_dependencies(Operator):
     bl_label = "Uninstall Dependencies"
     bl_description = "Uninstall GPT4All dependencies"
 
+    @classmethod
+    def poll(cls, context):
+        return not installer.running
+
     def execute(self, context):
-        uninstall_module_with_dependencies("GPT4ALL")
+        model_manager.release_all()
+        candidate_pool.release_all()
+        python_exe = python_exec()
+        run_installer(lambda: uninstall_commands(python_exe, "gpt4all"))
         return {"FINISHED"}
 
 
-def label_multiline(context, text, parent):
+def label_multiline(context, text, parent, key=None, start=0, count=None):
+    """Draw text as word wrapped labels, returns the number of wrapped lines"""
     chars = int(context.region.width / 7)
-    wrapper = textwrap.TextWrapper(width=chars)
-    text_lines = [wrapped_line for line in text.splitlines() for wrapped_line in wrapper.wrap(text=line)]
-    for text_line in text_lines:
+    text_lines = wrap_cache.wrap(text, chars, key)
+    stop = len(text_lines) if count is None else start + count
+    for text_line in text_lines[start:stop]:
         parent.label(text=text_line)
+    return len(text_lines)
 
 
-class ChatHistoryItem(PropertyGroup):
-    input: StringProperty()
-    output: StringProperty()
+def label_history_text(context, text, key, parent, preview_lines, expanded, page_owner, page_attribute):
+    """
+    Draw a history text collapsed to a preview, or one page at a time when expanded.
 
+    Returns the label and icon of the toggle to draw below, or None if the text fits the preview.
+    """
+    if not expanded:
+        total = label_multiline(context, text, parent, key, 0, preview_lines)
+    else:
+        total = len(wrap_cache.wrap(text, int(context.region.width / 7), key))
+        pages = max(1, -(-total // HISTORY_PAGE_LINES))
+        page = min(getattr(page_owner, page_attribute), pages - 1)
+        label_multiline(context, text, parent, key, page * HISTORY_PAGE_LINES, HISTORY_PAGE_LINES)
+        if pages > 1:
+            row = parent.row(align=True)
+            row.prop(page_owner, page_attribute, text="Page")
+            row.label(text="of " + str(pages))
+    if total <= preview_lines:
+        return None
+    if expanded:
+        return "Show Less", "TRIA_UP"
+    return "Show More (" + str(total) + " lines)", "TRIA_DOWN"
 
-class GPT4AllAddonProperties(PropertyGroup):
+
+def invalidate_history_cache():
+    wrap_cache.clear()
+
+
+class ChatHistoryItem(PropertyGroup):
+    input: StringProperty()
+    output: StringProperty()
+    # JSON encoded RequestMetrics of the generation that produced this item
+    metrics: StringProperty()
+    expanded: BoolProperty(
+        name="Expanded",
+        description="Show the full text of this history item",
+        default=False,
+    )
+    page: IntProperty(
+        name="Page",
+        description="Page of the output shown",
+        default=0,
+        min=0,
+    )
+
+
+class BatchSceneItem(PropertyGroup):
+    heading: StringProperty()
+    # Hash of the original scene text, used to find the scene again after earlier scenes were rewritten
+    scene_hash: StringProperty()
+    status: EnumProperty(
+        items=(
+            ("PENDING", "Pending", ""),
+            ("RUNNING", "Running", ""),
+            ("DONE", "Done", ""),
+            ("SKIPPED", "Skipped", "The scene was edited while the batch was running"),
+            ("FAILED", "Failed", ""),
+        ),
+        default="PENDING",
+    )
+    seconds: FloatProperty()
+
+
+BATCH_STATUS_ICONS = {
+    "PENDING": "BLANK1",
+    "RUNNING": "SORTTIME",
+    "DONE": "CHECKMARK",
+    "SKIPPED": "ERROR",
+    "FAILED": "CANCEL",
+}
+
+
+class GPT4AllAddonProperties(PropertyGroup):
     chat_history: CollectionProperty(type=ChatHistoryItem)
+    batch_scenes: CollectionProperty(type=BatchSceneItem)
+    batch_text: StringProperty()
+    batch_running: BoolProperty(default=False)
+    show_scenes: BoolProperty(
+        name="Scenes",
+        description="List the scenes of the Text",
+        default=False,
+    )
+    # Bumped whenever history items are edited or removed, which ends the open chat session
+    history_revision: IntProperty(default=0)
+    # Key of this scene's entries in the external history store
+    history_session: StringProperty()
+    history_page: IntProperty(
+        name="Page",
+        description="Page of the chat history shown",
+        default=0,
+        min=0,
+    )
+    history_current_model: BoolProperty(
+        name="Current Model Only",
+        description="Only show history entries generated by the selected model",
+        default=False,
+    )
+    # Entry of the external store shown in full, and the page of its output
+    history_expanded: IntProperty(default=-1)
+    history_output_page: IntProperty(
+        name="Page",
+        description="Page of the output shown",
+        default=0,
+        min=0,
+    )
+    bypass_cache: BoolProperty(
+        name="Bypass Cache",
+        description="Always generate a new answer, even if the prompt has been answered before",
+        default=False,
+    )
     chat_gpt_select_prefix: StringProperty(
         name="Select Prefix",
         description="Selection prefix text",
@@ -409,104 +1369,648 @@ class GPT4AllAddonProperties(PropertyGroup):
     )
 
 
+def target_text(context):
+    """Return the Text shown in the editor, creating one if the editor is empty"""
+    text_doc = context.space_data.text
+    if text_doc is None:
+        text_doc = bpy.data.texts.new("Chat GPT")
+        context.space_data.text = text_doc
+    return text_doc
+
+
+# Structure index of each Text by name, brought up to date when a feature needs it
+fountain_indexes = {}
+
+
+def fountain_index(text_doc):
+    """The Fountain index of a Text, only the lines edited since it was last used are parsed again"""
+    index = fountain_indexes.get(text_doc.name)
+    if index is None:
+        index = fountain_indexes[text_doc.name] = FountainIndex()
+    index.update(text_doc.as_string())
+    return index
+
+
+# Line count and cursor of each Text when the panel last updated its index
+_index_checks = {}
+
+
+def drawn_fountain_index(text_doc):
+    """
+    The Fountain index of a Text for the panel, only updated when the Text's line count or cursor
+    changed since the last draw, so redraws without edits do not read the Text again.
+    """
+    check = (len(text_doc.lines), text_doc.current_line_index, text_doc.current_character)
+    index = fountain_indexes.get(text_doc.name)
+    if index is None or _index_checks.get(text_doc.name) != check:
+        index = fountain_index(text_doc)
+        _index_checks[text_doc.name] = check
+    return index
+
+
+def scene_text_span(structure, n):
+    """The (line, character) span of scene n without its trailing blank lines, and its text"""
+    lines = structure.lines
+    start, end = structure.scene_span(n)
+    while end - 1 > start and not lines[end - 1].strip():
+        end -= 1
+    return ((start, 0), (end - 1, len(lines[end - 1]))), "\n".join(lines[start:end])
+
+
+def set_selection(text_doc, start, end):
+    text_doc.current_line_index = start[0]
+    text_doc.current_character = start[1]
+    text_doc.select_end_line_index = end[0]
+    text_doc.select_end_character = end[1]
+
+
+def shift_position(position, start, end, new_end):
+    """Move a (line, character) position to account for start..end being replaced by text ending at new_end"""
+    if position < start:
+        return position
+    if position < end:
+        return new_end
+    line, character = position
+    if line == end[0]:
+        return (new_end[0], new_end[1] + character - end[1])
+    return (line + new_end[0] - end[0], character)
+
+
+def replace_range(text_doc, start, end, new_text):
+    """Replace the text between two (line, character) positions, keeping the user's cursor in place"""
+    cursor = (text_doc.current_line_index, text_doc.current_character)
+    select_end = (text_doc.select_end_line_index, text_doc.select_end_character)
+    set_selection(text_doc, start, end)
+    text_doc.write(new_text)
+    written = (text_doc.current_line_index, text_doc.current_character)
+    set_selection(
+        text_doc,
+        shift_position(cursor, start, end, written),
+        shift_position(select_end, start, end, written),
+    )
+    return written
+
+
+def selection_span(text_doc):
+    cursor = (text_doc.current_line_index, text_doc.current_character)
+    select_end = (text_doc.select_end_line_index, text_doc.select_end_character)
+    return min(cursor, select_end), max(cursor, select_end)
+
+
+def text_range(text_doc, start, end):
+    """The text between two (line, character) positions"""
+    lines = text_doc.as_string().split("\n")[start[0] : end[0] + 1]
+    if not lines:
+        return ""
+    lines[-1] = lines[-1][: end[1]] if start[0] < end[0] else lines[-1][start[1] : end[1]]
+    if start[0] < end[0]:
+        lines[0] = lines[0][start[1] :]
+    return "\n".join(lines)
+
+
+def commit_output(text_doc, start, end, output, message="GPT4All output"):
+    """
+    Replace start..end with output as one undo step, only writing the lines that differ.
+
+    Returns the LineDiff that was applied.
+    """
+    diff = LineDiff(start, text_range(text_doc, start, end), output)
+    for edit_start, edit_end, replacement in diff.edits:
+        written = replace_range(text_doc, edit_start, edit_end, replacement)
+        shift_queued_spans(text_doc.name, edit_start, edit_end, written)
+    # The edit may leave the line count and cursor as they were, the panel reads the Text again
+    _index_checks.pop(text_doc.name, None)
+    if diff.edits:
+        try:
+            bpy.ops.ed.undo_push(message=message)
+        except RuntimeError as e:
+            print("Undo push failed: " + str(e))
+    return diff
+
+
+# Leading dots hide the scratch Texts from the Text browser, they are removed once their output is used
+SCRATCH_TEXT = ".GPT4All Output"
+CANDIDATE_TEXT = ".GPT4All Candidate {}"
+
+
+def scratch_text():
+    """The Text that output is streamed into before it is committed, it only holds the running generation"""
+    text_doc = bpy.data.texts.get(SCRATCH_TEXT)
+    if text_doc is None:
+        text_doc = bpy.data.texts.new(SCRATCH_TEXT)
+    return text_doc
+
+
+def remove_scratch_text():
+    """Remove the scratch Text so it is not saved into the .blend file"""
+    text_doc = bpy.data.texts.get(SCRATCH_TEXT)
+    if text_doc is not None:
+        bpy.data.texts.remove(text_doc)
+
+
+class PendingOutput:
+    """Finished output waiting to be accepted or rejected, with the text it was compared to"""
+
+    def __init__(self, text_name, span, original, output, label):
+        self.text_name = text_name
+        self.span = span
+        self.original = original
+        self.output = output
+        self.label = label
+        diff = LineDiff(span[0], original, output)
+        self.added = diff.added
+        self.removed = diff.removed
+        self.preview = diff_preview(original, output)
+
+
+pending_outputs = []
+
+
+class TextSink:
+    """
+    Write streamed text into a Text datablock where the generation started, leaving the user's cursor alone.
+
+    Tokens are buffered and written at most max_rate times per second, or when a newline arrives.
+    """
+
+    def __init__(self, text_doc, max_rate=0.0, span=None):
+        self.text_name = text_doc.name
+        self.coalescer = TokenCoalescer(max_rate)
+        self.start, self.end = span or selection_span(text_doc)
+
+    def write(self, chunk):
+        text_doc = bpy.data.texts.get(self.text_name)
+        if text_doc is None or not chunk:
+            return
+        written = replace_range(text_doc, self.start, self.end, chunk)
+        shift_queued_spans(self.text_name, self.start, self.end, written)
+        self.start = self.end = written
+
+    def push(self, token):
+        self.coalescer.push(token)
+
+    def update(self, force=False):
+        """Write the buffered tokens if a flush is due, returns True if the text changed"""
+        chunk = self.coalescer.flush() if force else self.coalescer.poll()
+        self.write(chunk)
+        return chunk != ""
+
+
+def model_settings(addon_prefs):
+    return {
+        "n_ctx": addon_prefs.context_length,
+        "n_threads": addon_prefs.n_threads or None,
+        "model_path": models_directory(addon_prefs),
+        "allow_download": False,
+    }
+
+
+def sampling_settings(addon_prefs):
+    return {
+        "temp": addon_prefs.temperature,
+        "top_k": addon_prefs.top_k,
+        "top_p": addon_prefs.top_p,
+        "repeat_penalty": addon_prefs.repeat_penalty,
+    }
+
+
+_embedder = None
+
+# SceneIndex of each Text, by name
+scene_indexes = {}
+
+
+def get_embedder(addon_prefs):
+    global _embedder
+    if _embedder is None or _embedder.model_name != addon_prefs.embedding_model:
+        close_embedder()
+        # Embedding models are small, GPT4All downloads them on first use
+        _embedder = Embedder(addon_prefs.embedding_model, model_path=models_directory(addon_prefs), allow_download=True)
+    return _embedder
+
+
+def close_embedder():
+    global _embedder
+    if _embedder is not None:
+        _embedder.close()
+        _embedder = None
+
+
+def use_retrieval(request, addon_prefs, text_doc):
+    """Let the worker add the scenes of text_doc most relevant to the prompt, when retrieval is enabled"""
+    if not addon_prefs.use_retrieval or text_doc is None:
+        return
+    lines = text_doc.as_string().split("\n")
+    texts = [text for text in ("\n".join(lines[start:end]).strip() for start, end in passages(lines)) if text]
+    if not texts:
+        return
+    index = scene_indexes.get(text_doc.name)
+    if index is None or index.model_name != addon_prefs.embedding_model:
+        index = scene_indexes[text_doc.name] = SceneIndex(addon_prefs.embedding_model)
+    embedder = get_embedder(addon_prefs)
+    request.retrieval = Retrieval(
+        index, embedder, texts, request.prompt, addon_prefs.retrieval_scenes, addon_prefs.retrieval_tokens
+    )
+
+
+def use_response_cache(request, addon_prefs):
+    """Let a deterministic request be answered from the response cache, unless it is bypassed"""
+    if not addon_prefs.use_response_cache or bpy.context.scene.gpt.bypass_cache:
+        return
+    if request.retrieval is not None:
+        # The answer depends on the scenes found, which are only known on the worker
+        return
+    if is_deterministic(request.sampling):
+        get_response_cache(addon_prefs)
+        request.cache_key = cache_key(request)
+
+
+@functools.lru_cache(maxsize=16)
+def cached_stop_rules(strings, pattern, scene_complete, expected_scenes):
+    return StopRules(strings, pattern, scene_complete, expected_scenes)
+
+
+def stop_rules(addon_prefs, expected_scenes=1):
+    """The stop rules set in the preferences, or None when there are none"""
+    strings = tuple(string.strip() for string in addon_prefs.stop_strings.split(",") if string.strip())
+    pattern = addon_prefs.stop_pattern
+    error = pattern_error(pattern)
+    if error is not None:
+        print(f"Stop pattern ignored, it is not a valid regular expression: {error}")
+        pattern = ""
+    if not strings and not pattern and not addon_prefs.stop_scene_complete:
+        return None
+    return cached_stop_rules(strings, pattern, addon_prefs.stop_scene_complete, expected_scenes)
+
+
+def sync_model_manager(addon_prefs):
+    model_manager.max_models = addon_prefs.model_cache_size
+    model_manager.idle_timeout = addon_prefs.model_idle_timeout * 60
+    candidate_pool.idle_timeout = addon_prefs.model_idle_timeout * 60
+
+
+local_backend = LocalBackend(model_manager, chat_sessions, _model_lock)
+
+_server_backend = None
+
+
+def server_backend(addon_prefs):
+    """The server backend for the current preferences, its connection pool is kept while they do not change"""
+    global _server_backend
+    settings = (
+        addon_prefs.server_url,
+        addon_prefs.server_api_key,
+        addon_prefs.server_connect_timeout,
+        addon_prefs.server_read_timeout,
+        addon_prefs.server_extended_sampling,
+    )
+    if _server_backend is None or _server_backend.settings != settings:
+        close_server_backend()
+        _server_backend = OpenAIBackend(*settings[:4], extended_sampling=settings[4])
+        _server_backend.settings = settings
+    return _server_backend
+
+
+def close_server_backend():
+    global _server_backend
+    if _server_backend is not None:
+        _server_backend.close()
+        _server_backend = None
+
+
+def use_backend(request, addon_prefs):
+    """Send the request to the server when the server backend is selected"""
+    if addon_prefs.backend != "SERVER":
+        return
+    request.backend = server_backend(addon_prefs)
+    request.model_name = addon_prefs.server_model or request.model_name
+    request.metrics.model = request.model_name
+    request.metrics.device = "server"
+    request.conversation = None
+
+
+def run_request(request, cancel_event):
+    """Stream the processed answer to a request from the response cache or its backend"""
+    metrics = request.metrics
+    if request.cache_key is not None:
+        output = _response_cache.get(request.cache_key)
+        if output is not None:
+            print("Response cache: hit")
+            metrics.cache_hit = True
+            yield output
+            return
+    if request.retrieval is not None:
+        start = time.perf_counter()
+        try:
+            found = request.retrieval.passages()
+            request.prompt = retrieval_prompt(found, request.prompt)
+            print(f"Retrieval: {len(found)} scenes, {request.retrieval.embedded} embedded")
+        except Exception as e:
+            print(f"Retrieval failed: {e}")
+        metrics.retrieval = time.perf_counter() - start
+    output = []
+    tokens = (request.backend or local_backend).generate(request, cancel_event)
+    if request.stop_rules is not None:
+        tokens = stop_stream(tokens, request)
+    for chunk in process_stream(tokens, metrics):
+        output.append(chunk)
+        yield chunk
+    if request.cache_key is not None and not (cancel_event is not None and cancel_event.is_set()):
+        _response_cache.put(request.cache_key, "".join(output))
+
+
+_generation_jobs = []
+
+request_queue = RequestQueue()
+
+
+class QueuedGeneration:
+    """A request waiting in the queue, with the Text span its tokens will replace"""
+
+    def __init__(self, request, text_name, span, on_finish, on_cancel=None, label="", preview=False):
+        self.request = request
+        self.text_name = text_name
+        self.span = span
+        self.on_finish = on_finish
+        self.on_cancel = on_cancel
+        self.label = label
+        # Whether the output may wait for the user to accept it in the Preview output mode
+        self.preview = preview
+        # The output mode used, decided when the request starts
+        self.output_mode = "STREAM"
+        # The text of span when the request started, the output is only committed over the same text
+        self.original = None
+        # What finish_output did with the output: COMMITTED, PENDING or UNCHANGED
+        self.result = None
+
+
+def is_generating():
+    return len(_generation_jobs) > 0
+
+
+def is_busy():
+    return is_generating() or len(request_queue) > 0
+
+
+def queue_key(request, text_name, span):
+    """Queued requests are only the same when they also write their output to the same place"""
+    return json.dumps([cache_key(request), text_name, span])
+
+
+def start_generation(
+    request, text_doc, on_finish, span=None, priority=PRIORITY_INTERACTIVE, label="", on_cancel=None, preview=False
+):
+    """
+    Queue a request to run on a worker thread, its output goes into text_doc unless it is None.
+
+    The output replaces span, a pair of (line, character) positions, or the selection at the time
+    the request is queued when span is None. It is streamed into the text or committed when done,
+    as set by the Output preference, preview allows it to wait for the user to accept it.
+    Returns the queue item, or None when an identical request is already pending.
+    """
+    if text_doc is not None and span is None:
+        span = selection_span(text_doc)
+    label = label or request.prompt[:40]
+    text_name = text_doc.name if text_doc is not None else None
+    queued = QueuedGeneration(request, text_name, span, on_finish, on_cancel, label, preview)
+    item, added = request_queue.push(queue_key(request, text_name, span), priority, label, queued)
+    run_next_request()
+    return item if added else None
+
+
+def run_next_request():
+    """Start the first queued request unless one is running, the resident model serves them in turn"""
+    if _generation_jobs:
+        return
+    item = request_queue.pop()
+    if item is None:
+        return
+    queued = item.payload
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    if isinstance(queued, CandidateSet):
+        queued.start(addon_prefs.flush_rate)
+        return
+    job = GenerationJob(queued.request, run_request).start()
+    text_doc = bpy.data.texts.get(queued.text_name) if queued.text_name is not None else None
+    sink = None
+    if text_doc is not None and addon_prefs.output_mode == "STREAM":
+        sink = TextSink(text_doc, addon_prefs.flush_rate, queued.span)
+    elif text_doc is not None:
+        queued.output_mode = addon_prefs.output_mode
+        queued.original = text_range(text_doc, *queued.span)
+        scratch = scratch_text()
+        scratch.clear()
+        sink = TextSink(scratch, addon_prefs.flush_rate, ((0, 0), (0, 0)))
+    _generation_jobs.append((job, sink, queued))
+    if not bpy.app.timers.is_registered(drain_generation_jobs):
+        bpy.app.timers.register(drain_generation_jobs)
+
+
+def shift_queued_spans(text_name, start, end, written):
+    """Keep the spans of queued requests on their text while a running request writes into the same Text"""
+    for item in request_queue.items():
+        queued = item.payload
+        if queued.text_name == text_name and queued.span is not None:
+            queued.span = tuple(shift_position(position, start, end, written) for position in queued.span)
+
+
+def cancel_queued(item_id):
+    item = request_queue.remove(item_id)
+    if item is not None and item.payload.on_cancel is not None:
+        item.payload.on_cancel()
+
+
+def finish_output(job, queued):
+    """
+    Commit the output of a request that was streamed into the scratch Text, or keep it for a preview.
+
+    Output whose span was edited while it was generated is kept for a preview instead of being committed,
+    empty output leaves the span as it is. queued.result tells which of these happened.
+    """
+    remove_scratch_text()
+    text_doc = bpy.data.texts.get(queued.text_name)
+    if text_doc is None or job.cancelled or job.error is not None:
+        return
+    if not job.output.strip():
+        print(f"{queued.label}: the output is empty, the text is unchanged")
+        queued.result = "UNCHANGED"
+        return
+    start, end = queued.span
+    edited = text_range(text_doc, start, end) != queued.original
+    if edited or (queued.output_mode == "PREVIEW" and queued.preview):
+        if edited:
+            print(f"{queued.label}: the text was edited during generation, the output waits in the panel")
+        pending_outputs.append(PendingOutput(queued.text_name, queued.span, queued.original, job.output, queued.label))
+        queued.result = "PENDING"
+        return
+    commit_output(text_doc, start, end, job.output, "GPT4All: " + queued.label)
+    queued.result = "COMMITTED"
+
+
+def cancel_generation():
+    for job, sink, queued in _generation_jobs:
+        job.cancel()
+
+
+def redraw_text_editors():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == "TEXT_EDITOR":
+                area.tag_redraw()
+
+
+def drain_generation_jobs():
+    """Move tokens produced by the worker threads into their Text datablocks"""
+    changed = False
+    for entry in list(_generation_jobs):
+        job, sink, queued = entry
+        tokens = job.drain()
+        finished = job.finished
+        if sink is not None:
+            for token in tokens:
+                sink.push(token)
+            start = time.perf_counter()
+            changed = sink.update(force=finished) or changed
+            job.request.metrics.ui_flush += time.perf_counter() - start
+        if finished:
+            _generation_jobs.remove(entry)
+            # An error here must not stop the timer, the other jobs and the queue still need it
+            try:
+                record_metrics(job)
+                if queued.output_mode != "STREAM":
+                    finish_output(job, queued)
+                queued.on_finish(job)
+            except Exception as e:
+                print(f"Finishing {queued.label or 'generation'} failed: {e}")
+            try:
+                run_next_request()
+            except Exception as e:
+                print("Starting the next request failed: " + str(e))
+            changed = True
+    if changed:
+        redraw_text_editors()
+    if _generation_jobs:
+        return 0.02
+    return None
+
+
+def run_blocking(request, text_doc):
+    """Run a request on the calling thread, for scripts and background mode"""
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    sink = TextSink(text_doc, addon_prefs.flush_rate)
+    output = ""
+    metrics = request.metrics
+    start = time.perf_counter()
+    for token in run_request(request, None):
+        if metrics.time_to_first_token is None:
+            metrics.time_to_first_token = time.perf_counter() - start
+        output = output + token
+        sink.push(token)
+        flush_start = time.perf_counter()
+        sink.update()
+        metrics.ui_flush += time.perf_counter() - flush_start
+    sink.update(force=True)
+    metrics.total = time.perf_counter() - start
+    metrics_averages.add(metrics.to_dict())
+    return output
+
+
+def add_history_entry(scene, model_name, user_input, output, metrics):
+    gpt = scene.gpt
+    if uses_history_store():
+        if not gpt.history_session:
+            gpt.history_session = uuid.uuid4().hex
+        get_history_store().append(gpt.history_session, model_name, user_input, output, metrics)
+    else:
+        item = gpt.chat_history.add()
+        item.input = user_input
+        item.output = output
+        item.metrics = metrics
+    invalidate_history_cache()
+
+
+def add_chat_history(scene_name, user_input, job):
+    """Store a finished generation in the chat history of the scene it was started from"""
+    output = process_message(str(job.error)) if job.error else job.output
+    print("Input: \n" + job.request.prompt)
+    print("Output: \n" + output)
+    scene = bpy.data.scenes.get(scene_name)
+    if scene is not None:
+        add_history_entry(scene, job.request.model_name, user_input, output, json.dumps(job.request.metrics.to_dict()))
+    if not job.cancelled:
+        bpy.ops.renderreminder.gpt_play_notification()
+
+
 class GPT_OT_SendMessage(Operator):
     bl_label = "Send Message"
     bl_idname = "gpt.send_message"
 
+    @classmethod
+    def poll(cls, context):
+        return local_model_free(context)
+
     def execute(self, context):
         gpt = context.scene.gpt
+        if not ready_to_generate(self):
+            return {"CANCELLED"}
         try:
-            output = process_message(request_answer(gpt.chat_gpt_prefix + " " + gpt.chat_gpt_input + ": "))
-            item = gpt.chat_history.add()
-            item.input = gpt.chat_gpt_input
-            item.output = output
-            bpy.ops.renderreminder.gpt_play_notification()
+            request = message_request(message_prompt(gpt.chat_gpt_prefix, gpt.chat_gpt_input))
+            scene_name = context.scene.name
+            user_input = gpt.chat_gpt_input
+            item = start_generation(
+                request,
+                target_text(context),
+                lambda job: add_chat_history(scene_name, user_input, job),
+                label=user_input[:40],
+                preview=True,
+            )
+            if item is None:
+                self.report({"INFO"}, "This message is already queued")
         except Exception as e:
             self.report({"ERROR"}, str(e))
         return {"FINISHED"}
 
 
-def request_answer(text: str) -> str:
-    """Request an answer from the GPT4All model"""
-    ensure_gpt4all_installed()
+def message_request(text: str) -> GenerationRequest:
+    """Collect the settings, history and prompt for a chat message"""
     gpt = bpy.context.scene.gpt
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    sync_model_manager(addon_prefs)
+    print("Model: " + addon_prefs.model_select)
+    history_outputs = recent_outputs(bpy.context.scene, HISTORY_OUTPUTS)
+    conversation = None
+    if addon_prefs.persistent_session:
+        conversation = (bpy.context.scene.name, SYSTEM_TEMPLATE, gpt.history_revision)
+    request = GenerationRequest(
+        addon_prefs.model_select,
+        addon_prefs.device_select,
+        text,
+        system_template=SYSTEM_TEMPLATE,
+        history=collect_history(history_outputs),
+        max_tokens=addon_prefs.tokens,
+        model_settings=model_settings(addon_prefs),
+        conversation=conversation,
+        turn=history_count(bpy.context.scene),
+        sampling=sampling_settings(addon_prefs),
+        n_batch=addon_prefs.n_batch,
+        history_outputs=history_outputs,
+        history_budget=addon_prefs.history_tokens,
+        stop_rules=stop_rules(addon_prefs),
+    )
+    use_backend(request, addon_prefs)
+    use_retrieval(request, addon_prefs, getattr(bpy.context.space_data, "text", None))
+    use_response_cache(request, addon_prefs)
+    return request
+
+
+def request_answer(text: str, text_doc=None) -> str:
+    """Request an answer from the GPT4All model, blocking until it is complete"""
+    if not wait_for_gpt4all():
+        return "GPT4All could not be installed"
+    if not wait_for_model():
+        return "The model could not be downloaded"
     try:
-        from gpt4all import GPT4All
-
-        gpt = bpy.context.scene.gpt
-        preferences = bpy.context.preferences.addons[__name__].preferences
-        model = preferences.model_select
-        print("Model: " + model)
-        preferences = bpy.context.preferences
-        addon_prefs = preferences.addons[__name__].preferences
-        tokens = addon_prefs.tokens
-
-        collected_history = " "
-        if len(gpt.chat_history) > 0:
-            recent_history = gpt.chat_history[-1:]
-            for history_item in recent_history:
-                collected_history = collected_history + str(history_item.output)
-        print(collected_history)
-        model = GPT4All(model, device=addon_prefs.device_select)
-
-        text_doc = bpy.context.space_data.text
-        if text_doc is None:
-            text_doc = bpy.data.texts.new("Chat GPT")
-            bpy.context.space_data.text = text_doc
-        output = ""
-        
-        system_template = """You'll act as a screenwriting co-author focused on writing and enhancing scenes while adhering to these principles:
-        
-        0. Do not include:
-            comments
-            suggestions
-            notes
-            explanations
-            markdown
-            html
-            code
-            
-
-        1. Format & Style:
-           - Write in Fountain format for screenplays.
-           - Use concise, straightforward prose with no clichés, adverbs, or literary embellishments.
-
-        2. Narrative Techniques:
-           - Prioritize "show, don't tell" by using actions to reveal emotions and traits.
-           - Avoid summarizing or reflective conclusions; end scenes *in media res*.
-           - Ensure each scene has a purpose, contributing to the story’s structure and character arcs.
-
-        3. Characterization & Dialogue:
-           - Craft realistic, flawed characters whose actions align with their backstories.
-           - Write casual, authentic dialogue infused with subtext.
-
-        4. Action & Description:
-           - Emphasize direct, precise descriptions and sensory details for immersive world-building.
-           - Use strong nouns and verbs, avoiding qualifiers or broader reflections.
-
-        5. Structure & Themes:
-           - Follow a logical, detailed progression with a clear beginning, middle, and end.
-           - Develop themes through character-driven storytelling, balancing plot and emotional depth.
-           
-        6. Fountain formatting:
-            Scene Headings start with INT, EXT, and written in CAPS.
-            Action is written as normal text.
-            Character names are in UPPERCASE + line break.
-            Dialogue comes right after Character  + line break.
-            Parentheticals are wrapped in (parentheses) + line break.
-            Transitions end in TO:  + line break
-
-        \n"""
-
-        #system_template = "You're a screenwriter assistant. When asked to write screenplays, you use fountain screenplay formatting with no markdown. When writing dialogue, you never let characters say what they feel or want. Parenticals should only be used, if nessessary, for a single word describing how the following dialog should be delivered emotionally.\n"
-        with model.chat_session(system_template, collected_history):
-            for token in model.generate(text, max_tokens=tokens, streaming=True):
-                output = output + token
-                text_doc.write(token)
-                bpy.ops.wm.redraw_timer(type="DRAW_WIN_SWAP", iterations=1)
-        print("Input: \n" + gpt.chat_gpt_prefix + " " + gpt.chat_gpt_input + ": ")
-        print("Output: \n" + output)
-        return output
+        return run_blocking(message_request(text), text_doc or target_text(bpy.context))
     except Exception as e:
         return str(e)
 
@@ -518,77 +2022,695 @@ class GPT_OT_SendSelection(Operator):
     @classmethod
     def poll(cls, context):
         gpt = context.scene.gpt
-        return gpt.chat_gpt_select_prefix != ""
+        return gpt.chat_gpt_select_prefix != "" and local_model_free(context)
 
     def execute(self, context):
         gpt = context.scene.gpt
 
+        if not ready_to_generate(self):
+            return {"CANCELLED"}
         try:
-            text_editor = bpy.context.space_data.text
-            text_content = text_editor.region_as_string()
+            text_editor = context.space_data.text
+            return start_rewrite(self, context, text_editor, text_editor.region_as_string())
+        except Exception as e:
+            self.report({"ERROR"}, str(e))
+        return {"FINISHED"}
 
-            output = process_message(
-                request_selection_answer(
-                    "Rewrite without commenting, " + gpt.chat_gpt_select_prefix + ": " + "\n" + text_content
-                )
-            )
 
-            item = gpt.chat_history.add()
-            item.input = gpt.chat_gpt_select_prefix
-            item.output = output
+def start_rewrite(operator, context, text_doc, text_content, span=None, label="Rewrite"):
+    """
+    Rewrite text_content with the Rewrite prompt, streaming the answer over span or the selection.
 
+    Text too long for one prompt is rewritten in chunks.
+    """
+    gpt = context.scene.gpt
+    chunk_tokens = selection_chunk_tokens(gpt.chat_gpt_select_prefix)
+    if estimate_tokens(text_content) > chunk_tokens:
+        if _chunked_rewrite is not None:
+            operator.report({"WARNING"}, "A long selection is already being rewritten")
+            return {"CANCELLED"}
+        if span is not None:
+            set_selection(text_doc, *span)
+        rewrite = start_chunked_rewrite(text_doc, gpt.chat_gpt_select_prefix, text_content, chunk_tokens)
+        operator.report({"INFO"}, f"Rewriting in {len(rewrite.chunks)} chunks")
+        return {"FINISHED"}
+    request = selection_request(selection_prompt(gpt.chat_gpt_select_prefix, text_content))
+    scene_name = context.scene.name
+    user_input = gpt.chat_gpt_select_prefix
+    item = start_generation(
+        request,
+        text_doc,
+        lambda job: add_chat_history(scene_name, user_input, job),
+        span=span,
+        label=label + ": " + user_input[:30],
+        preview=True,
+    )
+    if item is None:
+        operator.report({"INFO"}, "This rewrite is already queued")
+    return {"FINISHED"}
+
+
+def candidate_backends(addon_prefs, count):
+    """
+    The backend of each candidate. A server runs them all at once, locally extra models are
+    loaded when the cores and memory allow it and the candidates are shared out between them.
+    """
+    if addon_prefs.backend == "SERVER":
+        return [server_backend(addon_prefs)] * count
+    workers = candidate_workers(count, model_memory_estimate(addon_prefs), available_memory(), os.cpu_count())
+    backends = [local_backend] + candidate_pool.backends(workers - 1)
+    return [backends[i % len(backends)] for i in range(count)]
+
+
+def candidate_text(i):
+    """The scratch Text candidate i streams into"""
+    name = CANDIDATE_TEXT.format(i + 1)
+    text_doc = bpy.data.texts.get(name)
+    if text_doc is None:
+        text_doc = bpy.data.texts.new(name)
+    return text_doc
+
+
+class CandidateSet:
+    """
+    Rewrites of one selection, generated at the same time with different temperatures.
+
+    Queued as a single item, each candidate streams into its own scratch Text until one is picked.
+    """
+
+    def __init__(self, scene_name, prefix, text_name, span, original, requests):
+        self.scene_name = scene_name
+        self.prefix = prefix
+        self.text_name = text_name
+        self.span = span
+        self.original = original
+        self.requests = requests
+        self.jobs = []
+
+    def start(self, flush_rate):
+        extra = {
+            id(request.backend)
+            for request in self.requests
+            if isinstance(request.backend, LocalBackend) and request.backend is not local_backend
+        }
+        threads = max(1, (os.cpu_count() or 1) // (len(extra) + 1))
+        for i, request in enumerate(self.requests):
+            if id(request.backend) in extra:
+                # Extra models share the cores with the resident one
+                request.model_settings = dict(request.model_settings, n_threads=threads)
+            text_doc = candidate_text(i)
+            text_doc.clear()
+            job = GenerationJob(request, run_request).start()
+            sink = TextSink(text_doc, flush_rate, ((0, 0), (0, 0)))
+            queued = QueuedGeneration(request, text_doc.name, ((0, 0), (0, 0)), self.job_finished)
+            self.jobs.append(job)
+            _generation_jobs.append((job, sink, queued))
+        print(f"Candidates: {len(self.requests)} on {len(extra) + 1} models")
+        if not bpy.app.timers.is_registered(drain_generation_jobs):
+            bpy.app.timers.register(drain_generation_jobs)
+
+    def job_finished(self, job):
+        if _candidates is self and all(job.finished for job in self.jobs):
+            print("Candidates finished")
             bpy.ops.renderreminder.gpt_play_notification()
+
+    def on_cancel(self):
+        discard_candidates()
+
+
+_candidates = None
+
+
+def discard_candidates(context=None):
+    """Stop the candidates and remove their scratch Texts"""
+    global _candidates
+    if _candidates is None:
+        return
+    for job in _candidates.jobs:
+        job.cancel()
+    target = bpy.data.texts.get(_candidates.text_name)
+    for i in range(len(_candidates.requests)):
+        text_doc = bpy.data.texts.get(CANDIDATE_TEXT.format(i + 1))
+        if text_doc is None:
+            continue
+        if context is not None and context.space_data.text == text_doc and target is not None:
+            context.space_data.text = target
+        bpy.data.texts.remove(text_doc)
+    _candidates = None
+
+
+class GPT_OT_SendCandidates(Operator):
+    bl_label = "Send Candidates"
+    bl_idname = "gpt.send_candidates"
+    bl_description = "Generate several rewrites of the selection side by side, then pick one"
+
+    @classmethod
+    def poll(cls, context):
+        text_doc = context.space_data.text
+        return text_doc is not None and context.scene.gpt.chat_gpt_select_prefix != "" and local_model_free(context)
+
+    def execute(self, context):
+        global _candidates
+        gpt = context.scene.gpt
+        if _candidates is not None:
+            self.report({"WARNING"}, "Pick or discard the current candidates first")
+            return {"CANCELLED"}
+        if not ready_to_generate(self):
+            return {"CANCELLED"}
+        try:
+            text_doc = context.space_data.text
+            text_content = text_doc.region_as_string()
+            if estimate_tokens(text_content) > selection_chunk_tokens(gpt.chat_gpt_select_prefix):
+                self.report({"WARNING"}, "The selection is too long for candidates, use Send Selection")
+                return {"CANCELLED"}
+            addon_prefs = context.preferences.addons[__name__].preferences
+            request = selection_request(selection_prompt(gpt.chat_gpt_select_prefix, text_content))
+            count = addon_prefs.candidate_count
+            requests = candidate_requests(request, count, seed=int(time.time()) % 100000)
+            for candidate, backend in zip(requests, candidate_backends(addon_prefs, count)):
+                candidate.backend = backend
+            span = selection_span(text_doc)
+            candidates = CandidateSet(
+                context.scene.name, gpt.chat_gpt_select_prefix, text_doc.name, span, text_content, requests
+            )
+            label = f"{count} candidates: " + gpt.chat_gpt_select_prefix[:30]
+            key = "candidates:" + queue_key(request, text_doc.name, span)
+            item, added = request_queue.push(key, PRIORITY_INTERACTIVE, label, candidates)
+            if not added:
+                self.report({"INFO"}, "These candidates are already queued")
+                return {"FINISHED"}
+            _candidates = candidates
+            run_next_request()
         except Exception as e:
             self.report({"ERROR"}, str(e))
         return {"FINISHED"}
 
 
-def request_selection_answer(text: str) -> str:
-    """Request an answer from the GPT4All model"""
-    ensure_gpt4all_installed()
-    try:
-        from gpt4all import GPT4All
-
-        gpt = bpy.context.scene.gpt
-        text_editor = bpy.context.space_data.text
-        preferences = bpy.context.preferences.addons[__name__].preferences
-        model = preferences.model_select
-        print("Model: " + model)
-        preferences = bpy.context.preferences
-        addon_prefs = preferences.addons[__name__].preferences
-        tokens = addon_prefs.tokens
+class GPT_OT_PickCandidate(Operator):
+    bl_label = "Pick Candidate"
+    bl_idname = "gpt.pick_candidate"
+    bl_description = "Write this candidate over the selection it rewrites, as one undo step"
 
-        model = GPT4All(model, device=addon_prefs.device_select)
-        system_template = gpt.chat_gpt_select_prefix + ": \n"
+    index: IntProperty()
 
-        text_doc = bpy.context.space_data.text
+    def execute(self, context):
+        if _candidates is None or self.index >= len(_candidates.jobs):
+            return {"CANCELLED"}
+        job = _candidates.jobs[self.index]
+        if not job.finished or job.cancelled or job.error is not None:
+            self.report({"WARNING"}, "This candidate is not finished")
+            return {"CANCELLED"}
+        text_doc = bpy.data.texts.get(_candidates.text_name)
         if text_doc is None:
-            text_doc = bpy.data.texts.new("Chat GPT")
-            bpy.context.space_data.text = text_doc
-        output = ""
-        with model.chat_session(system_template):
-            for token in model.generate(text, max_tokens=tokens, streaming=True):
-                output = output + token
-                text_doc.write(token)
-                bpy.ops.wm.redraw_timer(type="DRAW_WIN_SWAP", iterations=1)
-        print("Input: \n" + gpt.chat_gpt_select_prefix + ": " + "\n" + text_editor.region_as_string())
-        print("Output: \n" + output)
-        return output
+            self.report({"WARNING"}, "The Text of the candidates was removed")
+            return {"CANCELLED"}
+        start, end = _candidates.span
+        if text_range(text_doc, start, end) != _candidates.original:
+            self.report({"WARNING"}, "The selection was edited since the candidates were generated")
+            return {"CANCELLED"}
+        scene_name, prefix = _candidates.scene_name, _candidates.prefix
+        discard_candidates(context)
+        commit_output(text_doc, start, end, job.output, "GPT4All: candidate " + str(self.index + 1))
+        add_chat_history(scene_name, prefix, job)
+        redraw_text_editors()
+        return {"FINISHED"}
+
+
+class GPT_OT_ShowCandidate(Operator):
+    bl_label = "Show Candidate"
+    bl_idname = "gpt.show_candidate"
+    bl_description = "Show this candidate in the editor, or the rewritten Text when index is -1"
+
+    index: IntProperty(default=-1)
+
+    def execute(self, context):
+        if _candidates is None:
+            return {"CANCELLED"}
+        name = _candidates.text_name if self.index < 0 else CANDIDATE_TEXT.format(self.index + 1)
+        text_doc = bpy.data.texts.get(name)
+        if text_doc is not None:
+            context.space_data.text = text_doc
+        return {"FINISHED"}
+
+
+class GPT_OT_DiscardCandidates(Operator):
+    bl_label = "Discard Candidates"
+    bl_idname = "gpt.discard_candidates"
+    bl_description = "Stop the candidates and remove their Texts"
+
+    def execute(self, context):
+        if _candidates is not None and not _candidates.jobs:
+            for item in request_queue.items():
+                if item.payload is _candidates:
+                    request_queue.remove(item.id)
+        discard_candidates(context)
+        return {"FINISHED"}
+
+
+class GPT_OT_RewriteCurrentScene(Operator):
+    bl_label = "Rewrite Current Scene"
+    bl_idname = "gpt.rewrite_current_scene"
+    bl_description = "Rewrite the scene at the cursor with the Rewrite prompt"
+
+    @classmethod
+    def poll(cls, context):
+        text_doc = context.space_data.text
+        return text_doc is not None and context.scene.gpt.chat_gpt_select_prefix != "" and local_model_free(context)
+
+    def execute(self, context):
+        text_doc = context.space_data.text
+        n = fountain_index(text_doc).scene_at(text_doc.current_line_index)
+        if n is None:
+            self.report({"WARNING"}, "The cursor is not in a scene")
+            return {"CANCELLED"}
+        return send_scene(self, context, text_doc, n)
+
+
+class GPT_OT_SendScene(Operator):
+    bl_label = "Send Scene"
+    bl_idname = "gpt.send_scene"
+    bl_description = "Rewrite this scene with the Rewrite prompt"
+
+    index: IntProperty(default=0)
+
+    @classmethod
+    def poll(cls, context):
+        text_doc = context.space_data.text
+        return text_doc is not None and context.scene.gpt.chat_gpt_select_prefix != "" and local_model_free(context)
+
+    def execute(self, context):
+        text_doc = context.space_data.text
+        if not 0 <= self.index < fountain_index(text_doc).scene_count:
+            self.report({"WARNING"}, f"There is no scene {self.index + 1}")
+            return {"CANCELLED"}
+        return send_scene(self, context, text_doc, self.index)
+
+
+def send_scene(operator, context, text_doc, n):
+    if not ready_to_generate(operator):
+        return {"CANCELLED"}
+    try:
+        span, scene_text = scene_text_span(fountain_index(text_doc), n)
+        return start_rewrite(operator, context, text_doc, scene_text, span, label=f"Scene {n + 1}")
+    except Exception as e:
+        operator.report({"ERROR"}, str(e))
+    return {"FINISHED"}
+
+
+def selection_request(text: str) -> GenerationRequest:
+    """Collect the settings and prompt for rewriting a selection"""
+    gpt = bpy.context.scene.gpt
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    sync_model_manager(addon_prefs)
+    print("Model: " + addon_prefs.model_select)
+    request = GenerationRequest(
+        addon_prefs.model_select,
+        addon_prefs.device_select,
+        text,
+        system_template=selection_system_template(gpt.chat_gpt_select_prefix),
+        max_tokens=addon_prefs.tokens,
+        model_settings=model_settings(addon_prefs),
+        sampling=sampling_settings(addon_prefs),
+        n_batch=addon_prefs.n_batch,
+        stop_rules=stop_rules(addon_prefs, sum(1 for line in text.split("\n") if is_scene_heading(line))),
+    )
+    use_backend(request, addon_prefs)
+    use_response_cache(request, addon_prefs)
+    return request
+
+
+def request_selection_answer(text: str, text_doc=None) -> str:
+    """Request a rewrite from the GPT4All model, blocking until it is complete"""
+    if not wait_for_gpt4all():
+        return "GPT4All could not be installed"
+    if not wait_for_model():
+        return "The model could not be downloaded"
+    try:
+        return run_blocking(selection_request(text), text_doc or target_text(bpy.context))
     except Exception as e:
         return str(e)
 
 
+def selection_chunk_tokens(prefix):
+    """Largest selection, in tokens, that is rewritten in one prompt"""
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    overhead = estimate_tokens(selection_system_template(prefix) + selection_prompt(prefix, ""))
+    room = min(addon_prefs.tokens, addon_prefs.context_length // 2) - overhead - addon_prefs.chunk_overlap
+    return max(64, room)
+
+
+class ChunkedRewrite:
+    """
+    A selection rewritten one chunk at a time, each chunk streamed over its own source lines.
+
+    Only the size and hash of every chunk are kept, the text is read back from the Text when the chunk starts.
+    """
+
+    def __init__(self, text_name, prefix, position, lines, spans):
+        self.text_name = text_name
+        self.prefix = prefix
+        # (line, character) where the next chunk starts
+        self.position = position
+        self.previous = ""
+        # The queued generation of the current chunk, its span follows writes made while it waits
+        self.queued = None
+        self.done = 0
+        # (source lines, trailing blank lines, hash) of every chunk
+        self.chunks = []
+        for start, end in spans:
+            body = lines[start:end]
+            while body and not body[-1].strip():
+                body.pop()
+            self.chunks.append((len(body), end - start - len(body), text_hash("\n".join(body))))
+        # The selection may end inside its last line
+        self.last_length = len(lines[-1])
+
+    def body_span(self, lines):
+        """The source span of the next chunk in the current lines, or None if it was edited"""
+        count, blank, chunk_hash = self.chunks[self.done]
+        line, character = self.position
+        body = lines[line : line + count]
+        if body:
+            body[0] = body[0][character:]
+            if self.done == len(self.chunks) - 1 and not blank:
+                body[-1] = body[-1][: self.last_length]
+        if len(body) < count or text_hash("\n".join(body)) != chunk_hash:
+            return None
+        end_character = len(body[-1]) + (character if count == 1 else 0)
+        return self.position, (line + count - 1, end_character), "\n".join(body)
+
+
+_chunked_rewrite = None
+
+
+def start_chunked_rewrite(text_doc, prefix, selection, chunk_tokens):
+    global _chunked_rewrite
+    cursor = (text_doc.current_line_index, text_doc.current_character)
+    select_end = (text_doc.select_end_line_index, text_doc.select_end_character)
+    lines = selection.split("\n")
+    _chunked_rewrite = ChunkedRewrite(
+        text_doc.name, prefix, min(cursor, select_end), lines, chunk_spans(lines, chunk_tokens)
+    )
+    rewrite_next_chunk(_chunked_rewrite)
+    return _chunked_rewrite
+
+
+def rewrite_next_chunk(rewrite):
+    """Start the next chunk of a chunked rewrite, skipping chunks that are only blank lines"""
+    global _chunked_rewrite
+    text_doc = bpy.data.texts.get(rewrite.text_name)
+    while text_doc is not None and rewrite.done < len(rewrite.chunks):
+        count, blank, chunk_hash = rewrite.chunks[rewrite.done]
+        if count:
+            break
+        rewrite.position = (rewrite.position[0] + blank, 0)
+        rewrite.done += 1
+    if text_doc is None or rewrite.done == len(rewrite.chunks):
+        if rewrite.done == len(rewrite.chunks):
+            print(f"Chunked rewrite finished, {rewrite.done} chunks")
+            bpy.ops.renderreminder.gpt_play_notification()
+        _chunked_rewrite = None
+        return
+
+    span = rewrite.body_span(text_doc.as_string().split("\n"))
+    if span is None:
+        print(f"Chunk {rewrite.done + 1} was edited, the rewrite stopped")
+        _chunked_rewrite = None
+        return
+    start, end, body = span
+    addon_prefs = bpy.context.preferences.addons[__name__].preferences
+    previous = tail_text(rewrite.previous, addon_prefs.chunk_overlap)
+    request = selection_request(chunk_prompt(rewrite.prefix, body, previous))
+    item = start_generation(
+        request,
+        text_doc,
+        lambda job: finish_chunk_rewrite(rewrite, job),
+        span=(start, end),
+        label=f"Chunk {rewrite.done + 1} / {len(rewrite.chunks)}",
+        on_cancel=stop_chunked_rewrite,
+    )
+    if item is None:
+        print(f"Chunk {rewrite.done + 1} is already queued, the rewrite stopped")
+        _chunked_rewrite = None
+        return
+    rewrite.queued = item.payload
+
+
+def stop_chunked_rewrite():
+    global _chunked_rewrite
+    _chunked_rewrite = None
+
+
+def finish_chunk_rewrite(rewrite, job):
+    global _chunked_rewrite
+    if job.cancelled or job.error is not None:
+        print(f"Chunked rewrite stopped at chunk {rewrite.done + 1}: {job.error or 'cancelled'}")
+        _chunked_rewrite = None
+        return
+    queued = rewrite.queued
+    if queued.result == "PENDING":
+        # The chunk was not written, the positions of the following chunks are unknown until it is accepted
+        print(f"Chunk {rewrite.done + 1} waits in the panel, the rewrite stopped")
+        _chunked_rewrite = None
+        return
+    count, blank, chunk_hash = rewrite.chunks[rewrite.done]
+    start, end = queued.span
+    # Streamed output replaced the span as it arrived, buffered output only when it was committed
+    if queued.result == "COMMITTED" or (queued.output_mode == "STREAM" and job.output):
+        end = text_end(start, job.output)
+    rewrite.position = (end[0] + blank + 1, 0)
+    rewrite.previous = job.output
+    rewrite.done += 1
+    print(f"Chunk {rewrite.done}/{len(rewrite.chunks)} done in {time.perf_counter() - job.started:.1f} s")
+    rewrite_next_chunk(rewrite)
+
+
+def find_scene(structure, scene_hash):
+    """Return the line span of the scene whose text has scene_hash, or None"""
+    lines = structure.lines
+    for start, end in structure.scene_spans():
+        if text_hash("\n".join(lines[start:end])) == scene_hash:
+            return start, end
+    return None
+
+
+def splice_scene(text_doc, lines, span, output):
+    """Replace a scene with its rewrite, keeping the blank lines that separate it from the next scene"""
+    start, end = span
+    scene_lines = lines[start:end]
+    blank = 0
+    while blank < len(scene_lines) - 1 and not scene_lines[-1 - blank].strip():
+        blank += 1
+    new_text = output.strip("\n") + "\n" * blank
+    commit_output(text_doc, (start, 0), (end - 1, len(lines[end - 1])), new_text, "GPT4All: " + lines[start].strip())
+
+
+def rewrite_next_scene(scene_name):
+    """Start rewriting the first pending scene of the batch, or end the batch when none are left"""
+    scene = bpy.data.scenes.get(scene_name)
+    if scene is None:
+        return
+    gpt = scene.gpt
+    text_doc = bpy.data.texts.get(gpt.batch_text)
+    pending = next((item for item in gpt.batch_scenes if item.status == "PENDING"), None)
+    if text_doc is None or pending is None or not gpt.batch_running:
+        gpt.batch_running = False
+        if pending is None:
+            print(f"Batch rewrite finished in {sum(item.seconds for item in gpt.batch_scenes):.1f} s")
+            bpy.ops.renderreminder.gpt_play_notification()
+        return
+
+    structure = fountain_index(text_doc)
+    lines = structure.lines
+    span = find_scene(structure, pending.scene_hash)
+    if span is None:
+        pending.status = "SKIPPED"
+        return rewrite_next_scene(scene_name)
+
+    pending.status = "RUNNING"
+    scene_text = "\n".join(lines[span[0] : span[1]])
+    index = list(gpt.batch_scenes).index(pending)
+    request = selection_request(selection_prompt(gpt.chat_gpt_select_prefix, scene_text))
+    item = start_generation(
+        request,
+        None,
+        lambda job: finish_scene_rewrite(scene_name, index, job),
+        priority=PRIORITY_BULK,
+        label=pending.heading[:40],
+        on_cancel=lambda: stop_batch_rewrite(scene_name, index),
+    )
+    if item is None:
+        # The same scene text is already queued, it is rewritten only once
+        pending.status = "SKIPPED"
+        print(f"Scene {index + 1}/{len(gpt.batch_scenes)} {pending.heading}: skipped, already queued")
+        return rewrite_next_scene(scene_name)
+
+
+def stop_batch_rewrite(scene_name, index):
+    """Put a scene whose queued rewrite was cancelled back to pending and pause the batch"""
+    scene = bpy.data.scenes.get(scene_name)
+    if scene is not None:
+        scene.gpt.batch_scenes[index].status = "PENDING"
+        scene.gpt.batch_running = False
+
+
+def finish_scene_rewrite(scene_name, index, job):
+    scene = bpy.data.scenes.get(scene_name)
+    if scene is None:
+        return
+    gpt = scene.gpt
+    item = gpt.batch_scenes[index]
+    item.seconds = time.perf_counter() - job.started
+    text_doc = bpy.data.texts.get(gpt.batch_text)
+    if job.cancelled:
+        item.status = "PENDING"
+        gpt.batch_running = False
+        print("Batch rewrite cancelled, " + str(index) + " scenes done")
+        return
+    if job.error is not None or text_doc is None:
+        item.status = "FAILED"
+        print(f"Scene {index + 1} failed: {job.error}")
+    else:
+        structure = fountain_index(text_doc)
+        lines = structure.lines
+        span = find_scene(structure, item.scene_hash)
+        if span is None:
+            item.status = "SKIPPED"
+        else:
+            splice_scene(text_doc, lines, span, job.output)
+            item.status = "DONE"
+    print(f"Scene {index + 1}/{len(gpt.batch_scenes)} {item.heading}: {item.status.lower()} in {item.seconds:.1f} s")
+    rewrite_next_scene(scene_name)
+
+
+class GPT_OT_BatchRewrite(Operator):
+    bl_label = "Rewrite Scenes"
+    bl_idname = "gpt.batch_rewrite"
+    bl_description = "Rewrite every scene of the text with the rewrite prompt, one scene at a time"
+
+    resume: BoolProperty(
+        name="Resume",
+        description="Continue a cancelled batch instead of starting a new one",
+        default=False,
+    )
+
+    @classmethod
+    def poll(cls, context):
+        gpt = context.scene.gpt
+        return (
+            context.space_data.text is not None
+            and gpt.chat_gpt_select_prefix != ""
+            and not gpt.batch_running
+            and local_model_free(context)
+        )
+
+    def execute(self, context):
+        gpt = context.scene.gpt
+        text_doc = context.space_data.text
+        if not ready_to_generate(self):
+            return {"CANCELLED"}
+
+        if not (self.resume and gpt.batch_text == text_doc.name):
+            structure = fountain_index(text_doc)
+            lines = structure.lines
+            gpt.batch_scenes.clear()
+            for start, end in structure.scene_spans():
+                item = gpt.batch_scenes.add()
+                item.heading = lines[start].strip()
+                item.scene_hash = text_hash("\n".join(lines[start:end]))
+            gpt.batch_text = text_doc.name
+        if len(gpt.batch_scenes) == 0:
+            self.report({"WARNING"}, "No scene headings found")
+            return {"CANCELLED"}
+
+        gpt.batch_running = True
+        rewrite_next_scene(context.scene.name)
+        return {"FINISHED"}
+
+
+class GPT_OT_CancelGeneration(Operator):
+    bl_idname = "gpt.cancel_generation"
+    bl_label = "Cancel Generation"
+    bl_description = "Stop the running generation"
+
+    @classmethod
+    def poll(cls, context):
+        return is_generating()
+
+    def execute(self, context):
+        cancel_generation()
+        return {"FINISHED"}
+
+
+class GPT_OT_CancelQueuedRequest(Operator):
+    bl_idname = "gpt.cancel_queued_request"
+    bl_label = "Cancel Queued Request"
+    bl_description = "Remove this request from the queue"
+
+    item_id: bpy.props.IntProperty()
+
+    def execute(self, context):
+        cancel_queued(self.item_id)
+        return {"FINISHED"}
+
+
+class GPT_OT_AcceptOutput(Operator):
+    bl_idname = "gpt.accept_output"
+    bl_label = "Accept Output"
+    bl_description = "Write the changed lines of this output into its Text, as one undo step"
+
+    index: IntProperty()
+
+    def execute(self, context):
+        if not 0 <= self.index < len(pending_outputs):
+            return {"CANCELLED"}
+        pending = pending_outputs[self.index]
+        text_doc = bpy.data.texts.get(pending.text_name)
+        if text_doc is None:
+            self.report({"WARNING"}, "The Text of this output was removed")
+            return {"CANCELLED"}
+        start, end = pending.span
+        if text_range(text_doc, start, end) != pending.original:
+            self.report({"WARNING"}, "The text was edited since the output was generated, reject it or undo the edit")
+            return {"CANCELLED"}
+        pending_outputs.pop(self.index)
+        commit_output(text_doc, start, end, pending.output, "GPT4All: " + pending.label)
+        redraw_text_editors()
+        return {"FINISHED"}
+
+
+class GPT_OT_RejectOutput(Operator):
+    bl_idname = "gpt.reject_output"
+    bl_label = "Reject Output"
+    bl_description = "Discard this output, leaving its Text unchanged"
+
+    index: IntProperty()
+
+    def execute(self, context):
+        if 0 <= self.index < len(pending_outputs):
+            pending_outputs.pop(self.index)
+        return {"FINISHED"}
+
+
 class GPT_OT_RemoveChatHistoryItem(Operator):
     bl_idname = "gpt.remove_chat_history_item"
     bl_label = "Remove Chat History Item"
     bl_description = "Remove this chat history item"
 
     index: bpy.props.IntProperty()
+    # Id of the entry in the external history store, -1 for scene history items
+    entry_id: bpy.props.IntProperty(default=-1)
 
     def execute(self, context):
         gpt = context.scene.gpt
-        if 0 <= self.index < len(gpt.chat_history):
+        if self.entry_id >= 0:
+            get_history_store().remove(self.entry_id)
+        elif 0 <= self.index < len(gpt.chat_history):
             gpt.chat_history.remove(self.index)
+        else:
+            return {"FINISHED"}
+        gpt.history_revision += 1
+        invalidate_history_cache()
         return {"FINISHED"}
 
 
@@ -598,16 +2720,60 @@ class GPT_OT_CopyChatHistoryItem(Operator):
     bl_description = "Copy this chat history item to clipboard"
 
     index: bpy.props.IntProperty()
+    # Id of the entry in the external history store, -1 for scene history items
+    entry_id: bpy.props.IntProperty(default=-1)
 
     def execute(self, context):
         gpt = context.scene.gpt
-        if 0 <= self.index < len(gpt.chat_history):
+        if self.entry_id >= 0:
+            item = get_history_store().get(self.entry_id)
+            if item is not None:
+                context.window_manager.clipboard = f"Input:\n{item['input']}\n\nOutput:\n{item['output']}"
+        elif 0 <= self.index < len(gpt.chat_history):
             item = gpt.chat_history[self.index]
             text = f"Input:\n{item.input}\n\nOutput:\n{item.output}"
             context.window_manager.clipboard = text
         return {"FINISHED"}
 
 
+class GPT_OT_ExpandHistoryEntry(Operator):
+    bl_idname = "gpt.expand_history_entry"
+    bl_label = "Show More"
+    bl_description = "Show or hide the full output of this chat history item"
+
+    entry_id: bpy.props.IntProperty()
+
+    def execute(self, context):
+        gpt = context.scene.gpt
+        gpt.history_expanded = -1 if gpt.history_expanded == self.entry_id else self.entry_id
+        gpt.history_output_page = 0
+        return {"FINISHED"}
+
+
+class GPT_OT_MoveHistoryToStore(Operator):
+    bl_idname = "gpt.move_history_to_store"
+    bl_label = "Move History to Store"
+    bl_description = "Move the chat history of the current scene out of the .blend file into the external store"
+
+    @classmethod
+    def poll(cls, context):
+        return len(context.scene.gpt.chat_history) > 0
+
+    def execute(self, context):
+        gpt = context.scene.gpt
+        if not gpt.history_session:
+            gpt.history_session = uuid.uuid4().hex
+        addon_prefs = context.preferences.addons[__name__].preferences
+        store = get_history_store()
+        for item in gpt.chat_history:
+            store.append(gpt.history_session, addon_prefs.model_select, item.input, item.output, item.metrics)
+        count = len(gpt.chat_history)
+        gpt.chat_history.clear()
+        invalidate_history_cache()
+        self.report({"INFO"}, f"Moved {count} history items")
+        return {"FINISHED"}
+
+
 class GPT_PT_MainPanel(Panel):
     bl_label = "GPT4ALL"
     bl_idname = "GPT_PT_main_panel"
@@ -616,12 +2782,47 @@ class GPT_PT_MainPanel(Panel):
     bl_category = "GPT4ALL"
 
     def draw(self, context):
+        global _panel_prewarmed
         layout = self.layout
         gpt = context.scene.gpt
+        if not _panel_prewarmed:
+            _panel_prewarmed = True
+            prewarm_model("PANEL")
 
         layout = self.layout
         layout = layout.box()
         layout = layout.column(align=True)
+        if prewarmer.running:
+            text = "Loading model..." if prewarmer.status == "LOADING" else "Warming up model..."
+            layout.label(text=text, icon="SORTTIME")
+        elif prewarmer.status == "FAILED":
+            layout.label(text="Pre-warm failed: " + str(prewarmer.error), icon="ERROR")
+        if is_generating():
+            row = layout.row(align=True)
+            row.label(text="Generating...", icon="SORTTIME")
+            row.operator("gpt.cancel_generation", text="Cancel", icon="CANCEL")
+            if _chunked_rewrite is not None:
+                layout.label(text=f"Chunk {_chunked_rewrite.done + 1} / {len(_chunked_rewrite.chunks)}")
+            scratch = bpy.data.texts.get(SCRATCH_TEXT)
+            if scratch is not None and any(queued.output_mode != "STREAM" for job, sink, queued in _generation_jobs):
+                box = layout.box().column(align=True)
+                for line in scratch.as_string()[-1000:].split("\n")[-4:]:
+                    box.label(text=line)
+        for i, pending in enumerate(pending_outputs):
+            box = layout.box().column(align=True)
+            row = box.row(align=True)
+            row.label(text=f"{pending.label}  +{pending.added} -{pending.removed}", icon="HIDE_OFF")
+            row.operator("gpt.accept_output", text="", icon="CHECKMARK").index = i
+            row.operator("gpt.reject_output", text="", icon="X").index = i
+            for line in pending.preview:
+                box.label(text=line)
+        if len(request_queue) > 0:
+            layout.label(text="Queued (" + str(len(request_queue)) + ")", icon="PREVIEW_RANGE")
+            for item in request_queue.items():
+                row = layout.row(align=True)
+                icon = "SORTTIME" if item.priority == PRIORITY_INTERACTIVE else "SEQ_STRIP_DUPLICATE"
+                row.label(text=item.label, icon=icon)
+                row.operator("gpt.cancel_queued_request", text="", icon="X").item_id = item.id
         layout.label(text="Write")
         wide = layout
         wide.scale_y = 1.25
@@ -645,70 +2846,214 @@ class GPT_PT_MainPanel(Panel):
         row.scale_y = 1.25
         row.prop(gpt, "chat_gpt_select_prefix", text="")
         row.operator("gpt.send_selection", text="", icon="PLAY")
+        row.operator("gpt.send_candidates", text="", icon="SEQ_STRIP_DUPLICATE")
+        if _candidates is not None:
+            self.draw_candidates(layout)
 
-        if len(gpt.chat_history) > 0:
-            layout = self.layout
-            layout = layout.box()
-            layout = layout.column()
+        row = layout.row(align=True)
+        row.operator("gpt.batch_rewrite", text="Rewrite Scenes", icon="SEQ_STRIP_DUPLICATE").resume = False
+        pending = sum(1 for item in gpt.batch_scenes if item.status == "PENDING")
+        if pending and not gpt.batch_running and gpt.batch_text == getattr(context.space_data.text, "name", None):
+            row.operator("gpt.batch_rewrite", text="Resume", icon="PLAY").resume = True
+        if gpt.batch_running or pending:
+            done = len(gpt.batch_scenes) - pending
+            layout.label(text=f"Scenes: {done} / {len(gpt.batch_scenes)}")
+            shown = [item for item in gpt.batch_scenes if item.status != "PENDING"][-5:]
+            for item in shown:
+                row = layout.row()
+                row.label(text=item.heading, icon=BATCH_STATUS_ICONS[item.status])
+                if item.status != "RUNNING":
+                    row.label(text=f"{item.seconds:.1f} s")
+
+        text_doc = context.space_data.text
+        structure = drawn_fountain_index(text_doc) if text_doc is not None else None
+        if structure is not None and structure.scene_count:
+            row = layout.row(align=True)
+            icon = "TRIA_DOWN" if gpt.show_scenes else "TRIA_RIGHT"
+            row.prop(gpt, "show_scenes", text=f"Scenes ({structure.scene_count})", icon=icon, emboss=False)
+            row.operator("gpt.rewrite_current_scene", text="", icon="PLAY")
+            if gpt.show_scenes:
+                current = structure.scene_at(text_doc.current_line_index)
+                for n in range(structure.scene_count):
+                    row = layout.row(align=True)
+                    row.label(text=structure.heading(n), icon="RIGHTARROW" if n == current else "BLANK1")
+                    row.operator("gpt.send_scene", text="", icon="PLAY").index = n
+                    if n == current:
+                        blocks = len(structure.dialogue_blocks(*structure.scene_span(n)))
+                        names = ", ".join(structure.scene_characters(n)) or "no dialogue"
+                        layout.label(text=f"{names} ({blocks} dialogue blocks)", icon="BLANK1")
+                if structure.characters:
+                    names = ", ".join(name for name, count in structure.characters.most_common(8))
+                    layout.label(text="Characters: " + names, icon="COMMUNITY")
+
+        addon_prefs = context.preferences.addons[__name__].preferences
+        if addon_prefs.use_response_cache:
+            row = self.layout.row()
+            row.prop(gpt, "bypass_cache")
+            if _response_cache is not None:
+                row.label(text=f"Cache: {_response_cache.hits} hits, {_response_cache.misses} misses")
+
+        if uses_history_store(context):
+            self.draw_history_store(context, gpt, addon_prefs)
+        elif len(gpt.chat_history) > 0:
+            layout = self.history_box(addon_prefs)
             recent_history = gpt.chat_history[-3:]
-            layout.separator()
             layout.label(text="Chat History (Last " + str(len(recent_history)) + ")")
 
             for i, item in enumerate(reversed(recent_history)):
-                layout.use_property_split = True
-                box = layout.box()
-                box = box.column(align=True)
-
-                row = box.row(align=True)
-                row.alignment = "RIGHT"
-                copy_op = row.operator("gpt.copy_chat_history_item", text="", icon="COPYDOWN")
-                copy_op.index = len(gpt.chat_history) - len(recent_history) + i
-                op = row.operator("gpt.remove_chat_history_item", text="", icon="TRASH")
-                op.index = len(gpt.chat_history) - len(recent_history) + i
-
+                index = len(gpt.chat_history) - 1 - i
+                box = self.history_entry_box(layout, index=index)
                 box.label(text="Input:")
-                label_multiline(context, item.input, box)
+                label_multiline(context, item.input, box, (item.as_pointer(), "input"))
                 box.label(text="Output:")
-                label_multiline(context, item.output, box)
+                toggle = label_history_text(
+                    context,
+                    item.output,
+                    (item.as_pointer(), "output"),
+                    box,
+                    addon_prefs.history_preview_lines,
+                    item.expanded,
+                    item,
+                    "page",
+                )
+                if toggle is not None:
+                    box.prop(item, "expanded", text=toggle[0], icon=toggle[1], emboss=False)
+                if item.metrics:
+                    box.label(text=format_summary(json.loads(item.metrics)), icon="TIME")
+
+    def draw_candidates(self, layout):
+        """Draw the candidates side by side, with the end of each and buttons to show or pick it"""
+        box = layout.box()
+        row = box.row(align=True)
+        row.label(text=f"Candidates ({len(_candidates.requests)})")
+        row.operator("gpt.show_candidate", text="", icon="TEXT").index = -1
+        row.operator("gpt.discard_candidates", text="", icon="X")
+        row = box.row()
+        for i, request in enumerate(_candidates.requests):
+            column = row.column(align=True)
+            job = _candidates.jobs[i] if i < len(_candidates.jobs) else None
+            if job is None or not job.finished:
+                icon = "SORTTIME"
+            else:
+                icon = "ERROR" if job.cancelled or job.error is not None else "CHECKMARK"
+            column.label(text=f"{i + 1}: {request.sampling.get('temp', 0):.2f}", icon=icon)
+            text_doc = bpy.data.texts.get(CANDIDATE_TEXT.format(i + 1))
+            lines = text_doc.as_string()[-600:].split("\n")[-6:] if text_doc is not None else []
+            for line in lines:
+                column.label(text=line)
+            buttons = column.row(align=True)
+            buttons.operator("gpt.show_candidate", text="", icon="HIDE_OFF").index = i
+            buttons.operator("gpt.pick_candidate", text="Pick", icon="CHECKMARK").index = i
+
+    def history_box(self, addon_prefs):
+        layout = self.layout
+        layout = layout.box()
+        layout = layout.column()
+        layout.separator()
+        averages = metrics_averages.average(addon_prefs.model_select, addon_prefs.device_select)
+        if averages is not None:
+            text = f"Average of {averages['count']}: {averages['tokens_per_second']:.1f} tok/s"
+            if averages["time_to_first_token"] is not None:
+                text += f", first {averages['time_to_first_token']:.2f} s"
+            layout.label(text=text, icon="TIME")
+        if early_stops["count"]:
+            text = f"Stopped early {early_stops['count']} times, up to {early_stops['tokens_saved']} tokens saved"
+            layout.label(text=text, icon="CANCEL")
+        return layout
+
+    def history_entry_box(self, layout, index=0, entry_id=-1):
+        layout.use_property_split = True
+        box = layout.box()
+        box = box.column(align=True)
+
+        row = box.row(align=True)
+        row.alignment = "RIGHT"
+        copy_op = row.operator("gpt.copy_chat_history_item", text="", icon="COPYDOWN")
+        copy_op.index = index
+        copy_op.entry_id = entry_id
+        op = row.operator("gpt.remove_chat_history_item", text="", icon="TRASH")
+        op.index = index
+        op.entry_id = entry_id
+        return box
+
+    def draw_history_store(self, context, gpt, addon_prefs):
+        """Draw one page of the external history, only that page is read from the store"""
+        if not gpt.history_session:
+            return
+        store = get_history_store()
+        model = addon_prefs.model_select if gpt.history_current_model else None
+        total = store.count(gpt.history_session, model)
+        layout = self.history_box(addon_prefs)
+        row = layout.row(align=True)
+        row.label(text="Chat History (" + str(total) + ")")
+        row.prop(gpt, "history_current_model", text="", icon="FILTER")
+        pages = max(1, -(-total // HISTORY_ENTRIES_PER_PAGE))
+        page = min(gpt.history_page, pages - 1)
+        if pages > 1:
+            row = layout.row(align=True)
+            row.prop(gpt, "history_page", text="Page")
+            row.label(text="of " + str(pages))
+
+        for entry in store.page(gpt.history_session, page * HISTORY_ENTRIES_PER_PAGE, HISTORY_ENTRIES_PER_PAGE, model):
+            box = self.history_entry_box(layout, entry_id=entry["id"])
+            box.label(text="Input:")
+            label_multiline(context, entry["input"], box, ("history", entry["id"], "input"))
+            box.label(text="Output:")
+            toggle = label_history_text(
+                context,
+                entry["output"],
+                ("history", entry["id"], "output"),
+                box,
+                addon_prefs.history_preview_lines,
+                gpt.history_expanded == entry["id"],
+                gpt,
+                "history_output_page",
+            )
+            if toggle is not None:
+                op = box.operator("gpt.expand_history_entry", text=toggle[0], icon=toggle[1], emboss=False)
+                op.entry_id = entry["id"]
+            if entry["metrics"]:
+                box.label(text=format_summary(json.loads(entry["metrics"])), icon="TIME")
 
 
 def process_message(message: str) -> str:
     """Process the message to make it more readable"""
-    # message = re.sub(r"[\"#/@<>{}`+=|]", "", message)
-    lines = message.split("\n")
-    processed = []
-    in_code_block = False
-    for line in lines:
-        line = line.rstrip()
-        if line == "```python":
-            in_code_block = True
-        elif in_code_block:
-            if line == "```":
-                in_code_block = False
-            else:
-                processed.append(line)
-        elif line:
-            words = line.split(" ")
-            while len(words) > 0:
-                line = ""
-                while len(words) > 0:
-                    line += words.pop(0) + " "
-                processed.append(line.rstrip())
-        else:
-            processed.append("")
-    return "\n".join(processed)
+    processor = StreamProcessor()
+    return processor.feed(message) + processor.finish()
 
 
+addon_keymaps = []
+
 classes = (
     GPT_OT_sound_notification,
     GPT_OT_SendSelection,
     GPT_PT_MainPanel,
     GPT_OT_SendMessage,
+    GPT_OT_release_models,
+    GPT_OT_clear_response_cache,
+    GPT_OT_download_model,
+    GPT_OT_auto_tune,
+    GPT_OT_cancel_auto_tune,
+    GPT_OT_cancel_download,
     GPT_OT_install_dependencies,
     GPT_OT_uninstall_dependencies,
     ChatHistoryItem,
+    BatchSceneItem,
     GPT_OT_RemoveChatHistoryItem,
     GPT_OT_CopyChatHistoryItem,
+    GPT_OT_ExpandHistoryEntry,
+    GPT_OT_MoveHistoryToStore,
+    GPT_OT_BatchRewrite,
+    GPT_OT_RewriteCurrentScene,
+    GPT_OT_SendScene,
+    GPT_OT_CancelGeneration,
+    GPT_OT_CancelQueuedRequest,
+    GPT_OT_AcceptOutput,
+    GPT_OT_SendCandidates,
+    GPT_OT_PickCandidate,
+    GPT_OT_ShowCandidate,
+    GPT_OT_DiscardCandidates,
+    GPT_OT_RejectOutput,
     GPT4AllAddonProperties,
     GPT4AllAddonPreferences,
 )
@@ -718,9 +3063,55 @@ def register():
     for cls in classes:
         bpy.utils.register_class(cls)
     bpy.types.Scene.gpt = PointerProperty(type=GPT4AllAddonProperties)
+    bpy.app.timers.register(release_idle_models, first_interval=30.0, persistent=True)
+    bpy.app.timers.register(prewarm_on_startup, first_interval=1.0)
+    bpy.app.handlers.load_post.append(prewarm_on_load)
+
+    keyconfig = bpy.context.window_manager.keyconfigs.addon
+    if keyconfig:
+        keymap = keyconfig.keymaps.new(name="Text", space_type="TEXT_EDITOR")
+        keymap_item = keymap.keymap_items.new(GPT_OT_CancelGeneration.bl_idname, "ESC", "PRESS")
+        addon_keymaps.append((keymap, keymap_item))
 
 
 def unregister():
+    for keymap, keymap_item in addon_keymaps:
+        keymap.keymap_items.remove(keymap_item)
+    addon_keymaps.clear()
+
+    cancel_generation()
+    if _model_download is not None:
+        _model_download.cancel()
+    if _auto_tuner is not None:
+        _auto_tuner.cancel()
+    if prewarm_on_load in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(prewarm_on_load)
+    for timer in (prewarm_on_startup, watch_prewarm):
+        if bpy.app.timers.is_registered(timer):
+            bpy.app.timers.unregister(timer)
+    if bpy.app.timers.is_registered(watch_auto_tuner):
+        bpy.app.timers.unregister(watch_auto_tuner)
+    if bpy.app.timers.is_registered(watch_background_tasks):
+        bpy.app.timers.unregister(watch_background_tasks)
+    if bpy.app.timers.is_registered(drain_generation_jobs):
+        bpy.app.timers.unregister(drain_generation_jobs)
+    _generation_jobs.clear()
+    discard_candidates()
+    remove_scratch_text()
+    pending_outputs.clear()
+    request_queue.clear()
+    chat_sessions.clear()
+    close_response_cache()
+    close_history_store()
+    close_server_backend()
+    close_embedder()
+    scene_indexes.clear()
+    fountain_indexes.clear()
+    _index_checks.clear()
+    if bpy.app.timers.is_registered(release_idle_models):
+        bpy.app.timers.unregister(release_idle_models)
+    model_manager.release_all()
+    candidate_pool.release_all()
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
     del bpy.types.Scene.gpt
@@ -0,0 +1,76 @@
+"""
+Model streaming throughput with and without the token coalescer.
+
+Runs outside Blender. The cost of writing to a Text datablock and of redrawing is
+assumed and simulated with busy waits, so the numbers are a model of how much of the
+wall time goes to UI overhead for a given model speed, not a measurement. Measured
+timings come from benchmarks/run.py inside Blender, which times request_answer with
+the fake model at a flush rate of 0 and at the default rate.
+
+    python benchmarks/coalescer.py --tokens 2000 --write-ms 0.2 --redraw-ms 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.streaming import TokenCoalescer  # noqa: E402
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def synthetic_tokens(count, token_seconds):
+    words = ["INT.", "KITCHEN", "-", "NIGHT\n", "She", "turns", "the", "key.\n", "MARA\n", "Not", "again.\n"]
+    for i in range(count):
+        busy_wait(token_seconds)
+        yield words[i % len(words)] + " "
+
+
+def run(tokens, token_seconds, write_seconds, redraw_seconds, max_rate):
+    """Stream tokens into a simulated Text datablock, returns (tokens/s, writes)"""
+    writes = 0
+    coalescer = TokenCoalescer(max_rate) if max_rate is not None else None
+    start = time.perf_counter()
+    for token in synthetic_tokens(tokens, token_seconds):
+        if coalescer is None:
+            chunk = token
+        else:
+            coalescer.push(token)
+            chunk = coalescer.poll()
+        if chunk:
+            busy_wait(write_seconds + redraw_seconds)
+            writes += 1
+    if coalescer is not None and coalescer.flush():
+        busy_wait(write_seconds + redraw_seconds)
+        writes += 1
+    elapsed = time.perf_counter() - start
+    return tokens / elapsed, writes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--model-tps", type=float, default=0, help="simulated model speed, 0 for unlimited")
+    parser.add_argument("--write-ms", type=float, default=0.2, help="cost of one Text.write call")
+    parser.add_argument("--redraw-ms", type=float, default=8.0, help="cost of one redraw")
+    parser.add_argument("--rate", type=float, default=20.0, help="coalescer flushes per second")
+    args = parser.parse_args(argv)
+
+    token_seconds = 1.0 / args.model_tps if args.model_tps else 0.0
+    costs = (args.tokens, token_seconds, args.write_ms / 1000, args.redraw_ms / 1000)
+    per_token, per_token_writes = run(*costs, max_rate=None)
+    coalesced, coalesced_writes = run(*costs, max_rate=args.rate)
+    print(f"Model with {args.write_ms:g} ms per write and {args.redraw_ms:g} ms per redraw:")
+    print(f"per token:  {per_token:8.1f} tokens/s  {per_token_writes} writes")
+    print(f"coalesced:  {coalesced:8.1f} tokens/s  {coalesced_writes} writes ({args.rate:g} Hz)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Stand-in for a model download server, used to check ModelDownload outside Blender.
+
+The server answers range requests like a static file host, including 416 for a range
+that starts at or past the end of the file. Each case prepares a part file, runs a
+download against the server and checks what ends up on disk:
+
+    python benchmarks/fake_downloads.py
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.downloads import ModelDownload  # noqa: E402
+
+
+class FakeFileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.data
+        self.server.ranges.append(self.headers.get("Range"))
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range") or "")
+        start = int(match.group(1)) if match else 0
+        if start >= len(data):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(data)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if match:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+def start_server(data, port=0):
+    """Serve data on a background thread, returns the server, its url is server.url"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeFileHandler)
+    server.daemon_threads = True
+    server.data = data
+    server.ranges = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/model.gguf"
+    threading.Thread(target=server.serve_forever, name="fake download server", daemon=True).start()
+    return server
+
+
+def run_case(server, directory, part, **settings):
+    """Download into a fresh path with part already in the part file, returns the download and the saved bytes"""
+    path = os.path.join(directory, f"case{len(os.listdir(directory))}.gguf")
+    if part is not None:
+        with open(path + ".part", "wb") as file:
+            file.write(part)
+    server.ranges.clear()
+    download = ModelDownload(server.url, path, **settings)
+    download.start()
+    download.wait(30)
+    saved = None
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            saved = file.read()
+    return download, saved, os.path.exists(path + ".part")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=3 * 1024 * 1024 + 17, help="bytes in the served file")
+    args = parser.parse_args(argv)
+
+    data = os.urandom(args.size)
+    md5 = hashlib.md5(data).hexdigest()
+    server = start_server(data)
+    half = data[: len(data) // 2]
+    cases = [
+        ("fresh download", None, {"expected_hash": md5}, "DONE", [None]),
+        ("resume from part file", half, {"expected_hash": md5}, "DONE", [f"bytes={len(half)}-"]),
+        ("416, part file complete", data, {}, "DONE", [f"bytes={len(data)}-"]),
+        ("416, part file too long", data + b"junk", {"expected_hash": md5}, "DONE", [f"bytes={len(data) + 4}-", None]),
+        ("hash mismatch", None, {"expected_hash": "0" * 32}, "FAILED", [None]),
+        ("size mismatch", None, {"expected_size": len(data) + 1}, "FAILED", [None]),
+    ]
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for name, part, settings, status, ranges in cases:
+            download, saved, part_left = run_case(server, directory, part, **settings)
+            ok = download.status == status and server.ranges == ranges and not part_left
+            ok = ok and (saved == data if status == "DONE" else saved is None)
+            failures += not ok
+            detail = f"{download.status}, ranges {server.ranges}, part file {'kept' if part_left else 'removed'}"
+            print(f"{'ok' if ok else 'FAIL':>4}  {name:<26} {detail}" + (f" ({download.error})" if download.error else ""))
+    server.shutdown()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
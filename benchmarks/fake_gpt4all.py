@@ -0,0 +1,78 @@
+"""
+Stand-in for gpt4all.GPT4All that streams synthetic tokens at a controlled rate.
+
+Prompt evaluation is charged per estimated token of text the model has not seen
+yet: a new chat session evaluates its system prompt, and every generate() call
+evaluates its prompt. Like the real bindings, a session keeps what it has
+evaluated until it is closed.
+"""
+
+import time
+from contextlib import contextmanager
+
+WORDS = ["INT.", "KITCHEN", "-", "NIGHT\n\n", "Mara", "turns", "the", "key.\n\n", "MARA\n", "Not", "again.\n\n"]
+
+
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class GPT4All:
+    prompt_seconds = 0.002
+    token_seconds = 0.0
+    loads = 0
+    # perf_counter() times of the last generate() call and of its first token
+    generate_started = None
+    first_token = None
+
+    def __init__(self, model_name, device=None, n_ctx=2048, **settings):
+        GPT4All.loads += 1
+        self.model_name = model_name
+        self.device = device
+        self.n_ctx = n_ctx
+        self.evaluated_tokens = 0
+        self._pending = ""
+        self._in_session = False
+
+    @contextmanager
+    def chat_session(self, system_prompt="", prompt_template=""):
+        self._in_session = True
+        self._pending = system_prompt + prompt_template
+        try:
+            yield self
+        finally:
+            self._in_session = False
+            self._pending = ""
+
+    def _evaluate(self, text):
+        tokens = count_tokens(text)
+        self.evaluated_tokens += tokens
+        busy_wait(tokens * self.prompt_seconds)
+
+    def generate(self, prompt, max_tokens=200, streaming=False, callback=None, **kwargs):
+        def tokens():
+            GPT4All.generate_started = time.perf_counter()
+            GPT4All.first_token = None
+            self._evaluate(self._pending + prompt)
+            self._pending = ""
+            for i in range(max_tokens):
+                busy_wait(self.token_seconds)
+                token = WORDS[i % len(WORDS)] + " "
+                if callback is not None and callback(i, token) is False:
+                    return
+                if GPT4All.first_token is None:
+                    GPT4All.first_token = time.perf_counter()
+                yield token
+
+        if streaming:
+            return tokens()
+        return "".join(tokens())
+
+    def close(self):
+        pass
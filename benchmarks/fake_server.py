@@ -0,0 +1,73 @@
+"""
+Stand-in for an OpenAI-compatible chat completions server that streams synthetic tokens.
+
+Responses use HTTP/1.1 chunked server-sent events, so clients can keep the connection
+alive between requests. The server counts the connections it accepted.
+
+    python benchmarks/fake_server.py --port 4891
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fake_gpt4all import WORDS
+
+
+class FakeCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        if self.path.rstrip("/").split("/")[-1] != "completions":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(body.get("max_tokens", 16)):
+            if self.server.token_seconds:
+                time.sleep(self.server.token_seconds)
+            token = WORDS[i % len(WORDS)] + ("" if WORDS[i % len(WORDS)].endswith("\n") else " ")
+            event = {"choices": [{"index": 0, "delta": {"content": token}}]}
+            self.send_chunk(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n")
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_server(port=0, token_seconds=0.0):
+    """Serve on a background thread, returns the server, its url is server.url"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeCompletionsHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.requests = []
+    server.token_seconds = token_seconds
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, name="fake completions server", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=4891)
+    parser.add_argument("--token-ms", type=float, default=0.0)
+    args = parser.parse_args()
+    server = start_server(args.port, args.token_ms / 1000)
+    print("Serving " + server.url)
+    threading.Event().wait()
@@ -0,0 +1,277 @@
+"""
+Benchmark the add-on's own overhead against a fake GPT4All backend.
+
+The fake model streams synthetic tokens at a controlled rate, so the numbers
+measure the add-on rather than the model. Results are printed as JSON.
+
+Engine benchmarks only:
+
+    python benchmarks/run.py --json bench_output.txt
+
+Including request_answer and panel drawing, from inside Blender:
+
+    blender -b --python benchmarks/run.py -- --json bench_output.txt
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, ADDON_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fake_gpt4all  # noqa: E402
+import fake_server  # noqa: E402
+from engine.backends import OpenAIBackend  # noqa: E402
+from engine.generation import GenerationJob, GenerationRequest, generate_tokens  # noqa: E402
+from engine.prompts import SYSTEM_TEMPLATE, message_prompt  # noqa: E402
+from engine.streaming import StreamProcessor, process_stream  # noqa: E402
+
+import coalescer  # noqa: E402
+import session  # noqa: E402
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+sys.modules["gpt4all"] = fake_gpt4all
+
+
+def timed(function, repeat=1):
+    """Return the fastest of repeat runs of function in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_streaming(tokens):
+    """Time to first token and tokens/s through a worker thread job, as the operators use it"""
+    model = fake_gpt4all.GPT4All("fake.gguf")
+    request = GenerationRequest(
+        "fake.gguf", "cpu", message_prompt("Write", "a scene"), system_template=SYSTEM_TEMPLATE, max_tokens=tokens
+    )
+    job = GenerationJob(request, lambda request, cancel: process_stream(generate_tokens(model, request, cancel)))
+    start = time.perf_counter()
+    job.start()
+    received = 0
+    first = None
+    while not job.finished:
+        chunk = job.drain()
+        if chunk and first is None:
+            first = time.perf_counter() - start
+        received += len(chunk)
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    return {
+        "tokens": tokens,
+        "chunks": received,
+        "time_to_first_token": first,
+        "seconds": elapsed,
+        "tokens_per_second": tokens / elapsed,
+    }
+
+
+def bench_server(tokens, requests=5):
+    """Time to first token and tokens/s from the fake completions server, over one kept-alive connection"""
+    server = fake_server.start_server(token_seconds=fake_gpt4all.GPT4All.token_seconds)
+    backend = OpenAIBackend(server.url)
+    runs = []
+    for _ in range(requests):
+        request = GenerationRequest("fake.gguf", "cpu", message_prompt("Write", "a scene"), max_tokens=tokens)
+        job = GenerationJob(request, lambda request, cancel: process_stream(backend.generate(request, cancel)))
+        start = time.perf_counter()
+        job.start()
+        job.wait()
+        runs.append({"time_to_first_token": job.time_to_first_token, "seconds": time.perf_counter() - start})
+    backend.close()
+    server.shutdown()
+    return {
+        "tokens": tokens,
+        "requests": requests,
+        "connections": server.connections,
+        "first_time_to_first_token": runs[0]["time_to_first_token"],
+        "kept_alive_time_to_first_token": min(run["time_to_first_token"] for run in runs[1:]),
+        "tokens_per_second": tokens / min(run["seconds"] for run in runs),
+    }
+
+
+def screenplay(size):
+    page = "INT. KITCHEN - NIGHT\n\nMara turns the key.   \n\nMARA\nNot again.\n\n```python\nprint(1)\n```\n\n"
+    return page * (size // len(page) + 1)
+
+
+def bench_process_message(sizes):
+    results = []
+    for size in sizes:
+        message = screenplay(size)
+
+        def run():
+            processor = StreamProcessor()
+            processor.feed(message)
+            processor.finish()
+
+        seconds = timed(run, repeat=3)
+        results.append({"bytes": len(message), "seconds": seconds, "mb_per_second": len(message) / seconds / 1e6})
+    return results
+
+
+class FakeLayout:
+    """Stands in for bpy.types.UILayout and counts the widgets drawn"""
+
+    def __init__(self, counter=None):
+        self.counter = counter if counter is not None else {"widgets": 0}
+
+    def _widget(self, *args, **kwargs):
+        self.counter["widgets"] += 1
+        return SimpleNamespace()
+
+    label = prop = operator = separator = _widget
+
+    def _sublayout(self, *args, **kwargs):
+        return FakeLayout(self.counter)
+
+    box = column = row = split = _sublayout
+
+
+def bench_addon(addon, history_sizes, tokens, flush_rates=(0.0, 20.0)):
+    """
+    Benchmarks that need bpy: request_answer and drawing the panel.
+
+    request_answer writes into a real Text once per token with a flush rate of 0, and
+    at most flush_rate times per second otherwise.
+    """
+    addon_prefs = bpy.context.preferences.addons[addon.__name__].preferences
+    # The fake backend does not read the model file, it only has to exist
+    models = tempfile.mkdtemp()
+    open(os.path.join(models, addon_prefs.model_select), "wb").close()
+    addon_prefs.models_directory = models
+    scene = bpy.context.scene
+    text_doc = bpy.data.texts.new("Benchmark")
+    addon_prefs.tokens = tokens
+    # Each run has to generate, not answer from the response cache
+    scene.gpt.bypass_cache = True
+
+    results = {"request_answer": [], "panel_draw": []}
+    for flush_rate in flush_rates:
+        addon_prefs.flush_rate = flush_rate
+        text_doc.clear()
+        start = time.perf_counter()
+        addon.request_answer(message_prompt("Write", "a scene"), text_doc)
+        elapsed = time.perf_counter() - start
+        results["request_answer"].append(
+            {
+                "flush_rate": flush_rate,
+                "tokens": tokens,
+                "time_to_first_token": fake_gpt4all.GPT4All.first_token - start,
+                "seconds": elapsed,
+                "tokens_per_second": tokens / elapsed,
+            }
+        )
+
+    output = screenplay(2000)
+    context = SimpleNamespace(
+        scene=scene,
+        preferences=bpy.context.preferences,
+        region=SimpleNamespace(width=300),
+        space_data=SimpleNamespace(text=text_doc),
+    )
+    for size in history_sizes:
+        scene.gpt.chat_history.clear()
+        for i in range(size):
+            item = scene.gpt.chat_history.add()
+            item.input = f"Prompt {i}"
+            item.output = output
+        addon.invalidate_history_cache()
+        panel = SimpleNamespace(layout=FakeLayout())
+        cold = timed(lambda: addon.GPT_PT_MainPanel.draw(panel, context))
+        warm = timed(lambda: addon.GPT_PT_MainPanel.draw(panel, context), repeat=20)
+        results["panel_draw"].append({"history": size, "cold_ms": cold * 1000, "warm_ms": warm * 1000})
+
+        label = timed(lambda: addon.label_multiline(context, output, FakeLayout()), repeat=20)
+        results["panel_draw"][-1]["label_multiline_ms"] = label * 1000
+    bpy.data.texts.remove(text_doc)
+    return results
+
+
+def enable_addon():
+    import addon_utils
+
+    sys.path.insert(0, os.path.dirname(ADDON_DIR))
+    name = os.path.basename(ADDON_DIR)
+    addon_utils.enable(name, default_set=True)
+    return sys.modules[name]
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--token-ms", type=float, default=0.0, help="simulated generation cost per token")
+    parser.add_argument("--prompt-ms", type=float, default=0.5, help="simulated prompt evaluation cost per token")
+    parser.add_argument("--history", default="0,3,30,300", help="history sizes for the panel benchmark")
+    parser.add_argument("--json", help="write the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    fake_gpt4all.GPT4All.token_seconds = args.token_ms / 1000
+    fake_gpt4all.GPT4All.prompt_seconds = args.prompt_ms / 1000
+
+    # Keep the add-on's console output out of the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmarks(args)
+
+    report = json.dumps(results, indent=2)
+    if args.json:
+        with open(args.json, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+
+
+def run_benchmarks(args):
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "blender": bpy.app.version_string if bpy else None,
+            "token_ms": args.token_ms,
+            "prompt_ms": args.prompt_ms,
+        },
+        "streaming": bench_streaming(args.tokens),
+        "server": bench_server(args.tokens),
+        "process_message": bench_process_message([10_000, 100_000, 1_000_000]),
+    }
+    # Write and redraw costs are assumed, the measured numbers are request_answer's, from inside Blender
+    per_token, _ = coalescer.run(args.tokens, args.token_ms / 1000, 0.0002, 0.008, None)
+    coalesced, _ = coalescer.run(args.tokens, args.token_ms / 1000, 0.0002, 0.008, 20.0)
+    results["coalescer_model"] = {
+        "write_ms": 0.2,
+        "redraw_ms": 8.0,
+        "per_token_tokens_per_second": per_token,
+        "coalesced_tokens_per_second": coalesced,
+    }
+    results["session_time_to_first_token"] = {
+        "fresh": session.run(3, False, 50),
+        "kept": session.run(3, True, 50),
+    }
+    if bpy is not None:
+        history_sizes = [int(size) for size in args.history.split(",")]
+        results.update(bench_addon(enable_addon(), history_sizes, args.tokens))
+    return results
+
+
+if __name__ == "__main__":
+    main()
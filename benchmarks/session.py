@@ -0,0 +1,66 @@
+"""
+Compare time to first token with and without a persistent chat session.
+
+Runs outside Blender against the fake GPT4All backend:
+
+    python benchmarks/session.py --prompts 5 --prompt-ms 2
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.generation import ChatSessions, GenerationRequest, generate_tokens  # noqa: E402
+from engine.prompts import SYSTEM_TEMPLATE, collect_history, message_prompt  # noqa: E402
+
+from fake_gpt4all import GPT4All  # noqa: E402
+
+
+def run(prompts, persistent, max_tokens):
+    """Send consecutive chat messages, returns the time to first token of each"""
+    model = GPT4All("fake.gguf")
+    sessions = ChatSessions()
+    history = []
+    timings = []
+    for turn in range(prompts):
+        request = GenerationRequest(
+            "fake.gguf",
+            "cpu",
+            message_prompt("Continue the scene", "Mara hides the key"),
+            system_template=SYSTEM_TEMPLATE,
+            history=collect_history(history[-1:]),
+            max_tokens=max_tokens,
+            conversation=("Scene", SYSTEM_TEMPLATE, 0) if persistent else None,
+            turn=turn,
+        )
+        start = time.perf_counter()
+        first = None
+        output = ""
+        for token in generate_tokens(model, request, threading.Event(), sessions):
+            if first is None:
+                first = time.perf_counter() - start
+            output += token
+        history.append(output)
+        timings.append(first)
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompts", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=200, help="tokens generated per prompt")
+    parser.add_argument("--prompt-ms", type=float, default=2.0, help="simulated prompt evaluation cost per token")
+    args = parser.parse_args(argv)
+
+    GPT4All.prompt_seconds = args.prompt_ms / 1000
+    for label, persistent in (("fresh session", False), ("kept session", True)):
+        timings = run(args.prompts, persistent, args.tokens)
+        print(f"{label:14} time to first token: " + "  ".join(f"{t * 1000:6.1f} ms" for t in timings))
+
+
+if __name__ == "__main__":
+    main()
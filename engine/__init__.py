@@ -0,0 +1,6 @@
+"""
+Blender independent parts of GPT4Blender.
+
+Nothing in this package may import bpy, so it can be used from worker threads,
+benchmarks and headless scripts as well as from the add-on itself.
+"""
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+from .chunking import tail_text
+from .fountain import text_hash
+from .metrics import estimate_tokens
+from .prompts import HISTORY_SEPARATOR
+
+
+def model_tokenizer(model):
+    """
+    The tokenize function of a loaded model, or None when its bindings do not expose one.
+
+    The gpt4all Python bindings expose none so far, local counts are then estimates like the server's.
+    """
+    for owner in (model, getattr(model, "model", None)):
+        tokenize = getattr(owner, "tokenize", None)
+        if callable(tokenize):
+            return tokenize
+    return None
+
+
+class TokenCounter:
+    """
+    Count tokens with a model's tokenizer, or estimate them without one.
+
+    Counts are memoized by content hash, so a static system template is only tokenized once.
+    exact tells whether counts come from a tokenizer.
+    """
+
+    def __init__(self, tokenize=None, cache_size=256):
+        self.tokenize = tokenize
+        self.cache_size = cache_size
+        self.hits = 0
+        self._counts = OrderedDict()
+
+    @property
+    def exact(self):
+        return self.tokenize is not None
+
+    def count(self, text):
+        if not text:
+            return 0
+        key = text_hash(text)
+        count = self._counts.get(key)
+        if count is not None:
+            self.hits += 1
+            self._counts.move_to_end(key)
+            return count
+        count = len(self.tokenize(text)) if self.tokenize is not None else estimate_tokens(text)
+        self._counts[key] = count
+        if len(self._counts) > self.cache_size:
+            self._counts.popitem(last=False)
+        return count
+
+
+def fit_history(counter, outputs, budget):
+    """
+    Join the newest outputs that fit in budget tokens with a blank line between them.
+
+    The oldest one kept may be cut to its end.
+    """
+    kept = []
+    used = 0
+    separator = counter.count(HISTORY_SEPARATOR)
+    for output in reversed(outputs):
+        tokens = counter.count(output) + (separator if kept else 0)
+        if used + tokens > budget:
+            tail = tail_text(output, budget - used - (separator if kept else 0), counter.count)
+            if tail:
+                used += counter.count(tail) + (separator if kept else 0)
+                kept.insert(0, tail)
+            break
+        kept.insert(0, output)
+        used += tokens
+    return " " + HISTORY_SEPARATOR.join(kept), used
+
+
+def assemble_request(request, counter, n_ctx):
+    """
+    Fit the parts of a request into the context window of the model.
+
+    History outputs are added newest first within request.history_budget, leaving at
+    least max_tokens or half the context for the output. max_tokens is then lowered
+    to the room that is left after the system template, history and prompt.
+    """
+    system = counter.count(request.system_template)
+    prompt = counter.count(request.prompt)
+    history = 0
+    if request.history_outputs is not None:
+        room = n_ctx - system - prompt - min(request.max_tokens, n_ctx // 2)
+        budget = max(0, min(request.history_budget, room))
+        request.history, history = fit_history(counter, request.history_outputs, budget)
+    request.max_tokens = min(request.max_tokens, max(1, n_ctx - system - history - prompt))
+    request.token_counts = {"system": system, "history": history, "prompt": prompt}
+    counted = "tokens" if counter.exact else "tokens, estimated"
+    print(
+        f"Prompt: {system + history + prompt} {counted} (system {system}, history {history}, prompt {prompt}), "
+        f"{request.max_tokens} reserved for output of {n_ctx}"
+    )
+    return request.token_counts
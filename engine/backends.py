@@ -0,0 +1,216 @@
+import http.client
+import json
+import queue
+import socket
+import time
+from urllib.parse import urlsplit
+
+from .assembly import TokenCounter, assemble_request, model_tokenizer
+from .generation import generate_tokens, prompt_tokens
+
+
+class LocalBackend:
+    """Generate with an in-process GPT4All model, kept resident by a ModelManager"""
+
+    def __init__(self, manager, sessions=None, lock=None):
+        self.manager = manager
+        self.sessions = sessions
+        self.lock = lock
+        self._counters = {}
+
+    def counter(self, model_name, model):
+        """The token counter of a model, its memoized counts outlive reloads of the model"""
+        counter = self._counters.get(model_name)
+        if counter is None:
+            counter = self._counters[model_name] = TokenCounter()
+        counter.tokenize = model_tokenizer(model)
+        return counter
+
+    def generate(self, request, cancel_event=None):
+        """Yield the raw tokens of the answer to request"""
+        metrics = request.metrics
+        start = time.perf_counter()
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            with self.manager.use(request.model_name, request.device, **request.model_settings) as model:
+                metrics.model_load = time.perf_counter() - start
+                n_ctx = request.model_settings.get("n_ctx", 2048)
+                assemble_request(request, self.counter(request.model_name, model), n_ctx)
+                yield from generate_tokens(model, request, cancel_event, self.sessions)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def close(self):
+        pass
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections to one server, reused across requests.
+
+    A connection is only returned to the pool after its response was read to the end.
+    """
+
+    def __init__(self, url, size=2, connect_timeout=5.0, read_timeout=120.0):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.created = 0
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def get(self):
+        """An idle pooled connection, which the server may have closed meanwhile, or a new one"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.new()
+
+    def new(self):
+        connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        connection = connection_class(self.host, self.port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        # Requests are small and latency bound, do not hold them back waiting for acknowledgements
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.created += 1
+        return connection
+
+    def put(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def chat_messages(request):
+    messages = []
+    if request.system_template:
+        messages.append({"role": "system", "content": request.system_template})
+    if request.history.strip():
+        messages.append({"role": "assistant", "content": request.history.strip()})
+    messages.append({"role": "user", "content": request.prompt})
+    return messages
+
+
+def server_sampling(sampling, extended=False):
+    """
+    Map GPT4All sampling settings to OpenAI request fields.
+
+    top_k and repeat_penalty are llama.cpp extensions that strict servers reject, they are only sent when extended.
+    """
+    names = {"temp": "temperature", "top_p": "top_p"}
+    if extended:
+        names.update(top_k="top_k", repeat_penalty="repeat_penalty")
+    return {names[key]: value for key, value in sampling.items() if key in names}
+
+
+def sse_events(response):
+    """Yield the data of each server-sent event in a streamed response, until [DONE]"""
+    while True:
+        line = response.readline()
+        if not line:
+            return
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            return
+        yield json.loads(data)
+
+
+class ServerError(Exception):
+    pass
+
+
+class OpenAIBackend:
+    """
+    Generate with an OpenAI-compatible chat completions server, streaming tokens over server-sent events.
+
+    Connections are kept alive and reused, a cancelled stream closes its connection.
+    """
+
+    def __init__(self, url, api_key="", connect_timeout=5.0, read_timeout=120.0, pool_size=2, extended_sampling=False):
+        self.url = url
+        self.api_key = api_key
+        self.extended_sampling = extended_sampling
+        self.pool = ConnectionPool(url, pool_size, connect_timeout, read_timeout)
+        # The server's tokenizer is not reachable, prompts are sized with estimates
+        self.counter = TokenCounter()
+
+    def body(self, request):
+        body = {
+            "model": request.model_name,
+            "messages": chat_messages(request),
+            "max_tokens": request.max_tokens,
+            "stream": True,
+        }
+        body.update(server_sampling(request.sampling, self.extended_sampling))
+        if request.seed is not None:
+            body["seed"] = request.seed
+        return json.dumps(body).encode("utf-8")
+
+    def generate(self, request, cancel_event=None):
+        """Yield the tokens of the answer to request as the server streams them"""
+        metrics = request.metrics
+        assemble_request(request, self.counter, request.model_settings.get("n_ctx", 2048))
+        metrics.prompt_tokens = prompt_tokens(request)
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        if self.api_key:
+            headers["Authorization"] = "Bearer " + self.api_key
+
+        start = time.perf_counter()
+        connection = self.pool.get()
+        reusable = False
+        try:
+            try:
+                connection.request("POST", self.pool.path + "/chat/completions", self.body(request), headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection, the other pooled ones may be closed too
+                connection.close()
+                connection = self.pool.new()
+                connection.request("POST", self.pool.path + "/chat/completions", self.body(request), headers)
+                response = connection.getresponse()
+            metrics.server_wait = time.perf_counter() - start
+            if response.status != 200:
+                detail = response.read()[:500].decode("utf-8", "replace")
+                raise ServerError(f"Server error {response.status}: {detail}")
+
+            first = None
+            for event in sse_events(response):
+                if request.stop_reason is not None or (cancel_event is not None and cancel_event.is_set()):
+                    return
+                choices = event.get("choices") or [{}]
+                token = (choices[0].get("delta") or {}).get("content") or choices[0].get("text") or ""
+                if not token:
+                    continue
+                now = time.perf_counter()
+                if first is None:
+                    first = now
+                metrics.generated_tokens += 1
+                metrics.generation_seconds = now - first
+                yield token
+            response.read()
+            reusable = not response.will_close
+        finally:
+            if reusable:
+                self.pool.put(connection)
+            else:
+                connection.close()
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,206 @@
+import json
+import multiprocessing
+import os
+import struct
+import time
+
+from .chunking import chunk_spans, tail_text
+from .generation import GenerationRequest, generate_tokens
+from .metrics import estimate_tokens
+from .models import load_gpt4all
+from .prompts import chunk_prompt, selection_prompt, selection_system_template
+from .streaming import process_stream
+from .tuning import available_memory, estimate_memory, read_gguf_metadata
+
+FOUNTAIN_EXTENSIONS = (".fountain", ".spmd", ".txt")
+
+
+class BatchOptions:
+    """Settings shared by every worker of a batch run"""
+
+    def __init__(
+        self,
+        model_name,
+        prefix,
+        device="cpu",
+        model_path=None,
+        n_ctx=2048,
+        max_tokens=2000,
+        chunk_overlap=64,
+        sampling=None,
+        n_batch=8,
+        n_threads=None,
+    ):
+        self.model_name = model_name
+        self.prefix = prefix
+        self.device = device
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.max_tokens = max_tokens
+        self.chunk_overlap = chunk_overlap
+        self.sampling = sampling or {}
+        self.n_batch = n_batch
+        self.n_threads = n_threads
+
+    def model_settings(self):
+        return {
+            "n_ctx": self.n_ctx,
+            "n_threads": self.n_threads,
+            "model_path": self.model_path,
+            "allow_download": False,
+        }
+
+    def chunk_tokens(self):
+        """Largest piece of a script, in tokens, rewritten in one prompt"""
+        overhead = estimate_tokens(selection_system_template(self.prefix) + selection_prompt(self.prefix, ""))
+        return max(64, min(self.max_tokens, self.n_ctx // 2) - overhead - self.chunk_overlap)
+
+
+def find_scripts(directory, extensions=FOUNTAIN_EXTENSIONS):
+    """Yield the paths of the scripts in directory, sorted by name"""
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.is_file() and entry.name.lower().endswith(extensions):
+            yield entry.path
+
+
+def rewrite_script(model, text, options):
+    """Rewrite a script chunk by chunk with the selection prompt, returns the text and a timing dict"""
+    lines = text.split("\n")
+    parts = []
+    previous = ""
+    report = {"chunks": 0, "prompt_tokens": 0, "generated_tokens": 0, "generation_seconds": 0.0}
+    for start, end in chunk_spans(lines, options.chunk_tokens()):
+        body = lines[start:end]
+        blank = 0
+        while blank < len(body) and not body[-1 - blank].strip():
+            blank += 1
+        if blank == len(body):
+            parts.append("\n".join(body))
+            continue
+        source = "\n".join(body[: len(body) - blank])
+        request = GenerationRequest(
+            options.model_name,
+            options.device,
+            chunk_prompt(options.prefix, source, tail_text(previous, options.chunk_overlap)),
+            system_template=selection_system_template(options.prefix),
+            max_tokens=options.max_tokens,
+            sampling=options.sampling,
+            n_batch=options.n_batch,
+        )
+        output = "".join(process_stream(generate_tokens(model, request), request.metrics)).strip("\n")
+        parts.append(output + "\n" * blank)
+        previous = output
+        metrics = request.metrics
+        report["chunks"] += 1
+        report["prompt_tokens"] += metrics.prompt_tokens
+        report["generated_tokens"] += metrics.generated_tokens
+        report["generation_seconds"] += metrics.generation_seconds
+    return "\n".join(parts), report
+
+
+def worker_count(options, requested=None, cpu_count=None):
+    """
+    Number of worker processes that fit in the available memory, each holding its own model.
+
+    requested caps the count, by default there is one worker per four CPU cores.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    workers = requested or max(1, cpu_count // 4)
+    path = os.path.join(options.model_path or "", options.model_name)
+    available = available_memory()
+    try:
+        needed = estimate_memory(read_gguf_metadata(path), os.path.getsize(path), options.n_ctx, options.n_batch)
+    except (OSError, ValueError, struct.error):
+        needed = None
+    if needed and available is not None:
+        workers = min(workers, max(1, available // needed))
+    return max(1, min(workers, cpu_count))
+
+
+# The settings of a worker process, and its model once the first script loaded it
+_worker = {}
+
+
+def init_worker(options, loader):
+    """
+    Pool initializer, it must not raise or the pool starts new workers without end.
+
+    The model is loaded by the first script instead, so a load error fails that script.
+    """
+    _worker["options"] = options
+    _worker["loader"] = loader
+    _worker["model"] = None
+    _worker["error"] = None
+
+
+def worker_model():
+    """The model of this worker, loaded on first use. A failed load is not retried for later scripts"""
+    if _worker["error"] is not None:
+        raise RuntimeError("The model could not be loaded: " + _worker["error"])
+    if _worker["model"] is None:
+        options = _worker["options"]
+        try:
+            _worker["model"] = _worker["loader"](options.model_name, options.device, **options.model_settings())
+        except Exception as e:
+            _worker["error"] = str(e)
+            raise
+    return _worker["model"]
+
+
+def process_script(task):
+    """Rewrite one script in a worker process and write the result, returns its report entry"""
+    source, destination = task
+    options = _worker["options"]
+    start = time.perf_counter()
+    entry = {"file": source, "output": destination}
+    try:
+        with open(source, encoding="utf-8") as file:
+            text = file.read()
+        output, report = rewrite_script(worker_model(), text, options)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, "w", encoding="utf-8") as file:
+            file.write(output)
+        entry.update(report)
+        entry["status"] = "DONE"
+    except Exception as e:
+        entry["status"] = "FAILED"
+        entry["error"] = str(e)
+    entry["seconds"] = time.perf_counter() - start
+    entry["worker"] = os.getpid()
+    return entry
+
+
+def run_batch(directory, output_directory, options, workers=None, loader=load_gpt4all, report_path=None):
+    """
+    Rewrite every script in directory into output_directory on a pool of worker processes.
+
+    Scripts are handed out one at a time, so memory does not grow with the number of files.
+    One JSON line per script is appended to report_path as it finishes. Returns the report entries.
+    Raises FileNotFoundError before starting any worker when the model file is missing, scripts
+    of a worker whose model fails to load are reported as FAILED.
+    """
+    if loader is load_gpt4all:
+        path = os.path.join(options.model_path or "", options.model_name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError("Model not found: " + path)
+    workers = worker_count(options, workers)
+    if options.n_threads is None:
+        options.n_threads = max(1, (os.cpu_count() or 1) // workers)
+    report_path = report_path or os.path.join(output_directory, "report.jsonl")
+    os.makedirs(output_directory, exist_ok=True)
+    tasks = ((path, os.path.join(output_directory, os.path.basename(path))) for path in find_scripts(directory))
+    entries = []
+    start = time.perf_counter()
+    print(f"Batch: {workers} workers, model {options.model_name}")
+    context = multiprocessing.get_context("spawn")
+    with open(report_path, "w", encoding="utf-8") as report:
+        with context.Pool(workers, initializer=init_worker, initargs=(options, loader)) as pool:
+            for entry in pool.imap_unordered(process_script, tasks):
+                entries.append(entry)
+                report.write(json.dumps(entry) + "\n")
+                report.flush()
+                print(f"{entry['status'].lower()}: {os.path.basename(entry['file'])} in {entry['seconds']:.1f} s")
+    total = time.perf_counter() - start
+    done = sum(1 for entry in entries if entry["status"] == "DONE")
+    print(f"Batch finished: {done} / {len(entries)} scripts in {total:.1f} s")
+    return entries
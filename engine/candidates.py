@@ -0,0 +1,69 @@
+import copy
+import threading
+
+from .backends import LocalBackend
+from .metrics import RequestMetrics
+from .models import ModelManager, load_gpt4all
+
+# Cores each extra model needs to be worth loading
+CORES_PER_WORKER = 4
+
+
+def candidate_sampling(sampling, count, spread=0.3):
+    """Sampling settings of count candidates, their temperatures spread evenly around the base temperature"""
+    base = sampling.get("temp", 0.7)
+    settings = []
+    for i in range(count):
+        offset = spread * (i / (count - 1) - 0.5) if count > 1 else 0.0
+        settings.append(dict(sampling, temp=round(min(2.0, max(0.05, base + offset)), 2)))
+    return settings
+
+
+def candidate_requests(request, count, seed=None):
+    """Copies of request that only differ in temperature and seed, each with its own metrics"""
+    requests = []
+    for i, sampling in enumerate(candidate_sampling(request.sampling, count)):
+        candidate = copy.copy(request)
+        candidate.sampling = sampling
+        candidate.seed = None if seed is None else seed + i
+        candidate.cache_key = None
+        candidate.token_counts = None
+        candidate.metrics = RequestMetrics(request.model_name, request.device)
+        requests.append(candidate)
+    return requests
+
+
+def candidate_workers(count, model_bytes, available, cpu_count):
+    """
+    How many models can generate candidates at the same time, counting the one already loaded.
+
+    Extra models are only used when both their size and the free memory are known.
+    """
+    workers = min(count, max(1, (cpu_count or 1) // CORES_PER_WORKER))
+    if not model_bytes or available is None:
+        return 1
+    return max(1, min(workers, 1 + available // model_bytes))
+
+
+class CandidatePool:
+    """Extra resident models that generate candidates next to the main one, each behind its own LocalBackend"""
+
+    def __init__(self, loader=load_gpt4all, idle_timeout=600.0):
+        self.loader = loader
+        self.idle_timeout = idle_timeout
+        self._backends = []
+
+    def backends(self, count):
+        while len(self._backends) < count:
+            manager = ModelManager(self.loader, max_models=1, idle_timeout=self.idle_timeout)
+            self._backends.append(LocalBackend(manager, None, threading.Lock()))
+        return self._backends[:count]
+
+    def release_idle(self):
+        for backend in self._backends:
+            backend.manager.idle_timeout = self.idle_timeout
+            backend.manager.release_idle()
+
+    def release_all(self):
+        for backend in self._backends:
+            backend.manager.release_all()
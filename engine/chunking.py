@@ -0,0 +1,53 @@
+from .fountain import is_scene_heading
+from .metrics import estimate_tokens
+
+
+def element_starts(lines):
+    """Indices of the lines that begin a paragraph or a Fountain scene"""
+    return [
+        i for i, line in enumerate(lines) if i == 0 or not lines[i - 1].strip() or is_scene_heading(line)
+    ]
+
+
+def chunk_spans(lines, max_tokens, count_tokens=estimate_tokens):
+    """
+    Split lines into (start, end) line ranges of at most max_tokens each, breaking between paragraphs or scenes.
+
+    An element larger than max_tokens is split between lines, a single line is never split.
+    """
+    starts = element_starts(lines)
+    elements = list(zip(starts, starts[1:] + [len(lines)]))
+    spans = []
+    start = end = 0
+    size = 0
+    for element_start, element_end in elements:
+        element_size = count_tokens("\n".join(lines[element_start:element_end]))
+        if element_size > max_tokens:
+            pieces = [(i, i + 1) for i in range(element_start, element_end)]
+        else:
+            pieces = [(element_start, element_end)]
+        for piece_start, piece_end in pieces:
+            piece_size = element_size if len(pieces) == 1 else count_tokens(lines[piece_start])
+            if end > start and size + piece_size > max_tokens:
+                spans.append((start, end))
+                start, size = end, 0
+            end = piece_end
+            size += piece_size
+    if end > start:
+        spans.append((start, end))
+    return spans
+
+
+def tail_text(text, max_tokens, count_tokens=estimate_tokens):
+    """The last paragraphs of text that fit in max_tokens, or its last characters when one paragraph is too long"""
+    if max_tokens <= 0:
+        return ""
+    paragraphs = text.strip("\n").split("\n\n")
+    kept = []
+    for paragraph in reversed(paragraphs):
+        if count_tokens("\n\n".join([paragraph] + kept)) > max_tokens:
+            break
+        kept.insert(0, paragraph)
+    if not kept:
+        return text[-max_tokens * 4 :]
+    return "\n\n".join(kept)
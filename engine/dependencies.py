@@ -0,0 +1,113 @@
+import importlib
+import importlib.util
+import subprocess
+import threading
+from collections import deque
+
+_installed = {}
+
+
+def is_installed(module, refresh=False):
+    """Check whether a module can be imported without importing it, caching the answer"""
+    if refresh or module not in _installed:
+        try:
+            _installed[module] = importlib.util.find_spec(module) is not None
+        except (ImportError, ValueError):
+            _installed[module] = False
+    return _installed[module]
+
+
+def forget_installed():
+    _installed.clear()
+    importlib.invalidate_caches()
+
+
+def install_commands(python_exe, requirement, wheel_dir=""):
+    """pip commands installing requirement, from wheel_dir only when it is given"""
+    commands = [[python_exe, "-m", "ensurepip"]]
+    install = [python_exe, "-m", "pip", "install", requirement, "--no-warn-script-location", "--upgrade"]
+    if wheel_dir:
+        install += ["--no-index", "--find-links", wheel_dir]
+    else:
+        commands.append([python_exe, "-m", "pip", "install", "--upgrade", "pip"])
+    commands.append(install)
+    return commands
+
+
+def module_dependencies(python_exe, module_name):
+    """
+    Get the list of dependencies for a given module.
+    """
+    result = subprocess.run([python_exe, "-m", "pip", "show", module_name], capture_output=True, text=True)
+    for line in result.stdout.strip().split("\n"):
+        if line.startswith("Requires:"):
+            return [name.strip() for name in line.split(":", 1)[1].split(",") if name.strip()]
+    return []
+
+
+def uninstall_commands(python_exe, module_name):
+    """pip commands uninstalling a module and its dependencies, apart from numpy which Blender needs"""
+    commands = [[python_exe, "-m", "pip", "uninstall", "-y", module_name]]
+    for dependency in module_dependencies(python_exe, module_name):
+        if dependency.lower() != "numpy":
+            commands.append([python_exe, "-m", "pip", "uninstall", "-y", dependency])
+    return commands
+
+
+class Installer:
+    """
+    Run pip commands one after another in a background process.
+
+    The output is collected line by line so it can be shown while the commands run.
+    """
+
+    def __init__(self, max_lines=200):
+        self.status = "IDLE"
+        self.lines = deque(maxlen=max_lines)
+        self._thread = None
+
+    @property
+    def running(self):
+        return self.status == "RUNNING"
+
+    def start(self, build_commands, on_done=None):
+        """Run the commands returned by build_commands(), which is called on the worker thread"""
+        if self.running:
+            return False
+        self.status = "RUNNING"
+        self.lines.clear()
+        self._thread = threading.Thread(target=self._work, args=(build_commands, on_done), daemon=True)
+        self._thread.start()
+        return True
+
+    def _work(self, build_commands, on_done):
+        status = "DONE"
+        try:
+            for command in build_commands():
+                self.lines.append("$ " + " ".join(command[2:]))
+                process = subprocess.Popen(
+                    command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    text=True,
+                    bufsize=1,
+                )
+                for line in process.stdout:
+                    line = line.rstrip()
+                    if line:
+                        self.lines.append(line)
+                # ensurepip fails harmlessly when pip is already there
+                if process.wait() != 0 and "ensurepip" not in command:
+                    status = "FAILED"
+                    break
+        except Exception as e:
+            self.lines.append(str(e))
+            status = "FAILED"
+        forget_installed()
+        self.status = status
+        if on_done is not None:
+            on_done(status)
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
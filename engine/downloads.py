@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_MODELS_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "gpt4all")
+
+MODELS_JSON_URL = "https://gpt4all.io/models/models3.json"
+
+
+def scan_models(directory):
+    """Return the names of the complete model files in directory"""
+    try:
+        return {name for name in os.listdir(directory) if name.endswith(".gguf")}
+    except OSError:
+        return set()
+
+
+def fetch_model_info(filename, url=MODELS_JSON_URL, timeout=10):
+    """Look up the size and md5 of a model in the GPT4All model list, or None if it is not listed or offline"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            models = json.loads(response.read().decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+    for model in models:
+        if model.get("filename") == filename:
+            return {"size": int(model["filesize"]) if model.get("filesize") else None, "md5": model.get("md5sum")}
+    return None
+
+
+def file_hash(path, name="md5", chunk_size=1024 * 1024):
+    digest = hashlib.new(name)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelDownload:
+    """
+    Download a file on a background thread.
+
+    Data is streamed in chunks to path + ".part". An interrupted download is
+    resumed with an HTTP range request, and the finished file is checked against
+    the expected size and hash before it is renamed into place. A part file that
+    fails the check is deleted, so the next attempt starts over.
+    """
+
+    def __init__(self, url, path, expected_size=None, expected_hash=None, hash_name="md5", lookup=None, timeout=30):
+        self.url = url
+        self.path = path
+        self.part_path = path + ".part"
+        self.expected_size = expected_size
+        self.expected_hash = expected_hash
+        self.hash_name = hash_name
+        self.lookup = lookup
+        self.timeout = timeout
+        self.chunk_size = 1024 * 1024
+        self.status = "IDLE"
+        self.error = None
+        self.downloaded = 0
+        self.total = expected_size
+        self.bytes_per_second = 0.0
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self.status in {"RUNNING", "VERIFYING"}
+
+    @property
+    def progress(self):
+        if not self.total:
+            return 0.0
+        return min(1.0, self.downloaded / self.total)
+
+    def start(self):
+        self.status = "RUNNING"
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._work, name="GPT4Blender download", daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self):
+        try:
+            if self.lookup is not None and (self.expected_size is None or self.expected_hash is None):
+                info = self.lookup() or {}
+                self.expected_size = self.expected_size or info.get("size")
+                self.expected_hash = self.expected_hash or info.get("md5")
+                self.total = self.total or self.expected_size
+            if self._download():
+                self.status = "VERIFYING"
+                self._verify()
+                os.replace(self.part_path, self.path)
+                self.status = "DONE"
+            else:
+                self.status = "CANCELLED"
+        except Exception as e:
+            self.error = str(e)
+            self.status = "FAILED"
+
+    def _download(self):
+        """Fetch the rest of the file into the part file, returns False when cancelled"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        offset = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+        if self.expected_size and offset == self.expected_size:
+            self.downloaded = offset
+            return True
+        request = urllib.request.Request(self.url, headers={"User-Agent": "GPT4Blender"})
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # The range starts at the end of the file, the part file holds all of it when the sizes agree
+            match = re.match(r"bytes \*/(\d+)", e.headers.get("Content-Range", ""))
+            size = int(match.group(1)) if match else self.expected_size
+            if size == offset:
+                self.total = self.downloaded = offset
+                return True
+            os.remove(self.part_path)
+            return self._download()
+        with response:
+            if response.status == 206:
+                match = re.match(r"bytes (\d+)-\d+/(\d+)", response.headers.get("Content-Range", ""))
+                if match is None or int(match.group(1)) != offset:
+                    raise IOError("Server sent an unexpected range")
+                self.total = int(match.group(2))
+                mode = "ab"
+            else:
+                offset = 0
+                length = response.headers.get("Content-Length")
+                self.total = int(length) if length else self.expected_size
+                mode = "wb"
+            self.downloaded = offset
+            window_start, window_bytes = time.perf_counter(), 0
+            with open(self.part_path, mode) as file:
+                while True:
+                    if self._cancel.is_set():
+                        return False
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    file.write(chunk)
+                    self.downloaded += len(chunk)
+                    window_bytes += len(chunk)
+                    elapsed = time.perf_counter() - window_start
+                    if elapsed >= 1.0:
+                        self.bytes_per_second = window_bytes / elapsed
+                        window_start, window_bytes = time.perf_counter(), 0
+        return True
+
+    def _verify(self):
+        size = os.path.getsize(self.part_path)
+        expected_size = self.expected_size or self.total
+        if expected_size and size != expected_size:
+            os.remove(self.part_path)
+            raise IOError(f"Downloaded {size} bytes, expected {expected_size}")
+        if self.expected_hash and file_hash(self.part_path, self.hash_name) != self.expected_hash.lower():
+            os.remove(self.part_path)
+            raise IOError("Downloaded file does not match its " + self.hash_name + " checksum")
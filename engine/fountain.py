@@ -0,0 +1,193 @@
+import hashlib
+import re
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+# INT. EXT. EST. INT./EXT. I/E, or a line forced to be a heading with a leading period
+SCENE_HEADING = re.compile(r"^(?:(?:INT|EXT|EST|INT\.?/EXT|I/E)[\. ]|\.[^.\s])", re.IGNORECASE)
+# An uppercase line ending in TO:, or a line forced to be a transition with a leading >, but not >centered<
+TRANSITION = re.compile(r"^(?:[^a-z]+ TO:|>.*[^<])$")
+
+# Element types, as listed in the Fountain section of the system template
+HEADING = "HEADING"
+ACTION = "ACTION"
+CHARACTER = "CHARACTER"
+DIALOGUE = "DIALOGUE"
+PARENTHETICAL = "PARENTHETICAL"
+TRANSITION_TYPE = "TRANSITION"
+
+
+def is_scene_heading(line):
+    return SCENE_HEADING.match(line.strip()) is not None
+
+
+def scene_spans(lines):
+    """Return the (start, end) line ranges of the scenes in lines, each starting at a scene heading"""
+    starts = [i for i, line in enumerate(lines) if is_scene_heading(line)]
+    return list(zip(starts, starts[1:] + [len(lines)]))
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def is_character(line):
+    """An uppercase name, optionally with an extension such as (V.O.), or a name forced with a leading @"""
+    line = line.strip()
+    if line.startswith("@"):
+        return len(line) > 1
+    if TRANSITION.match(line):
+        return False
+    name = line.split("(")[0].strip()
+    return name == name.upper() and any(c.isalpha() for c in name)
+
+
+def classify_paragraph(lines):
+    """The element type of every line of a paragraph, a run of lines without blank lines"""
+    if len(lines) > 1 and is_character(lines[0]) and not any(is_scene_heading(line) for line in lines):
+        types = [CHARACTER]
+        for line in lines[1:]:
+            stripped = line.strip()
+            types.append(PARENTHETICAL if stripped.startswith("(") and stripped.endswith(")") else DIALOGUE)
+        return types
+    if len(lines) == 1 and TRANSITION.match(lines[0].strip()):
+        return [TRANSITION_TYPE]
+    return [HEADING if is_scene_heading(line) else ACTION for line in lines]
+
+
+def classify_lines(lines):
+    """The element type of every line, None for blank lines"""
+    types = []
+    paragraph = []
+    for line in lines + [""]:
+        if line.strip():
+            paragraph.append(line)
+            continue
+        if paragraph:
+            types.extend(classify_paragraph(paragraph))
+            paragraph = []
+        types.append(None)
+    return types[:-1]
+
+
+class FountainIndex:
+    """
+    Scene headings, characters, dialogue blocks, transitions and the element type of every line of a Fountain text.
+
+    update() compares line hashes with the previous text and only classifies the
+    paragraphs around the edited lines again. Element types only depend on the
+    paragraph a line is in, so the rest of the index is kept, shifted by the number
+    of lines that were added or removed. Lookups bisect the sorted line numbers.
+    """
+
+    def __init__(self):
+        self.source = None
+        self.lines = []
+        self.hashes = []
+        self.types = []
+        # Line numbers of the scene headings, in order
+        self.headings = []
+        # Line numbers of the character lines that start dialogue blocks, in order
+        self.dialogues = []
+        # Line numbers of the transitions, in order
+        self.transitions = []
+        # How many dialogue blocks each character name has
+        self.characters = Counter()
+
+    def update(self, source):
+        """Bring the index up to date with the text source, returns the number of lines classified"""
+        if source == self.source:
+            return 0
+        lines = source.split("\n")
+        hashes = [hash(line) for line in lines]
+        old_lines, old_hashes = self.lines, self.hashes
+        common = min(len(hashes), len(old_hashes))
+        prefix = next((i for i in range(common) if hashes[i] != old_hashes[i]), common)
+        suffix = 0
+        while suffix < common - prefix and hashes[-1 - suffix] == old_hashes[-1 - suffix]:
+            suffix += 1
+
+        # Widen the edit to whole paragraphs, the lines around it are the same in the old and new text
+        start = prefix
+        while start > 0 and lines[start - 1].strip():
+            start -= 1
+        end = len(lines) - suffix
+        while end < len(lines) and lines[end].strip():
+            end += 1
+        old_end = end - len(lines) + len(old_lines)
+
+        types = classify_lines(lines[start:end])
+        for line in self.dialogues[bisect_left(self.dialogues, start) : bisect_left(self.dialogues, old_end)]:
+            self.characters[character_name(old_lines[line])] -= 1
+        for i, element in enumerate(types):
+            if element == CHARACTER:
+                self.characters[character_name(lines[start + i])] += 1
+        self.characters = +self.characters
+
+        shift = len(lines) - len(old_lines)
+        for positions, element_type in (
+            (self.headings, HEADING),
+            (self.dialogues, CHARACTER),
+            (self.transitions, TRANSITION_TYPE),
+        ):
+            added = [start + i for i, element in enumerate(types) if element == element_type]
+            splice_lines(positions, start, old_end, added, shift)
+        self.types[start:old_end] = types
+        self.source = source
+        self.lines = lines
+        self.hashes = hashes
+        return len(types)
+
+    @property
+    def scene_count(self):
+        return len(self.headings)
+
+    def scene_span(self, n):
+        """The (start, end) lines of scene n, from its heading to the next heading"""
+        end = self.headings[n + 1] if n + 1 < len(self.headings) else len(self.lines)
+        return self.headings[n], end
+
+    def scene_at(self, line):
+        """The number of the scene containing line, or None before the first heading"""
+        n = bisect_right(self.headings, line) - 1
+        return n if n >= 0 else None
+
+    def scene_spans(self):
+        return [self.scene_span(n) for n in range(len(self.headings))]
+
+    def heading(self, n):
+        return self.lines[self.headings[n]].strip()
+
+    def dialogue_blocks(self, start, end):
+        """The (start, end) lines of the dialogue blocks starting between start and end, character line first"""
+        blocks = []
+        for line in self.dialogues[bisect_left(self.dialogues, start) : bisect_left(self.dialogues, end)]:
+            block_end = line + 1
+            while block_end < len(self.types) and self.types[block_end] in (DIALOGUE, PARENTHETICAL):
+                block_end += 1
+            blocks.append((line, block_end))
+        return blocks
+
+    def scene_characters(self, n):
+        """The names of the characters that speak in scene n, in order of their first line"""
+        names = {}
+        for start, end in self.dialogue_blocks(*self.scene_span(n)):
+            names.setdefault(character_name(self.lines[start]), None)
+        return list(names)
+
+    def scene_transitions(self, n):
+        """The line numbers of the transitions in scene n"""
+        start, end = self.scene_span(n)
+        return self.transitions[bisect_left(self.transitions, start) : bisect_left(self.transitions, end)]
+
+
+def splice_lines(positions, start, old_end, added, shift):
+    """Replace the sorted line numbers in start..old_end with added, shifting the ones after the edit"""
+    low = bisect_left(positions, start)
+    high = bisect_left(positions, old_end)
+    positions[low:] = added + [line + shift for line in positions[high:]]
+
+
+def character_name(line):
+    """The name of a character line, without its extension or the @ that forces it"""
+    return line.strip().lstrip("@").split("(")[0].strip()
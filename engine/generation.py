@@ -0,0 +1,278 @@
+import queue
+import threading
+import time
+
+from .metrics import RequestMetrics, estimate_tokens
+
+
+class GenerationRequest:
+    """Everything needed to run one prompt, collected on the main thread so workers never touch bpy"""
+
+    def __init__(
+        self,
+        model_name,
+        device,
+        prompt,
+        system_template="",
+        history="",
+        max_tokens=2000,
+        model_settings=None,
+        conversation=None,
+        turn=0,
+        sampling=None,
+        n_batch=None,
+        backend=None,
+        retrieval=None,
+        history_outputs=None,
+        history_budget=0,
+        stop_rules=None,
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.prompt = prompt
+        self.system_template = system_template
+        self.history = history
+        self.max_tokens = max_tokens
+        self.model_settings = model_settings or {}
+        # Requests with a conversation key may continue the open chat session of the model.
+        # turn is the number of history items the conversation had when the request was made.
+        self.conversation = conversation
+        self.turn = turn
+        self.sampling = sampling or {}
+        self.n_batch = n_batch
+        # Sampling seed, only sent to servers as the GPT4All bindings do not take one
+        self.seed = None
+        # Where the request runs, None means the in-process model
+        self.backend = backend
+        # Finds passages of the Text relevant to the prompt, run on the worker before generating
+        self.retrieval = retrieval
+        # Previous outputs, oldest first, fitted into history within history_budget tokens before generating
+        self.history_outputs = history_outputs
+        self.history_budget = history_budget
+        # Token counts of the system template, history and prompt, once the prompt was assembled
+        self.token_counts = None
+        # StopRules applied to the stream, stop_reason is set when one of them ended it
+        self.stop_rules = stop_rules
+        self.stop_reason = None
+        # Set when the answer may be served from and stored in the response cache
+        self.cache_key = None
+        self.metrics = RequestMetrics(model_name, device)
+
+
+def prompt_tokens(request):
+    """Size of the whole prompt, as counted when it was assembled or else estimated"""
+    if request.token_counts:
+        return sum(request.token_counts.values())
+    return estimate_tokens(request.system_template + request.history + request.prompt)
+
+
+def open_chat_session(model, request):
+    """
+    Open a chat session with the history at the end of its system prompt.
+
+    The second argument of chat_session() is the prompt template, the bindings take no earlier turns.
+    """
+    system_prompt = request.system_template
+    if request.history.strip():
+        system_prompt = system_prompt + "\n\nPrevious output:\n" + request.history.strip()
+    return model.chat_session(system_prompt)
+
+
+class PersistentSession:
+    """A chat session left open between prompts, so the model keeps its evaluated prefix"""
+
+    def __init__(self, model, request):
+        self.conversation = request.conversation
+        self.next_turn = request.turn
+        self._context = open_chat_session(model, request)
+        self._context.__enter__()
+
+    def continues(self, request):
+        return request.conversation == self.conversation and request.turn == self.next_turn
+
+    def close(self):
+        if self._context is not None:
+            self._context.__exit__(None, None, None)
+            self._context = None
+
+
+class ChatSessions:
+    """Open chat sessions, at most one per loaded model"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def enter(self, model, request):
+        """Return a session for the request, reusing the open one when the conversation continues"""
+        with self._lock:
+            session = self._sessions.get(model)
+            if session is not None and session.continues(request):
+                return session, True
+            if session is not None:
+                session.close()
+            session = self._sessions[model] = PersistentSession(model, request)
+            return session, False
+
+    def discard(self, model):
+        with self._lock:
+            session = self._sessions.pop(model, None)
+            if session is not None:
+                session.close()
+
+    def clear(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def stream_from_model(model, request, keep_going):
+    metrics = request.metrics
+    options = dict(request.sampling)
+    if request.n_batch:
+        options["n_batch"] = request.n_batch
+    tokens = model.generate(
+        request.prompt, max_tokens=request.max_tokens, streaming=True, callback=keep_going, **options
+    )
+    first = None
+    for token in tokens:
+        if not keep_going(None, token):
+            break
+        now = time.perf_counter()
+        if first is None:
+            first = now
+        metrics.generated_tokens += 1
+        metrics.generation_seconds = now - first
+        try:
+            yield token
+        except GeneratorExit:
+            if request.stop_reason is not None:
+                # A stop rule ended the stream, the model stops at its next callback.
+                # Running it to the end lets the bindings close the turn of the chat session.
+                for _ in tokens:
+                    pass
+            raise
+
+
+def generate_tokens(model, request, cancel_event=None, sessions=None):
+    """
+    Stream the answer to a request, stopping early when cancel_event is set.
+
+    When sessions is given and the request has a conversation key, the chat session
+    is left open afterwards and reused by the next request of the same conversation.
+    """
+
+    def keep_going(token_id, response):
+        if request.stop_reason is not None:
+            return False
+        return cancel_event is None or not cancel_event.is_set()
+
+    metrics = request.metrics
+    metrics.prompt_tokens = prompt_tokens(request)
+    if sessions is None or request.conversation is None:
+        if sessions is not None:
+            sessions.discard(model)
+        with open_chat_session(model, request):
+            yield from stream_from_model(model, request, keep_going)
+        return
+
+    session, reused = sessions.enter(model, request)
+    print("Chat session: " + ("continued" if reused else "started"))
+    if reused:
+        metrics.session_reused = True
+        metrics.prompt_tokens = request.token_counts["prompt"] if request.token_counts else estimate_tokens(request.prompt)
+    try:
+        yield from stream_from_model(model, request, keep_going)
+    except GeneratorExit:
+        # Ended early by a stop rule the turn is complete, the session is only lost on other closes
+        if request.stop_reason is None:
+            sessions.discard(model)
+        else:
+            session.next_turn = request.turn + 1
+        raise
+    except BaseException:
+        sessions.discard(model)
+        raise
+    session.next_turn = request.turn + 1
+
+
+class GenerationJob:
+    """
+    Run a generation on a worker thread.
+
+    run(request, cancel_event) must return an iterable of tokens. Tokens are pushed
+    into a thread-safe queue which the main thread empties with drain().
+    """
+
+    def __init__(self, request, run):
+        self.request = request
+        self.run = run
+        self.cancel_event = threading.Event()
+        self.error = None
+        self.started = None
+        self.first_token = None
+        self._tokens = queue.Queue()
+        self._parts = []
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._work, name="GPT4Blender generation", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _work(self):
+        tokens = None
+        self.started = time.perf_counter()
+        try:
+            tokens = self.run(self.request, self.cancel_event)
+            for token in tokens:
+                if self.cancel_event.is_set():
+                    break
+                if self.first_token is None:
+                    self.first_token = time.perf_counter()
+                self._parts.append(token)
+                self._tokens.put(token)
+        except Exception as e:
+            self.error = e
+        finally:
+            close = getattr(tokens, "close", None)
+            if close is not None:
+                close()
+            metrics = self.request.metrics
+            metrics.time_to_first_token = self.time_to_first_token
+            metrics.total = time.perf_counter() - self.started
+            self._done.set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def drain(self):
+        """Return every token produced since the last call without blocking"""
+        tokens = []
+        while True:
+            try:
+                tokens.append(self._tokens.get_nowait())
+            except queue.Empty:
+                return tokens
+
+    @property
+    def finished(self):
+        return self._done.is_set() and self._tokens.empty()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def time_to_first_token(self):
+        if self.first_token is None:
+            return None
+        return self.first_token - self.started
+
+    @property
+    def output(self):
+        return "".join(self._parts)
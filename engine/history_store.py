@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+import time
+
+COLUMNS = ("id", "session", "created", "model", "input", "output", "metrics")
+
+
+class HistoryStore:
+    """
+    SQLite store of chat history entries, grouped by session and indexed by time and model.
+
+    Pages and counts are cached until the next write, so drawing the same page on every
+    redraw does not touch the database. The store may be used from any thread.
+    """
+
+    def __init__(self, path, cache_size=64):
+        self.path = path
+        self.cache_size = cache_size
+        self._cache = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT NOT NULL, created REAL NOT NULL, "
+            "model TEXT NOT NULL, input TEXT NOT NULL, output TEXT NOT NULL, metrics TEXT NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session, created)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS history_model ON history (session, model, created)")
+        self._connection.commit()
+
+    def append(self, session, model, user_input, output, metrics=""):
+        """Add an entry and return its id"""
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO history (session, created, model, input, output, metrics) VALUES (?, ?, ?, ?, ?, ?)",
+                (session, time.time(), model, user_input, output, metrics),
+            )
+            self._connection.commit()
+            self._cache.clear()
+            return cursor.lastrowid
+
+    def remove(self, entry_id):
+        with self._lock:
+            self._connection.execute("DELETE FROM history WHERE id = ?", (entry_id,))
+            self._connection.commit()
+            self._cache.clear()
+
+    def clear(self, session):
+        with self._lock:
+            self._connection.execute("DELETE FROM history WHERE session = ?", (session,))
+            self._connection.commit()
+            self._cache.clear()
+
+    def get(self, entry_id):
+        """Return the entry as a dict, or None"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT " + ", ".join(COLUMNS) + " FROM history WHERE id = ?", (entry_id,)
+            ).fetchone()
+        return None if row is None else dict(zip(COLUMNS, row))
+
+    def _where(self, session, model):
+        if model is None:
+            return "WHERE session = ?", (session,)
+        return "WHERE session = ? AND model = ?", (session, model)
+
+    def _cached(self, key, query, parameters, fetch):
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            result = fetch(self._connection.execute(query, parameters))
+            if len(self._cache) >= self.cache_size:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = result
+            return result
+
+    def count(self, session, model=None):
+        where, parameters = self._where(session, model)
+        return self._cached(
+            ("count", session, model),
+            "SELECT COUNT(*) FROM history " + where,
+            parameters,
+            lambda cursor: cursor.fetchone()[0],
+        )
+
+    def page(self, session, offset, limit, model=None):
+        """Return up to limit entries as dicts, newest first, skipping the offset newest"""
+        where, parameters = self._where(session, model)
+        return self._cached(
+            ("page", session, model, offset, limit),
+            "SELECT " + ", ".join(COLUMNS) + " FROM history " + where
+            + " ORDER BY created DESC, id DESC LIMIT ? OFFSET ?",
+            parameters + (limit, offset),
+            lambda cursor: [dict(zip(COLUMNS, row)) for row in cursor.fetchall()],
+        )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+def estimate_tokens(text):
+    """Rough token count for text when no tokenizer is at hand"""
+    return len(text) // 4 + 1 if text else 0
+
+
+class RequestMetrics:
+    """Timings and token counts of one request, filled in by the worker and the main thread"""
+
+    def __init__(self, model="", device=""):
+        self.model = model
+        self.device = device
+        self.timestamp = time.time()
+        self.cache_hit = False
+        self.session_reused = False
+        self.model_load = 0.0
+        # Seconds until a server's response headers arrived, server latency rather than a local load
+        self.server_wait = 0.0
+        self.retrieval = 0.0
+        self.prompt_tokens = 0
+        self.time_to_first_token = None
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+        self.post_processing = 0.0
+        self.ui_flush = 0.0
+        self.total = 0.0
+        # The stop rule that ended the output, and how many of max_tokens were not generated because of it
+        self.stop_reason = None
+        self.tokens_saved = 0
+
+    @property
+    def tokens_per_second(self):
+        """Generation speed after the first token, so prompt evaluation is not counted"""
+        if self.generated_tokens < 2 or self.generation_seconds <= 0:
+            return 0.0
+        return (self.generated_tokens - 1) / self.generation_seconds
+
+    def to_dict(self):
+        data = dict(vars(self))
+        data["tokens_per_second"] = self.tokens_per_second
+        return data
+
+    def summary(self):
+        return format_summary(self.to_dict())
+
+
+def format_summary(data):
+    """One line summary of a metrics dict"""
+    if data.get("cache_hit"):
+        return f"Cached, {data['total']:.2f} s"
+    parts = [f"{data['tokens_per_second']:.1f} tok/s"]
+    if data.get("time_to_first_token") is not None:
+        parts.append(f"first {data['time_to_first_token']:.2f} s")
+    if data.get("model_load", 0) >= 0.05:
+        parts.append(f"load {data['model_load']:.1f} s")
+    if data.get("server_wait", 0) >= 0.05:
+        parts.append(f"server {data['server_wait']:.2f} s")
+    if data.get("retrieval", 0) >= 0.05:
+        parts.append(f"retrieval {data['retrieval']:.1f} s")
+    parts.append(f"{data['prompt_tokens']} in / {data['generated_tokens']} out")
+    if data.get("tokens_saved"):
+        parts.append(f"stopped, {data['tokens_saved']} saved")
+    return ", ".join(parts)
+
+
+class MetricsLog:
+    """Append-only JSONL log that is rotated to path.1, path.2, ... when it grows past max_bytes"""
+
+    def __init__(self, path, max_bytes=1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+
+    def append(self, data):
+        line = json.dumps(data) + "\n"
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+
+class RollingAverages:
+    """Average metrics of the last few requests per (model, device)"""
+
+    FIELDS = ("model_load", "server_wait", "time_to_first_token", "tokens_per_second", "ui_flush", "post_processing")
+
+    def __init__(self, window=20):
+        self.window = window
+        self._samples = {}
+
+    def add(self, data):
+        if data.get("cache_hit"):
+            return
+        key = (data["model"], data["device"])
+        self._samples.setdefault(key, deque(maxlen=self.window)).append(data)
+
+    def average(self, model, device):
+        samples = self._samples.get((model, device))
+        if not samples:
+            return None
+        averages = {"count": len(samples)}
+        for field in self.FIELDS:
+            values = [sample[field] for sample in samples if sample.get(field) is not None]
+            averages[field] = sum(values) / len(values) if values else None
+        return averages
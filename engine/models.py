@@ -0,0 +1,214 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def load_gpt4all(model_name, device, **settings):
+    """Load a GPT4All model, downloading it on first use"""
+    from gpt4all import GPT4All
+
+    return GPT4All(model_name, device=device, **settings)
+
+
+def close_model(model):
+    """Free the memory held by a model"""
+    close = getattr(model, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception as e:
+            print(f"Closing model failed: {e}")
+
+
+class ModelManager:
+    """
+    Keep loaded models resident between requests.
+
+    Models are keyed by name, device and load settings. The least recently used
+    model is unloaded when more than max_models are loaded, and models unused for
+    idle_timeout seconds are unloaded by release_idle(). An idle_timeout of 0
+    keeps models loaded until they are released explicitly. on_release is called
+    with each model just before it is closed.
+
+    Models load outside the lock. A request for a model that is already loading
+    waits for that load instead of starting a second one.
+    """
+
+    def __init__(self, loader=load_gpt4all, max_models=1, idle_timeout=600.0, on_release=None):
+        self.loader = loader
+        self.on_release = on_release
+        self.max_models = max_models
+        self.idle_timeout = idle_timeout
+        self._models = OrderedDict()
+        self._last_used = {}
+        self._in_use = {}
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(model_name, device, **settings):
+        return (model_name, device, tuple(sorted(settings.items())))
+
+    def acquire(self, model_name, device, **settings):
+        """Return the loaded model for these settings, loading it if needed"""
+        return self._acquire(model_name, device, settings, hold=False)
+
+    def _acquire(self, model_name, device, settings, hold):
+        key = self.make_key(model_name, device, **settings)
+        while True:
+            with self._lock:
+                model = self._models.get(key)
+                if model is not None:
+                    return self._touch(key, model, hold)
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Another thread is loading this model, take it over once loaded or load it again if that failed
+            loading.wait()
+
+        try:
+            print("Loading model: " + model_name + " (" + device + ")")
+            model = self.loader(model_name, device, **settings)
+            with self._lock:
+                self._models[key] = model
+                return self._touch(key, model, hold)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def _touch(self, key, model, hold):
+        self._models.move_to_end(key)
+        self._last_used[key] = time.monotonic()
+        if hold:
+            self._in_use[model] = self._in_use.get(model, 0) + 1
+        self._evict(keep=key)
+        return model
+
+    @contextmanager
+    def use(self, model_name, device, **settings):
+        """Hold a model for the duration of a generation so it is not unloaded underneath it"""
+        key = self.make_key(model_name, device, **settings)
+        model = self._acquire(model_name, device, settings, hold=True)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._in_use[model] -= 1
+                if self._in_use[model] == 0:
+                    del self._in_use[model]
+                    if self._models.get(key) is model:
+                        self._last_used[key] = time.monotonic()
+                    else:
+                        self._close(model)
+
+    def is_loaded(self, model_name, device, **settings):
+        with self._lock:
+            return self.make_key(model_name, device, **settings) in self._models
+
+    def is_loading(self, model_name, device, **settings):
+        with self._lock:
+            return self.make_key(model_name, device, **settings) in self._loading
+
+    def _evict(self, keep=None):
+        for key in list(self._models):
+            if len(self._models) <= max(1, self.max_models):
+                break
+            if key != keep:
+                self._release(key)
+
+    def _release(self, key):
+        model = self._models.pop(key)
+        self._last_used.pop(key, None)
+        print("Unloading model: " + key[0])
+        if model not in self._in_use:
+            self._close(model)
+
+    def _close(self, model):
+        if self.on_release is not None:
+            self.on_release(model)
+        close_model(model)
+
+    def release_idle(self, now=None):
+        """Unload models that have not been used within idle_timeout"""
+        if not self.idle_timeout:
+            return 0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            expired = [
+                key
+                for key, used in self._last_used.items()
+                if now - used >= self.idle_timeout and self._models[key] not in self._in_use
+            ]
+            for key in expired:
+                self._release(key)
+            return len(expired)
+
+    def release_all(self):
+        """Unload every resident model"""
+        with self._lock:
+            for key in list(self._models):
+                self._release(key)
+
+    def __len__(self):
+        return len(self._models)
+
+
+class Prewarmer:
+    """
+    Load a model into a ModelManager on a worker thread and evaluate a short prompt with it.
+
+    The evaluation pages the weights in, so the first real request does not pay for it.
+    It holds lock, the lock of the backend that generates with the same models, so a
+    request sent during the warm-up waits for it instead of sharing the model.
+    """
+
+    def __init__(self, manager, lock=None):
+        self.manager = manager
+        self.lock = lock or threading.Lock()
+        self.status = "IDLE"
+        self.error = None
+        self.seconds = 0.0
+        self._thread = None
+
+    @property
+    def running(self):
+        return self.status in ("LOADING", "WARMING")
+
+    def start(self, model_name, device, settings, prompt, **options):
+        """Start warming the model unless it is loaded, loading or already being warmed"""
+        if self.running or self.manager.is_loaded(model_name, device, **settings):
+            return False
+        if self.manager.is_loading(model_name, device, **settings):
+            return False
+        self.status = "LOADING"
+        self.error = None
+        self._thread = threading.Thread(
+            target=self._work,
+            args=(model_name, device, settings, prompt, options),
+            name="GPT4Blender pre-warm",
+            daemon=True,
+        )
+        self._thread.start()
+        return True
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self, model_name, device, settings, prompt, options):
+        start = time.perf_counter()
+        try:
+            with self.lock, self.manager.use(model_name, device, **settings) as model:
+                self.status = "WARMING"
+                for _ in model.generate(prompt, max_tokens=1, streaming=True, **options):
+                    break
+            self.seconds = time.perf_counter() - start
+            self.status = "READY"
+            print(f"Pre-warmed {model_name} in {self.seconds:.1f} s")
+        except Exception as e:
+            self.error = str(e)
+            self.status = "FAILED"
+            print(f"Pre-warm failed: {e}")
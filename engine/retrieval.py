@@ -0,0 +1,138 @@
+import threading
+
+import numpy as np
+
+from .chunking import chunk_spans
+from .fountain import scene_spans, text_hash
+from .metrics import estimate_tokens
+
+# Size of the passages a text without scene headings is split into
+PASSAGE_TOKENS = 256
+
+
+def load_embedder(model_name, **settings):
+    from gpt4all import Embed4All
+
+    return Embed4All(model_name, **settings)
+
+
+class Embedder:
+    """
+    An embedding model, loaded on first use and shared between threads.
+
+    nomic-embed models are given the task prefixes they were trained with.
+    """
+
+    def __init__(self, model_name, loader=load_embedder, **settings):
+        self.model_name = model_name
+        self.loader = loader
+        self.settings = settings
+        self._model = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts, query=False):
+        """Return a float32 matrix with one unit length row per text"""
+        with self._lock:
+            if self._model is None:
+                print("Loading embedding model: " + self.model_name)
+                self._model = self.loader(self.model_name, **self.settings)
+            if self.model_name.startswith("nomic-embed"):
+                prefix = "search_query" if query else "search_document"
+                vectors = self._model.embed(list(texts), prefix=prefix)
+            else:
+                vectors = self._model.embed(list(texts))
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def close(self):
+        with self._lock:
+            close = getattr(self._model, "close", None)
+            if close is not None:
+                close()
+            self._model = None
+
+
+def passages(lines):
+    """The (start, end) line spans that are embedded, the scenes or paragraph groups when there are no headings"""
+    spans = scene_spans(lines)
+    if not spans:
+        return chunk_spans(lines, PASSAGE_TOKENS)
+    if spans[0][0] > 0:
+        # Text before the first scene heading, such as a title page
+        spans.insert(0, (0, spans[0][0]))
+    return spans
+
+
+class SceneIndex:
+    """
+    Embeddings of the passages of one Text, kept in a single float32 matrix.
+
+    update() only embeds passages whose content hash is new, rows of unchanged
+    passages are reused wherever they moved to.
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.hashes = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def update(self, texts, embedder):
+        """Make the index match texts, returns the number of passages that were embedded"""
+        hashes = [text_hash(text) for text in texts]
+        with self._lock:
+            rows = {passage_hash: row for row, passage_hash in enumerate(self.hashes)}
+            new = [i for i, passage_hash in enumerate(hashes) if passage_hash not in rows]
+            embedded = embedder.embed([texts[i] for i in new]) if new else None
+            width = embedded.shape[1] if embedded is not None else self.vectors.shape[1]
+            vectors = np.empty((len(texts), width), dtype=np.float32)
+            for i, passage_hash in enumerate(hashes):
+                if passage_hash in rows:
+                    vectors[i] = self.vectors[rows[passage_hash]]
+            if new:
+                vectors[new] = embedded
+            self.hashes = hashes
+            self.vectors = vectors
+        return len(new)
+
+    def search(self, query_vector, k):
+        """Indices of the k passages most similar to query_vector, best first"""
+        with self._lock:
+            if len(self.hashes) == 0 or k <= 0:
+                return []
+            scores = self.vectors @ query_vector
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        return [int(i) for i in best[np.argsort(-scores[best])]]
+
+
+class Retrieval:
+    """
+    Passages of a Text that are relevant to a prompt, found on the worker thread.
+
+    The passage texts are captured on the main thread, passages() embeds them on the worker.
+    """
+
+    def __init__(self, index, embedder, texts, query, k=3, max_tokens=1024):
+        self.index = index
+        self.embedder = embedder
+        self.texts = texts
+        self.query = query
+        self.k = k
+        self.max_tokens = max_tokens
+        self.embedded = 0
+
+    def passages(self):
+        """The most relevant passages in text order, within max_tokens"""
+        self.embedded = self.index.update(self.texts, self.embedder)
+        query_vector = self.embedder.embed([self.query], query=True)[0]
+        chosen = []
+        used = 0
+        for i in self.index.search(query_vector, self.k):
+            tokens = estimate_tokens(self.texts[i])
+            if used + tokens > self.max_tokens:
+                continue
+            chosen.append(i)
+            used += tokens
+        return [self.texts[i] for i in sorted(chosen)]
@@ -0,0 +1,75 @@
+import heapq
+import itertools
+
+# Lower values run first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+class QueueItem:
+    def __init__(self, item_id, key, priority, label, payload):
+        self.id = item_id
+        self.key = key
+        self.priority = priority
+        self.label = label
+        self.payload = payload
+        self.sequence = item_id
+
+
+class RequestQueue:
+    """
+    Pending requests ordered by priority and then by arrival.
+
+    A request whose key matches a pending one is coalesced into it instead of being queued twice.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._items = {}
+        self._by_key = {}
+        self._ids = itertools.count(1)
+
+    def push(self, key, priority, label, payload):
+        """Queue a request, returns (item, added) where added is False if it was coalesced"""
+        existing = self._by_key.get(key)
+        if existing is not None:
+            if priority < existing.priority:
+                existing.priority = priority
+                heapq.heappush(self._heap, (existing.priority, existing.sequence, existing.id))
+            return existing, False
+        item = QueueItem(next(self._ids), key, priority, label, payload)
+        self._items[item.id] = item
+        self._by_key[key] = item
+        heapq.heappush(self._heap, (item.priority, item.sequence, item.id))
+        return item, True
+
+    def pop(self):
+        """Remove and return the next item, or None if the queue is empty"""
+        while self._heap:
+            priority, sequence, item_id = heapq.heappop(self._heap)
+            item = self._items.get(item_id)
+            # Entries of removed items, or left behind when an item was promoted, are skipped
+            if item is not None and item.priority == priority:
+                return self._forget(item)
+        return None
+
+    def remove(self, item_id):
+        item = self._items.get(item_id)
+        return self._forget(item) if item is not None else None
+
+    def _forget(self, item):
+        del self._items[item.id]
+        del self._by_key[item.key]
+        return item
+
+    def items(self):
+        """Pending items in the order they will run"""
+        return sorted(self._items.values(), key=lambda item: (item.priority, item.sequence))
+
+    def clear(self):
+        self._heap.clear()
+        self._items.clear()
+        self._by_key.clear()
+
+    def __len__(self):
+        return len(self._items)
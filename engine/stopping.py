@@ -0,0 +1,189 @@
+import re
+
+from .fountain import TRANSITION, is_scene_heading
+
+# Lines that end a screenplay, besides the transitions ending in TO:
+SCRIPT_ENDINGS = ("FADE OUT.", "FADE TO BLACK.", "THE END")
+
+
+class AhoCorasick:
+    """
+    Automaton that finds any of a set of strings in text fed one character at a time.
+
+    Each character costs amortized constant time, however the text is split into tokens.
+    depth[state] is the length of the longest suffix of the text so far that begins one
+    of the strings, match[state] is the longest string that ends at the last character.
+    """
+
+    def __init__(self, strings):
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match = [None]
+        for string in strings:
+            state = 0
+            for char in string:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.match.append(None)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.match[state] = string
+        # Breadth first, so the fail state of every state is done before its children
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                if self.match[child] is None:
+                    self.match[child] = self.match[self.fail[child]]
+                queue.append(child)
+
+    def step(self, state, char):
+        while state and char not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(char, 0)
+
+
+def pattern_error(pattern):
+    """Why pattern is not a valid regular expression, or None when it is"""
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        return str(e)
+    return None
+
+
+class StopRules:
+    """
+    When to end a generation early, shared by every request made with the same settings.
+
+    strings end the output right before a line that starts with one of them, so words
+    like "Note:" inside dialogue are kept. A line matching pattern is dropped with
+    everything after it. With scene_complete the output ends
+    after a transition once it has expected_scenes scene headings, or right before
+    one heading more than that.
+    """
+
+    def __init__(self, strings=(), pattern="", scene_complete=False, expected_scenes=1):
+        self.strings = tuple(string for string in strings if string)
+        self.pattern = re.compile(pattern) if pattern else None
+        self.scene_complete = scene_complete
+        self.expected_scenes = expected_scenes
+        # Strings are matched after a newline, the stream starts after an implied one
+        self.automaton = AhoCorasick("\n" + string for string in self.strings)
+
+    @property
+    def signature(self):
+        """What decides the output, for cache keys"""
+        pattern = self.pattern.pattern if self.pattern is not None else ""
+        return [list(self.strings), pattern, self.scene_complete, self.expected_scenes]
+
+    @property
+    def line_rules(self):
+        return self.pattern is not None or self.scene_complete
+
+    def start(self):
+        return StopEngine(self)
+
+
+class StopEngine:
+    """
+    Apply StopRules to one stream of tokens.
+
+    Text is held back while it could still be the start of a stop string, and with
+    line rules until its line is complete, so nothing after a stop is ever passed on.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.reason = None
+        self.headings = 0
+        self._state = rules.automaton.step(0, "\n")
+        self._pending = []
+        self._line_start = 0
+
+    def feed(self, token):
+        """Consume a token, returns the text that is ready to be passed on"""
+        automaton = self.rules.automaton
+        pending = self._pending
+        for char in token:
+            pending.append(char)
+            self._state = automaton.step(self._state, char)
+            string = automaton.match[self._state]
+            if string is not None:
+                return self._stop("stop string " + string.strip(), max(0, len(pending) - len(string)))
+            if char == "\n" and self.rules.line_rules:
+                cut = self._check_line("".join(pending[self._line_start : -1]), len(pending))
+                if cut is not None:
+                    return self._stop(self.reason, cut)
+                self._line_start = len(pending)
+        ready = max(0, len(pending) - automaton.depth[self._state])
+        if self.rules.line_rules:
+            ready = min(ready, self._line_start)
+        return self._take(ready)
+
+    def finish(self):
+        """The text still held back once the stream has ended"""
+        if self.reason is not None:
+            return ""
+        cut = None
+        if self.rules.line_rules:
+            cut = self._check_line("".join(self._pending[self._line_start :]), len(self._pending))
+        return self._take(len(self._pending) if cut is None else cut)
+
+    def _check_line(self, line, end):
+        """Where the output ends if line, which finishes at end, triggers a line rule, otherwise None"""
+        rules = self.rules
+        if rules.pattern is not None and rules.pattern.search(line):
+            self.reason = "stop pattern"
+            return self._line_start
+        if not rules.scene_complete:
+            return None
+        stripped = line.strip()
+        if is_scene_heading(stripped):
+            self.headings += 1
+            if self.headings > rules.expected_scenes:
+                self.reason = "next scene"
+                return self._line_start
+        elif self.headings >= rules.expected_scenes and (
+            TRANSITION.match(stripped) or stripped.upper() in SCRIPT_ENDINGS
+        ):
+            self.reason = "scene complete"
+            return end
+        return None
+
+    def _stop(self, reason, cut):
+        self.reason = reason
+        return self._take(cut)
+
+    def _take(self, count):
+        text = "".join(self._pending[:count])
+        del self._pending[:count]
+        self._line_start = max(0, self._line_start - count)
+        return text
+
+
+def stop_stream(tokens, request):
+    """Pass tokens through the stop rules of request, ending the stream as soon as one matches"""
+    engine = request.stop_rules.start()
+    metrics = request.metrics
+    for token in tokens:
+        text = engine.feed(token)
+        if text:
+            yield text
+        if engine.reason is not None:
+            # Generation callbacks see this and end the model's generation
+            request.stop_reason = metrics.stop_reason = engine.reason
+            metrics.tokens_saved = max(0, request.max_tokens - metrics.generated_tokens)
+            print(f"Stopped early on {engine.reason}, up to {metrics.tokens_saved} tokens saved")
+            return
+    text = engine.finish()
+    if engine.reason is not None:
+        metrics.stop_reason = engine.reason
+    if text:
+        yield text
@@ -0,0 +1,156 @@
+import time
+
+
+class TokenCoalescer:
+    """
+    Buffer streamed tokens and release them in batches.
+
+    A batch is released at most max_rate times per second, or as soon as a token
+    containing a newline arrives when flush_on_newline is set. A max_rate of 0
+    releases every token as soon as it is polled.
+    """
+
+    def __init__(self, max_rate=20.0, flush_on_newline=True, clock=time.monotonic):
+        self.interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.flush_on_newline = flush_on_newline
+        self.clock = clock
+        self.flushes = 0
+        self._parts = []
+        self._newline = False
+        self._last_flush = None
+
+    def push(self, token):
+        self._parts.append(token)
+        if self.flush_on_newline and "\n" in token:
+            self._newline = True
+
+    def poll(self):
+        """Return the buffered text if a flush is due, otherwise an empty string"""
+        if not self._parts:
+            return ""
+        now = self.clock()
+        if self._newline or self._last_flush is None or now - self._last_flush >= self.interval:
+            return self.flush(now)
+        return ""
+
+    def flush(self, now=None):
+        """Return all buffered text regardless of the rate limit"""
+        if not self._parts:
+            return ""
+        chunk = "".join(self._parts)
+        self._parts = []
+        self._newline = False
+        self._last_flush = self.clock() if now is None else now
+        self.flushes += 1
+        return chunk
+
+    @property
+    def pending(self):
+        return len(self._parts) > 0
+
+
+FENCE_OPEN = "```python"
+FENCE_CLOSE = "```"
+
+
+class StreamProcessor:
+    """
+    Clean up model output while it streams in.
+
+    Trailing whitespace is stripped from every line and ```python code fences are
+    dropped while the code inside them is kept, even when a fence is split over
+    several tokens. Each character is looked at a constant number of times, and
+    feeding a complete message gives the same result as feeding it token by token.
+    """
+
+    def __init__(self):
+        self.in_code_block = False
+        self._parts = []
+        # Start of the current line, held back while it could still turn out to be a fence
+        self._held = ""
+        # Trailing whitespace, held back until the line continues
+        self._whitespace = ""
+        self._line_started = False
+        self._separator = ""
+
+    def feed(self, token):
+        """Consume a token and return the processed text that is ready to be shown"""
+        out = []
+        pieces = token.split("\n")
+        for piece in pieces[:-1]:
+            self._continue_line(piece, out)
+            self._end_line(out)
+        self._continue_line(pieces[-1], out)
+        return self._emit(out)
+
+    def finish(self):
+        """Flush the last line once the stream has ended"""
+        out = []
+        self._end_line(out)
+        return self._emit(out)
+
+    @property
+    def output(self):
+        return "".join(self._parts)
+
+    def _emit(self, out):
+        chunk = "".join(out)
+        if chunk:
+            self._parts.append(chunk)
+        return chunk
+
+    def _could_be_fence(self, candidate):
+        return FENCE_OPEN.startswith(candidate) or (self.in_code_block and FENCE_CLOSE.startswith(candidate))
+
+    def _continue_line(self, piece, out):
+        if not piece:
+            return
+        if self._line_started:
+            text = self._whitespace + piece
+        else:
+            text = self._held + piece
+            if self._could_be_fence(text.rstrip()):
+                self._held = text
+                return
+            self._held = ""
+            self._line_started = True
+            # The newline that ended the previous line is only written once this one is known to be kept
+            out.append(self._separator)
+            self._separator = "\n"
+        stripped = text.rstrip()
+        self._whitespace = text[len(stripped) :]
+        out.append(stripped)
+
+    def _end_line(self, out):
+        if not self._line_started:
+            line = self._held.rstrip()
+            self._held = ""
+            if line == FENCE_OPEN:
+                self.in_code_block = True
+                return
+            if self.in_code_block and line == FENCE_CLOSE:
+                self.in_code_block = False
+                return
+            out.append(self._separator + line)
+            self._separator = "\n"
+        self._line_started = False
+        self._whitespace = ""
+
+
+def process_stream(tokens, metrics=None):
+    """Run a token stream through a StreamProcessor, yielding the processed chunks"""
+    processor = StreamProcessor()
+    spent = 0.0
+    for token in tokens:
+        start = time.perf_counter()
+        chunk = processor.feed(token)
+        spent += time.perf_counter() - start
+        if metrics is not None:
+            metrics.post_processing = spent
+        if chunk:
+            yield chunk
+    chunk = processor.finish()
+    if metrics is not None:
+        metrics.post_processing = spent
+    if chunk:
+        yield chunk
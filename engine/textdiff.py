@@ -0,0 +1,65 @@
+from difflib import SequenceMatcher
+
+
+def split_lines(text):
+    """Split text into lines that keep their newline, so joining them gives text back"""
+    pieces = text.split("\n")
+    lines = [piece + "\n" for piece in pieces[:-1]]
+    if pieces[-1]:
+        lines.append(pieces[-1])
+    return lines
+
+
+def text_end(start, text):
+    """The (line, character) position after text written at start"""
+    lines = text.split("\n")
+    if len(lines) == 1:
+        return (start[0], start[1] + len(text))
+    return (start[0] + len(lines) - 1, len(lines[-1]))
+
+
+class LineDiff:
+    """
+    The runs of lines that differ between old text, written at start, and new text.
+
+    edits are (start, end, replacement) with (line, character) positions in the
+    old text, last first, so applying them in turn leaves the earlier positions valid.
+    """
+
+    def __init__(self, start, old, new):
+        old_lines = split_lines(old)
+        new_lines = split_lines(new)
+        end = text_end(start, old)
+
+        def position(i):
+            if i == len(old_lines):
+                return end
+            return (start[0] + i, start[1] if i == 0 else 0)
+
+        self.edits = []
+        self.added = 0
+        self.removed = 0
+        matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            self.edits.append((position(i1), position(i2), "".join(new_lines[j1:j2])))
+            self.removed += i2 - i1
+            self.added += j2 - j1
+        self.edits.reverse()
+
+
+def diff_preview(old, new, limit=12):
+    """The changed lines of new against old, prefixed with + or -, at most limit of them"""
+    old_lines = old.split("\n")
+    new_lines = new.split("\n")
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    preview = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        preview.extend("- " + line for line in old_lines[i1:i2])
+        preview.extend("+ " + line for line in new_lines[j1:j2])
+        if len(preview) >= limit:
+            return preview[:limit]
+    return preview
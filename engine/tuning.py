@@ -0,0 +1,252 @@
+import ctypes
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from .metrics import estimate_tokens
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF metadata value types and the struct format of the fixed size ones
+GGUF_SCALARS = {0: "B", 1: "b", 2: "H", 3: "h", 4: "I", 5: "i", 6: "f", 7: "?", 10: "Q", 11: "q", 12: "d"}
+GGUF_STRING = 8
+GGUF_ARRAY = 9
+
+
+class GGUFReader:
+    """Read the metadata of a GGUF file through mmap, without loading the tensors"""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from("<" + fmt, self.data, self.offset)
+        self.offset += struct.calcsize("<" + fmt)
+        return values[0]
+
+    def read_string(self):
+        length = self.read("Q")
+        value = bytes(self.data[self.offset : self.offset + length])
+        self.offset += length
+        return value.decode("utf-8", errors="replace")
+
+    def read_value(self, value_type):
+        if value_type == GGUF_STRING:
+            return self.read_string()
+        if value_type == GGUF_ARRAY:
+            item_type = self.read("I")
+            count = self.read("Q")
+            if item_type in GGUF_SCALARS:
+                # Arrays such as the vocabulary are skipped rather than decoded
+                self.offset += count * struct.calcsize("<" + GGUF_SCALARS[item_type])
+            else:
+                for _ in range(count):
+                    self.read_value(item_type)
+            return None
+        return self.read(GGUF_SCALARS[value_type])
+
+
+def read_gguf_metadata(path):
+    """Return the scalar metadata of a GGUF model file as a dict"""
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:4] != GGUF_MAGIC:
+            raise ValueError(path + " is not a GGUF file")
+        reader = GGUFReader(data)
+        reader.offset = 4
+        version = reader.read("I")
+        count_format = "I" if version == 1 else "Q"
+        reader.read(count_format)
+        kv_count = reader.read(count_format)
+        metadata = {"gguf.version": version}
+        for _ in range(kv_count):
+            key = reader.read_string()
+            value = reader.read_value(reader.read("I"))
+            if value is not None:
+                metadata[key] = value
+        return metadata
+
+
+def estimate_memory(metadata, file_size, n_ctx, n_batch=8):
+    """
+    Estimate the RAM a model needs in bytes.
+
+    This is the size of the weights plus an f16 key/value cache for n_ctx tokens,
+    a scratch buffer that grows with the batch size, and a fixed allowance for the runtime.
+    """
+    architecture = metadata.get("general.architecture", "llama")
+    layers = metadata.get(architecture + ".block_count", 32)
+    embedding = metadata.get(architecture + ".embedding_length", 4096)
+    heads = metadata.get(architecture + ".attention.head_count", 32) or 1
+    kv_heads = metadata.get(architecture + ".attention.head_count_kv", heads)
+    kv_cache = 2 * layers * n_ctx * (embedding * kv_heads // heads) * 2
+    scratch = n_batch * embedding * 4 * 16
+    return file_size + kv_cache + scratch + 256 * 1024 * 1024
+
+
+def available_memory():
+    """Physical memory available without swapping in bytes, or None if unknown"""
+    try:
+        if sys.platform.startswith("linux"):
+            with open("/proc/meminfo") as file:
+                for line in file:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        elif sys.platform == "win32":
+
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [
+                    ("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+                ]
+
+            status = MemoryStatus()
+            status.dwLength = ctypes.sizeof(MemoryStatus)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return status.ullAvailPhys
+        else:
+            # macOS and other unixes only report the total, keep a margin for the system
+            return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.75)
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def tuning_configurations(cpu_count, n_ctx):
+    """(threads, batch size) pairs to try, thread counts around the number of physical cores"""
+    cpu_count = cpu_count or 4
+    threads = sorted({max(1, cpu_count // 4), max(1, cpu_count // 2), cpu_count})
+    batches = [batch for batch in (8, 32, 128, 512) if batch <= n_ctx]
+    return [(thread_count, batch) for thread_count in threads for batch in batches]
+
+
+def request_seconds(result, prompt_tokens=600, generated_tokens=300):
+    """Time a typical request would take with a measured configuration"""
+    if not result["prompt_tps"] or not result["generation_tps"]:
+        return float("inf")
+    return prompt_tokens / result["prompt_tps"] + generated_tokens / result["generation_tps"]
+
+
+class AutoTuner:
+    """
+    Measure prompt evaluation and generation speed for a set of configurations on a worker thread.
+
+    load(n_threads) must return a model. Each thread count is loaded once and all
+    batch sizes are measured on it before it is closed.
+    """
+
+    def __init__(self, load, configurations, prompt, generated_tokens=32, close=None):
+        self.load = load
+        self.close = close
+        self.configurations = configurations
+        self.prompt = prompt
+        self.generated_tokens = generated_tokens
+        self.status = "IDLE"
+        self.error = None
+        self.results = []
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self.status == "RUNNING"
+
+    @property
+    def best(self):
+        if not self.results:
+            return None
+        return min(self.results, key=request_seconds)
+
+    def start(self):
+        self.status = "RUNNING"
+        self._thread = threading.Thread(target=self._work, name="GPT4Blender auto-tune", daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self):
+        try:
+            by_threads = {}
+            for n_threads, n_batch in self.configurations:
+                by_threads.setdefault(n_threads, []).append(n_batch)
+            for n_threads, batches in by_threads.items():
+                model = self.load(n_threads)
+                try:
+                    for n_batch in batches:
+                        if self._cancel.is_set():
+                            self.status = "CANCELLED"
+                            return
+                        self.results.append(self.measure(model, n_threads, n_batch))
+                finally:
+                    if self.close is not None:
+                        self.close(model)
+            self.status = "DONE"
+        except Exception as e:
+            self.error = str(e)
+            self.status = "FAILED"
+
+    def measure(self, model, n_threads, n_batch):
+        start = time.perf_counter()
+        for _ in model.generate(self.prompt, max_tokens=1, n_batch=n_batch, streaming=True):
+            break
+        prompt_seconds = time.perf_counter() - start
+
+        first = last = None
+        count = 0
+        for _ in model.generate("Go on.", max_tokens=self.generated_tokens, n_batch=n_batch, streaming=True):
+            last = time.perf_counter()
+            first = first or last
+            count += 1
+        generation_tps = (count - 1) / (last - first) if count > 1 and last > first else 0.0
+        result = {
+            "n_threads": n_threads,
+            "n_batch": n_batch,
+            "prompt_tps": estimate_tokens(self.prompt) / prompt_seconds if prompt_seconds > 0 else 0.0,
+            "generation_tps": generation_tps,
+        }
+        print(
+            f"Auto-tune threads {n_threads} batch {n_batch}: "
+            f"{result['prompt_tps']:.0f} prompt tok/s, {generation_tps:.1f} tok/s"
+        )
+        return result
+
+
+class TuningStore:
+    """The fastest configuration per (model, device), kept in a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, model, device):
+        return self._load().get(model + "|" + device)
+
+    def put(self, model, device, configuration):
+        data = self._load()
+        data[model + "|" + device] = configuration
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as file:
+            json.dump(data, file, indent=2)
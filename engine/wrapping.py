@@ -0,0 +1,51 @@
+import textwrap
+from collections import OrderedDict
+
+
+def fingerprint(text):
+    """Cheap signature of a text, used to notice when a cache key is reused for different text"""
+    return (len(text), text[:64], text[-64:])
+
+
+class WrapCache:
+    """
+    LRU cache of word wrapped lines.
+
+    Entries are keyed by (key, width), where key defaults to the text itself. Callers
+    drawing long texts pass a stable key instead, such as the pointer of the datablock
+    holding the text, so a lookup does not have to hash the whole text.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._wrappers = {}
+
+    def wrap(self, text, width, key=None):
+        """Return the wrapped lines of text as a tuple"""
+        width = max(1, width)
+        cache_key = (text if key is None else key, width)
+        signature = fingerprint(text) if key is not None else None
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] == signature:
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        wrapper = self._wrappers.get(width)
+        if wrapper is None:
+            wrapper = self._wrappers[width] = textwrap.TextWrapper(width=width)
+        lines = tuple(wrapped_line for line in text.splitlines() for wrapped_line in wrapper.wrap(text=line))
+        self._entries[cache_key] = (signature, lines)
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return lines
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
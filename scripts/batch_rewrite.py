@@ -0,0 +1,69 @@
+"""
+Rewrite every Fountain script in a directory with one prompt, without the Blender UI.
+
+Scripts are rewritten in context sized chunks with the same prompts and clean-up
+as Send Selection. Each worker process loads its own model, and the number of
+workers is limited to what fits in the available memory. The rewritten scripts
+and a report.jsonl with the timing of each file are written to the output folder.
+
+As a plain Python script:
+
+    python scripts/batch_rewrite.py scripts_in scripts_out --prefix "Make the dialogue sharper"
+
+From Blender, using its bundled Python and GPT4All:
+
+    blender -b --python scripts/batch_rewrite.py -- scripts_in scripts_out --prefix "Make the dialogue sharper"
+"""
+
+import argparse
+import os
+import sys
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ADDON_DIR)
+
+from engine.batch import BatchOptions, run_batch  # noqa: E402
+from engine.downloads import DEFAULT_MODELS_DIRECTORY  # noqa: E402
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="folder with the .fountain files")
+    parser.add_argument("output", help="folder the rewritten files and report.jsonl are written to")
+    parser.add_argument("--prefix", required=True, help="rewrite instruction, as in the Rewrite field")
+    parser.add_argument("--model", default="Nous-Hermes-2-Mistral-7B-DPO.Q4_0.gguf")
+    parser.add_argument("--models-directory", default=DEFAULT_MODELS_DIRECTORY)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--max-tokens", type=int, default=2000)
+    parser.add_argument("--chunk-overlap", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--threads", type=int, help="threads per worker, by default the cores are shared out")
+    parser.add_argument("--workers", type=int, help="maximum number of worker processes")
+    args = parser.parse_args(argv)
+
+    options = BatchOptions(
+        args.model,
+        args.prefix,
+        device=args.device,
+        model_path=args.models_directory,
+        n_ctx=args.context_length,
+        max_tokens=args.max_tokens,
+        chunk_overlap=args.chunk_overlap,
+        sampling={"temp": args.temperature},
+        n_batch=args.batch_size,
+        n_threads=args.threads,
+    )
+    try:
+        entries = run_batch(args.input, args.output, options, workers=args.workers)
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        return 2
+    return 0 if all(entry["status"] == "DONE" for entry in entries) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.fountain import (  # noqa: E402
+    ACTION,
+    CHARACTER,
+    DIALOGUE,
+    HEADING,
+    PARENTHETICAL,
+    TRANSITION_TYPE,
+    FountainIndex,
+    classify_lines,
+)
+
+LINES = ["INT. HOUSE - DAY", "EXT. ROAD - NIGHT", "", "", "MARA", "JOHN (V.O.)", "@mcClane", "Hello.", "(beat)",
+         "CUT TO:", "She walks in.", "> THE END <"]
+
+INDEXED = ("types", "headings", "dialogues", "transitions", "characters")
+
+
+def full_index(lines):
+    index = FountainIndex()
+    index.update("\n".join(lines))
+    return index
+
+
+class FountainIndexTest(unittest.TestCase):
+    def test_element_types(self):
+        lines = ["INT. HOUSE - DAY", "", "Mara waits.", "", "MARA", "(quietly)", "Not again.", "", "CUT TO:"]
+        self.assertEqual(
+            classify_lines(lines),
+            [HEADING, None, ACTION, None, CHARACTER, PARENTHETICAL, DIALOGUE, None, TRANSITION_TYPE],
+        )
+
+    def test_incremental_updates_match_a_full_parse(self):
+        random.seed(3)
+        index = FountainIndex()
+        lines = []
+        for _ in range(1500):
+            start = random.randint(0, len(lines))
+            end = start + random.randint(0, 3)
+            lines[start:end] = [random.choice(LINES) for _ in range(random.randint(0, 4))]
+            index.update("\n".join(lines))
+            full = full_index(lines)
+            for name in INDEXED:
+                self.assertEqual(getattr(index, name), getattr(full, name), name)
+            for n in range(full.scene_count):
+                self.assertEqual(index.scene_characters(n), full.scene_characters(n))
+
+    def test_only_edited_paragraphs_are_classified(self):
+        lines = []
+        for n in range(200):
+            lines += [f"INT. ROOM {n} - DAY", "", "Mara waits.", "", "MARA", "Hello.", ""]
+        index = full_index(lines)
+        lines[3 * 7 + 2] = "Mara leaves."
+        self.assertEqual(index.update("\n".join(lines)), 1)
+        self.assertEqual(index.update("\n".join(lines)), 0)
+
+    def test_scene_lookups(self):
+        lines = ["Title", "", "INT. A - DAY", "", "MARA", "Hi.", "", "JOHN", "Hey.", "", "CUT TO:", "",
+                 "EXT. B - NIGHT", "", "MARA", "Bye."]
+        index = full_index(lines)
+        self.assertEqual(index.scene_count, 2)
+        self.assertIsNone(index.scene_at(0))
+        self.assertEqual(index.scene_at(5), 0)
+        self.assertEqual(index.scene_at(12), 1)
+        self.assertEqual(index.scene_span(0), (2, 12))
+        self.assertEqual(index.heading(1), "EXT. B - NIGHT")
+        self.assertEqual(index.dialogue_blocks(2, 12), [(4, 6), (7, 9)])
+        self.assertEqual(index.scene_characters(0), ["MARA", "JOHN"])
+        self.assertEqual(index.scene_transitions(0), [10])
+        self.assertEqual(index.characters["MARA"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.models import ModelManager, Prewarmer  # noqa: E402
+
+
+class FakeModel:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def generate(self, prompt, **options):
+        yield "token"
+
+
+class ModelManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.loads = []
+
+        def loader(name, device, **settings):
+            self.loads.append(name)
+            return FakeModel(name)
+
+        self.manager = ModelManager(loader, max_models=2, idle_timeout=60)
+
+    def test_loaded_models_are_reused(self):
+        first = self.manager.acquire("a", "cpu", n_ctx=2048)
+        self.assertIs(self.manager.acquire("a", "cpu", n_ctx=2048), first)
+        self.assertIsNot(self.manager.acquire("a", "cpu", n_ctx=4096), first)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_least_recently_used_is_evicted(self):
+        a = self.manager.acquire("a", "cpu")
+        b = self.manager.acquire("b", "cpu")
+        self.manager.acquire("a", "cpu")
+        self.manager.acquire("c", "cpu")
+        self.assertTrue(b.closed)
+        self.assertFalse(a.closed)
+        self.assertTrue(self.manager.is_loaded("a", "cpu"))
+        self.assertFalse(self.manager.is_loaded("b", "cpu"))
+
+    def test_model_in_use_is_closed_after_its_generation(self):
+        with self.manager.use("a", "cpu") as a:
+            self.manager.acquire("b", "cpu")
+            self.manager.acquire("c", "cpu")
+            self.assertFalse(self.manager.is_loaded("a", "cpu"))
+            self.assertFalse(a.closed)
+        self.assertTrue(a.closed)
+
+    def test_idle_models_are_released_unless_in_use(self):
+        a = self.manager.acquire("a", "cpu")
+        with self.manager.use("b", "cpu") as b:
+            self.assertEqual(self.manager.release_idle(now=float("inf")), 1)
+            self.assertFalse(b.closed)
+        self.assertTrue(a.closed)
+
+    def test_concurrent_requests_load_once(self):
+        release = threading.Event()
+
+        def slow_loader(name, device, **settings):
+            release.wait(5)
+            self.loads.append(name)
+            return FakeModel(name)
+
+        manager = ModelManager(slow_loader)
+        models = []
+        threads = [threading.Thread(target=lambda: models.append(manager.acquire("a", "cpu"))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.loads, ["a"])
+        self.assertEqual(len({id(model) for model in models}), 1)
+
+
+class PrewarmerTest(unittest.TestCase):
+    def test_warm_up_holds_the_lock(self):
+        lock = threading.Lock()
+        manager = ModelManager(lambda name, device, **settings: FakeModel(name))
+        prewarmer = Prewarmer(manager, lock)
+        with lock:
+            self.assertTrue(prewarmer.start("a", "cpu", {}, "Hi"))
+            prewarmer.wait(0.2)
+            self.assertEqual(prewarmer.status, "LOADING")
+        prewarmer.wait(5)
+        self.assertEqual(prewarmer.status, "READY")
+        self.assertFalse(prewarmer.start("a", "cpu", {}, "Hi"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, RequestQueue  # noqa: E402
+
+
+def drain(queue):
+    labels = []
+    item = queue.pop()
+    while item is not None:
+        labels.append(item.label)
+        item = queue.pop()
+    return labels
+
+
+class RequestQueueTest(unittest.TestCase):
+    def test_priority_then_arrival(self):
+        queue = RequestQueue()
+        queue.push("1", PRIORITY_BULK, "bulk 1", None)
+        queue.push("2", PRIORITY_INTERACTIVE, "interactive 1", None)
+        queue.push("3", PRIORITY_BULK, "bulk 2", None)
+        queue.push("4", PRIORITY_INTERACTIVE, "interactive 2", None)
+        self.assertEqual([item.label for item in queue.items()], ["interactive 1", "interactive 2", "bulk 1", "bulk 2"])
+        self.assertEqual(drain(queue), ["interactive 1", "interactive 2", "bulk 1", "bulk 2"])
+        self.assertEqual(len(queue), 0)
+
+    def test_duplicate_is_coalesced_and_promoted(self):
+        queue = RequestQueue()
+        first, added = queue.push("same", PRIORITY_BULK, "scene", "payload")
+        queue.push("other", PRIORITY_BULK, "other", None)
+        queue.push("first", PRIORITY_INTERACTIVE, "message", None)
+        item, added = queue.push("same", PRIORITY_INTERACTIVE, "scene again", "ignored")
+        self.assertFalse(added)
+        self.assertIs(item, first)
+        self.assertEqual(item.payload, "payload")
+        self.assertEqual(len(queue), 3)
+        # Promoted ahead of the bulk items, behind the interactive one queued before it
+        self.assertEqual(drain(queue), ["scene", "message", "other"])
+
+    def test_lower_priority_duplicate_does_not_demote(self):
+        queue = RequestQueue()
+        queue.push("a", PRIORITY_INTERACTIVE, "a", None)
+        queue.push("b", PRIORITY_INTERACTIVE, "b", None)
+        queue.push("a", PRIORITY_BULK, "a again", None)
+        self.assertEqual(drain(queue), ["a", "b"])
+
+    def test_removed_items_are_skipped(self):
+        queue = RequestQueue()
+        item, added = queue.push("a", PRIORITY_BULK, "a", None)
+        queue.push("b", PRIORITY_BULK, "b", None)
+        self.assertIs(queue.remove(item.id), item)
+        self.assertIsNone(queue.remove(item.id))
+        self.assertEqual(drain(queue), ["b"])
+        self.assertTrue(queue.push("a", PRIORITY_BULK, "a", None)[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
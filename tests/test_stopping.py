@@ -0,0 +1,76 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.stopping import AhoCorasick, StopRules, pattern_error  # noqa: E402
+
+
+def run(rules, text, sizes=(1,)):
+    """Feed text to a StopEngine in tokens of the given sizes, returns the output and the stop reason"""
+    engine = rules.start()
+    output = []
+    i = 0
+    n = 0
+    while i < len(text):
+        size = sizes[n % len(sizes)]
+        output.append(engine.feed(text[i : i + size]))
+        i += size
+        n += 1
+        if engine.reason is not None:
+            return "".join(output), engine.reason
+    output.append(engine.finish())
+    return "".join(output), engine.reason
+
+
+class AhoCorasickTest(unittest.TestCase):
+    def test_matches_like_a_brute_force_search(self):
+        random.seed(1)
+        for _ in range(500):
+            strings = ["".join(random.choice("abc") for _ in range(random.randint(1, 4))) for _ in range(3)]
+            text = "".join(random.choice("abc") for _ in range(30))
+            automaton = AhoCorasick(strings)
+            state = 0
+            for end in range(1, len(text) + 1):
+                state = automaton.step(state, text[end - 1])
+                found = [string for string in strings if text[:end].endswith(string)]
+                expected = max(found, key=len) if found else None
+                self.assertEqual(automaton.match[state], expected)
+
+
+class StopEngineTest(unittest.TestCase):
+    def test_stop_string_at_line_start(self):
+        rules = StopRules(["Note:"])
+        text = "MARA\nTake a Note: now.\nNote: this was added"
+        for sizes in ((1,), (3,), (7, 2), (len(text),)):
+            self.assertEqual(run(rules, text, sizes), ("MARA\nTake a Note: now.", "stop string Note:"))
+
+    def test_stop_string_at_stream_start(self):
+        self.assertEqual(run(StopRules(["Note:"]), "Note: all of it"), ("", "stop string Note:"))
+
+    def test_partial_match_is_released_at_the_end(self):
+        self.assertEqual(run(StopRules(["Notes:"]), "INT. A\nNote"), ("INT. A\nNote", None))
+
+    def test_pattern_drops_the_matching_line(self):
+        rules = StopRules(pattern=r"^\(.*\)$")
+        self.assertEqual(run(rules, "JOHN\nHi.\n(laughs)\nMore", (4,)), ("JOHN\nHi.\n", "stop pattern"))
+
+    def test_scene_complete_after_transition(self):
+        rules = StopRules(scene_complete=True)
+        text = "INT. A - DAY\n\nMara waits.\n\nCUT TO:\n\nINT. B - DAY\n"
+        self.assertEqual(run(rules, text, (5,)), ("INT. A - DAY\n\nMara waits.\n\nCUT TO:\n", "scene complete"))
+
+    def test_scene_complete_before_extra_heading(self):
+        rules = StopRules(scene_complete=True)
+        text = "INT. A - DAY\n\nMara waits.\n\nEXT. B - NIGHT\nRain."
+        self.assertEqual(run(rules, text, (3,)), ("INT. A - DAY\n\nMara waits.\n\n", "next scene"))
+
+    def test_invalid_pattern(self):
+        self.assertIsNone(pattern_error(r"^Note"))
+        self.assertIsNotNone(pattern_error("(unclosed"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.streaming import StreamProcessor, TokenCoalescer  # noqa: E402
+
+
+def process_message(message):
+    """The add-on's message processing before it streamed, kept as the reference"""
+    lines = message.split("\n")
+    processed = []
+    in_code_block = False
+    for line in lines:
+        line = line.rstrip()
+        if line == "```python":
+            in_code_block = True
+        elif in_code_block:
+            if line == "```":
+                in_code_block = False
+            else:
+                processed.append(line)
+        else:
+            processed.append(line)
+    return "\n".join(processed)
+
+
+def stream(message, sizes):
+    processor = StreamProcessor()
+    chunks = []
+    i = 0
+    n = 0
+    while i < len(message):
+        size = sizes[n % len(sizes)]
+        chunks.append(processor.feed(message[i : i + size]))
+        i += size
+        n += 1
+    chunks.append(processor.finish())
+    return "".join(chunks)
+
+
+class StreamProcessorTest(unittest.TestCase):
+    def test_matches_process_message(self):
+        random.seed(2)
+        pieces = ["INT. A", "Mara", "  ", " ", "\n", "\n\n", "```python", "```", "`", "``", "print(1)", "\t"]
+        for _ in range(1000):
+            message = "".join(random.choice(pieces) for _ in range(random.randint(0, 25)))
+            expected = process_message(message)
+            for sizes in ((1,), (2, 5), (len(message) or 1,)):
+                self.assertEqual(stream(message, sizes), expected, repr(message))
+
+    def test_code_fence_split_over_tokens(self):
+        message = "Before\n``" + "`pyth" + "on\nx = 1   \n``" + "`\nAfter"
+        self.assertEqual(stream(message, (3,)), "Before\nx = 1\nAfter")
+
+
+class TokenCoalescerTest(unittest.TestCase):
+    def test_rate_limit_and_newline_flush(self):
+        now = [0.0]
+        coalescer = TokenCoalescer(max_rate=10, clock=lambda: now[0])
+        coalescer.push("a")
+        self.assertEqual(coalescer.poll(), "a")
+        coalescer.push("b")
+        now[0] = 0.05
+        self.assertEqual(coalescer.poll(), "")
+        coalescer.push("c\n")
+        self.assertEqual(coalescer.poll(), "bc\n")
+        coalescer.push("d")
+        now[0] = 0.2
+        self.assertEqual(coalescer.poll(), "d")
+        self.assertEqual(coalescer.flushes, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine.textdiff import LineDiff, diff_preview, split_lines, text_end  # noqa: E402
+
+
+def offset(text, position):
+    line, character = position
+    lines = text.split("\n")
+    return sum(len(text) + 1 for text in lines[:line]) + character
+
+
+def apply(text, diff):
+    """Apply the edits of a LineDiff to text, the way commit_output does to a Text"""
+    for start, end, replacement in diff.edits:
+        text = text[: offset(text, start)] + replacement + text[offset(text, end) :]
+    return text
+
+
+class LineDiffTest(unittest.TestCase):
+    def test_apply_gives_the_new_text(self):
+        random.seed(4)
+        pieces = ["a", "b", "Mara", "", "INT. A"]
+        for _ in range(2000):
+            old = "\n".join(random.choice(pieces) for _ in range(random.randint(0, 6)))
+            new = "\n".join(random.choice(pieces) for _ in range(random.randint(0, 6)))
+            before = "".join(random.choice(pieces) for _ in range(2))
+            after = "\n" + random.choice(pieces) if random.random() < 0.5 else ""
+            head = before.split("\n")
+            start = (len(head) - 1, len(head[-1]))
+            diff = LineDiff(start, old, new)
+            self.assertEqual(apply(before + old + after, diff), before + new + after, (before, old, new, after))
+
+    def test_unchanged_lines_are_not_written(self):
+        diff = LineDiff((0, 0), "one\ntwo\nthree", "one\n2\nthree")
+        self.assertEqual(diff.edits, [((1, 0), (2, 0), "2\n")])
+        self.assertEqual((diff.added, diff.removed), (1, 1))
+        self.assertEqual(LineDiff((3, 2), "same", "same").edits, [])
+
+    def test_helpers(self):
+        self.assertEqual(split_lines("a\nb\n"), ["a\n", "b\n"])
+        self.assertEqual(text_end((2, 3), "ab"), (2, 5))
+        self.assertEqual(text_end((2, 3), "ab\ncd"), (3, 2))
+        self.assertEqual(diff_preview("a\nb", "a\nc"), ["- b", "+ c"])
+
+
+if __name__ == "__main__":
+    unittest.main()